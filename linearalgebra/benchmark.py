@@ -0,0 +1,583 @@
+"""Benchmarks for the linearalgebra module.
+
+Each bench_* function below times one aspect of the linearalgebra module and
+prints a small table of results. All of them can be run by executing:
+
+python benchmark.py
+
+or just some of them, by giving the part of their names after 'bench_':
+
+python benchmark.py validation"""
+
+import contextlib
+import gc
+import multiprocessing
+import os
+import random
+import resource
+import sys
+import tempfile
+import time
+
+import linearalgebra as la
+
+
+def random_vector(n, low=-10.0, high=10.0):
+    """ Create a vector of n random floats between low and high. """
+    return [random.uniform(low, high) for i in range(n)]
+
+
+def random_matrix(m, n, low=-10.0, high=10.0):
+    """ Create an m x n matrix of random floats between low and high. """
+    return [random_vector(n, low, high) for i in range(m)]
+
+
+def best_time(func, *args, **kwargs):
+    """ Call func with the given args 'repeat' times (default 3), returning
+    the shortest time taken by a single call, in seconds. """
+    repeat = kwargs.pop('repeat', 3)
+    best = None
+    for i in range(repeat):
+        start = time.time()
+        func(*args, **kwargs)
+        elapsed = time.time() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+
+@contextlib.contextmanager
+def using_backend(name):
+    """ Context manager in which the linearalgebra module uses the given
+    backend. """
+    previous = la.backend
+    la.set_backend(name)
+    try:
+        yield
+    finally:
+        la.backend = previous
+
+
+def loop(func, n, *args):
+    """ Call func with the given args n times. """
+    for i in xrange(n):
+        func(*args)
+
+
+def bench_validation(sizes=(10, 25, 50), loops=10):
+    """ Time calling matrix_plus and matrix_product repeatedly on the same
+    operands with full validation, with the validation cache, in trusted
+    mode and on Matrix instances. """
+    with using_backend('python'):
+        _bench_validation(sizes, loops)
+
+
+def _bench_validation(sizes, loops):
+    print("validation: %d calls per timing" % loops)
+    print("%5s %-15s %10s %10s %10s %10s"
+          % ("n", "function", "checked", "cached", "trusted", "Matrix"))
+    for n in sizes:
+        ma, mb = random_matrix(n, n), random_matrix(n, n)
+        xa, xb = la.Matrix(ma), la.Matrix(mb)
+        for func in (la.matrix_plus, la.matrix_product):
+            checked = best_time(loop, func, loops, ma, mb)
+            la.cache_validation = True
+            try:
+                cached = best_time(loop, func, loops, ma, mb)
+            finally:
+                la.cache_validation = False
+                la.clear_validation_cache()
+            with la.trusted_mode():
+                trusted = best_time(loop, func, loops, ma, mb)
+            matrix = best_time(loop, func, loops, xa, xb)
+            print("%5d %-15s %10.4f %10.4f %10.4f %10.4f"
+                  % (n, func.__name__, checked, cached, trusted, matrix))
+
+
+def naive_product(ma, mb):
+    """ The original matrix_product, which builds each column of B anew for
+    every element of the result. """
+    (m, n) = la.matrix_dimensions(ma)
+    (n, r) = la.matrix_dimensions(mb)
+    mc = [[None] * r for i in range(m)]
+    for i in range(m):
+        for j in range(r):
+            mc[i][j] = la.vector_product(ma[i], [row[j] for row in mb])
+    return mc
+
+
+def bench_product(sizes=(16, 32, 64, 128, 256)):
+    """ Time multiplying n x n matrices with each of the product functions,
+    for a sweep of sizes n. """
+    with using_backend('python'):
+        _bench_product(sizes)
+
+
+def _bench_product(sizes):
+    print("product: seconds per n x n product")
+    print("%5s %10s %10s %10s %10s %10s"
+          % ("n", "naive", "product", "blocked", "strassen", "Matrix"))
+    for n in sizes:
+        ma, mb = random_matrix(n, n), random_matrix(n, n)
+        xa, xb = la.Matrix(ma), la.Matrix(mb)
+        naive = best_time(naive_product, ma, mb, repeat=1) if n <= 64 else None
+        print("%5d %10s %10.4f %10.4f %10.4f %10.4f"
+              % (n, "%.4f" % naive if naive is not None else "-",
+                 best_time(la.matrix_product, ma, mb),
+                 best_time(la.matrix_product_blocked, ma, mb),
+                 best_time(la.matrix_product_strassen, ma, mb),
+                 best_time(la.matrix_product, xa, xb)))
+
+
+def bench_backend(sizes=(4, 64, 256)):
+    """ Time the functions that have a NumPy implementation with each
+    backend, on n x n matrices and vectors of size n. """
+    if la.numpy is None:
+        print("backend: skipped, NumPy is not installed")
+        return
+    print("backend: seconds per call")
+    print("%5s %-17s %10s %10s %10s"
+          % ("n", "function", "python", "numpy", "Matrix"))
+    for n in sizes:
+        ma, mb = random_matrix(n, n), random_matrix(n, n)
+        xa, xb = la.Matrix(ma), la.Matrix(mb)
+        u, v = random_vector(n), random_vector(n)
+        cases = [(la.matrix_product, (ma, mb), (xa, xb)),
+                 (la.matrix_transpose, (ma,), (xa,)),
+                 (la.matrix_plus, (ma, mb), (xa, xb)),
+                 (la.matrix_minus, (ma, mb), (xa, xb)),
+                 (la.vector_product, (u, v), None),
+                 (la.vector_norm, (u,), None)]
+        for (func, args, matrix_args) in cases:
+            with using_backend('python'):
+                python = best_time(func, *args)
+            with using_backend('numpy'):
+                numpy = best_time(func, *args)
+                matrix = (best_time(func, *matrix_args)
+                          if matrix_args else None)
+            print("%5d %-17s %10.6f %10.6f %10s"
+                  % (n, func.__name__, python, numpy,
+                     "%.6f" % matrix if matrix is not None else "-"))
+
+
+def cofactor_det(ma):
+    """ Calculate the determinant of A by cofactor expansion along the
+    first row, which takes time proportional to n!. """
+    n = len(ma)
+    if n == 0:
+        return 1
+    if n == 1:
+        return ma[0][0]
+    det = 0
+    for j in range(n):
+        minor = [row[:j] + row[j + 1:] for row in ma[1:]]
+        sign = -1 if j % 2 else 1
+        det += sign * ma[0][j] * cofactor_det(minor)
+    return det
+
+
+def bench_lu(sizes=(4, 6, 8, 16, 64), solves=100):
+    """ Time matrix_det against cofactor expansion, and solving for many
+    right-hand sides with one LU decomposition against calling matrix_solve
+    for each of them. """
+    print("lu: seconds per determinant; seconds for %d solves" % solves)
+    print("%5s %10s %10s %10s %10s"
+          % ("n", "cofactor", "det", "solve", "lu_solve"))
+    with using_backend('python'):
+        for n in sizes:
+            ma = random_matrix(n, n)
+            vs = [random_vector(n) for i in range(solves)]
+            cofactor = (best_time(cofactor_det, ma, repeat=1)
+                        if n <= 8 else None)
+            det = best_time(la.matrix_det, ma)
+            solve = best_time(lambda: [la.matrix_solve(ma, v) for v in vs])
+            lu_solve = best_time(lambda: [la.matrix_lu_solve(lu, v)
+                                          for lu in [la.matrix_lu(ma)]
+                                          for v in vs])
+            print("%5d %10s %10.4f %10.4f %10.4f"
+                  % (n, "%.4f" % cofactor if cofactor is not None else "-",
+                     det, solve, lu_solve))
+
+
+def random_sparse_matrix(m, n, density):
+    """ Create an m x n (dense) matrix in which each element is a random
+    float with the given probability, and 0 otherwise. """
+    return [[random.uniform(-10.0, 10.0) if random.random() < density else 0
+             for j in range(n)] for i in range(m)]
+
+
+def bench_sparse(sizes=(50, 100, 200), density=0.02):
+    """ Time the matrix functions on CSR matrices against the same matrices
+    stored densely. """
+    print("sparse: seconds per call, %.0f%% nonzero" % (density * 100))
+    print("%5s %-22s %10s %10s" % ("n", "function", "dense", "csr"))
+    with using_backend('python'):
+        for n in sizes:
+            ma = random_sparse_matrix(n, n, density)
+            mb = random_sparse_matrix(n, n, density)
+            sa, sb = la.CSRMatrix.from_dense(ma), la.CSRMatrix.from_dense(mb)
+            cases = [(la.matrix_product, (ma, mb), (sa, sb)),
+                     (la.matrix_product, (ma, mb), (sa, mb)),
+                     (la.matrix_plus, (ma, mb), (sa, sb)),
+                     (la.matrix_transpose, (ma,), (sa,)),
+                     (la.matrix_is_symmetric, (ma,), (sa,))]
+            for (func, dense_args, sparse_args) in cases:
+                name = func.__name__
+                if any(type(x) is list for x in sparse_args):
+                    name += "(dense)"
+                print("%5d %-22s %10.6f %10.6f"
+                      % (n, name, best_time(func, *dense_args),
+                         best_time(func, *sparse_args)))
+
+
+def bench_batch(dims=(3, 16, 128), count=2000):
+    """ Time scoring one vector against many with the batched vector
+    functions, against calling the single-vector function for each. """
+    print("batch: seconds to score 1 vector against %d" % count)
+    print("%5s %-19s %10s %10s %10s"
+          % ("n", "function", "loop", "batch", "numpy"))
+    for n in dims:
+        u = random_vector(n)
+        vs = [random_vector(n) for i in range(count)]
+        cases = [(la.vector_norm, la.vector_norms, False),
+                 (la.vector_distance, la.vector_distances, True),
+                 (la.vector_angle, la.vector_angles, True),
+                 (la.vector_project, la.vector_projections, True),
+                 (la.vector_plus, la.vector_sums, True)]
+        for (single, batch, takes_u) in cases:
+            if takes_u:
+                looped = lambda: [single(u, v) for v in vs]
+                batched = lambda: batch(u, vs)
+            else:
+                looped = lambda: [single(v) for v in vs]
+                batched = lambda: batch(vs)
+            with using_backend('python'):
+                loop_time = best_time(looped)
+                batch_time = best_time(batched)
+            numpy = None
+            if la.numpy is not None:
+                with using_backend('numpy'):
+                    numpy = best_time(batched)
+            print("%5d %-19s %10.6f %10.6f %10s"
+                  % (n, batch.__name__, loop_time, batch_time,
+                     "%.6f" % numpy if numpy is not None else "-"))
+
+
+def measure_in_child(func, *args):
+    """ Call func with the given args in a forked child process, returning
+    a triple of the seconds taken, the growth in the peak resident memory
+    of the child in kilobytes, and the number of garbage collections that
+    ran during the call. """
+    (r, w) = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        os.close(r)
+        log = tempfile.TemporaryFile()
+        os.dup2(log.fileno(), 2)
+        before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        gc.set_debug(gc.DEBUG_STATS)
+        start = time.time()
+        func(*args)
+        elapsed = time.time() - start
+        gc.set_debug(0)
+        after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        log.seek(0)
+        collections = sum(1 for line in log if 'collecting generation' in line)
+        os.write(w, "%r %r %r" % (elapsed, after - before, collections))
+        os._exit(0)
+    os.close(w)
+    result = os.read(r, 1024)
+    os.close(r)
+    os.waitpid(pid, 0)
+    (elapsed, growth, collections) = result.split()
+    return (float(elapsed), int(growth), int(collections))
+
+
+def damp_allocating(x, y, steps):
+    """ Repeatedly set x to x / 2 + y, creating new matrices each time. """
+    for i in xrange(steps):
+        x = la.matrix_plus(la.matrix_times(0.5, x), y)
+    return x
+
+
+def damp_in_place(x, y, steps):
+    """ Repeatedly set x to x / 2 + y, updating x in place. """
+    for i in xrange(steps):
+        la.matrix_iscale(0.5, x)
+        la.matrix_iadd(x, y)
+    return x
+
+
+def bench_inplace(sizes=(50, 200), steps=50):
+    """ Time an iterative update of a matrix with the allocating functions
+    and with their in-place forms, measuring the growth in peak memory and
+    the number of garbage collections along the way. """
+    print("inplace: %d steps of x = x / 2 + y" % steps)
+    print("%5s %-8s %-11s %10s %10s %12s"
+          % ("n", "type", "variant", "seconds", "peak kB", "collections"))
+    with using_backend('python'):
+        for n in sizes:
+            for kind in ("list", "Matrix"):
+                for (name, func) in (("allocating", damp_allocating),
+                                     ("in-place", damp_in_place)):
+                    (x, y) = (random_matrix(n, n), random_matrix(n, n))
+                    if kind == "Matrix":
+                        (x, y) = (la.Matrix(x), la.Matrix(y))
+                    (elapsed, growth, collections) = measure_in_child(
+                        func, x, y, steps)
+                    print("%5d %-8s %-11s %10.4f %10d %12d"
+                          % (n, kind, name, elapsed, growth, collections))
+
+
+def load_text(path):
+    """ Read a matrix written one row per line of whitespace-separated
+    numbers into nested lists. """
+    with open(path) as f:
+        return [map(float, line.split()) for line in f]
+
+
+def scan_blocks(ma, rows=64):
+    """ Sum every element of the matrix, one block of rows at a time. """
+    return sum(sum(block.flat()) for block in la.matrix_row_blocks(ma, rows))
+
+
+def write_files(n, text, binary):
+    """ Write a random n x n matrix to the given paths, as text with one
+    row per line and with matrix_save. """
+    ma = random_matrix(n, n)
+    with open(text, 'w') as f:
+        for row in ma:
+            f.write(" ".join(repr(x) for x in row) + "\n")
+    la.matrix_save(ma, binary)
+
+
+def bench_files(sizes=(300, 1000)):
+    """ Time loading an n x n matrix from a text file into nested lists
+    against opening it with matrix_load, and then scanning the mapped
+    matrix in blocks of rows, measuring the growth in peak memory (which,
+    for the scan, includes the pages of the file mapped into memory, which
+    the system can reclaim at any time). """
+    print("files: loading n x n matrices")
+    print("%5s %-20s %10s %10s %10s"
+          % ("n", "method", "file kB", "seconds", "peak kB"))
+    directory = tempfile.mkdtemp()
+    (text, binary) = (os.path.join(directory, 'a.txt'),
+                      os.path.join(directory, 'a.lamx'))
+    try:
+        for n in sizes:
+            # Writing the files in a child process keeps the matrix from
+            # raising the peak memory of this one, which the children
+            # below inherit.
+            measure_in_child(write_files, n, text, binary)
+            for (name, path, func) in (
+                    ("text to lists", text, load_text),
+                    ("matrix_load", binary, la.matrix_load),
+                    ("matrix_load + scan", binary,
+                     lambda path: scan_blocks(la.matrix_load(path)))):
+                (elapsed, growth, collections) = measure_in_child(func, path)
+                print("%5d %-20s %10d %10.4f %10d"
+                      % (n, name, os.path.getsize(path) // 1024, elapsed,
+                         growth))
+    finally:
+        for path in (text, binary):
+            if os.path.exists(path):
+                os.remove(path)
+        os.rmdir(directory)
+
+
+def bench_lazy(n=150):
+    """ Time multi-step expressions calculated eagerly, one function at a
+    time, against the same expressions recorded on lazy matrices and then
+    evaluated. """
+    print("lazy: seconds per expression, n = %d" % n)
+    print("%-30s %10s %10s" % ("expression", "eager", "lazy"))
+    args = [random_matrix(n, n) for i in range(3)]
+    args += [random_matrix(n, 4), random_matrix(4, n)]
+    p, t, times = la.matrix_plus, la.matrix_transpose, la.matrix_times
+    minus, product = la.matrix_minus, la.matrix_product
+    cases = [("2A + B - C / 2 + A^T",
+              lambda a, b, c, tall, wide:
+              p(minus(p(times(2, a), b), times(0.5, c)), t(a))),
+             ("(A^T)^T + B",
+              lambda a, b, c, tall, wide: p(t(t(a)), b)),
+             ("2A + BC",
+              lambda a, b, c, tall, wide: p(times(2, a), product(b, c))),
+             ("((tall wide) tall) wide",
+              lambda a, b, c, tall, wide:
+              product(product(product(tall, wide), tall), wide))]
+    lazy_args = [la.lazy(x) for x in args]
+    with using_backend('python'):
+        for (name, func) in cases:
+            eager = best_time(func, *args)
+            lazy = best_time(lambda: la.evaluate(func(*lazy_args)))
+            print("%-30s %10.4f %10.4f" % (name, eager, lazy))
+
+
+def bench_parallel(sizes=(100, 200), workers=(1, 2, 4, 8)):
+    """ Time matrix_product_parallel with increasing numbers of worker
+    processes, against matrix_product. """
+    print("parallel: seconds per product (speedup over serial), %d CPU(s)"
+          % multiprocessing.cpu_count())
+    print("%5s %10s %s" % ("n", "serial", " ".join("%16s" % ("%d workers" % w)
+                                                 for w in workers)))
+    threshold = la.parallel_threshold
+    la.parallel_threshold = 0
+    try:
+        with using_backend('python'):
+            for n in sizes:
+                ma, mb = random_matrix(n, n), random_matrix(n, n)
+                serial = best_time(la.matrix_product, ma, mb)
+                row = []
+                for w in workers:
+                    elapsed = best_time(la.matrix_product_parallel, ma, mb, w)
+                    row.append("%9.4f (%4.2f)" % (elapsed, serial / elapsed))
+                print("%5d %10.4f %s" % (n, serial,
+                                         " ".join("%16s" % x for x in row)))
+    finally:
+        la.parallel_threshold = threshold
+
+
+def grid_matrix(k, shift=1.0):
+    """ Create the sparse, symmetric, strictly diagonally dominant n x n
+    matrix, for n = k^2, of the 5-point Laplacian on a k x k grid plus
+    shift times the identity. """
+    n = k * k
+    values = {}
+    for i in range(n):
+        values[(i, i)] = 4.0 + shift
+        for j in (i - k, i + k) + ((i - 1,) if i % k else ()) + \
+                ((i + 1,) if (i + 1) % k else ()):
+            if 0 <= j < n:
+                values[(i, j)] = -1.0
+    keys = sorted(values)
+    return la.COOMatrix((n, n), [i for (i, j) in keys],
+                        [j for (i, j) in keys],
+                        [values[key] for key in keys]).tocsr()
+
+
+def bench_iterative(grids=(10, 20)):
+    """ Time the iterative solvers and eigenvalue routines on sparse grid
+    matrices, against matrix_solve on the same matrix stored densely. """
+    print("iterative: seconds (iterations) on k x k grid matrices")
+    print("%4s %6s %12s %16s %16s %16s %16s %16s"
+          % ("k", "n", "solve", "cg", "jacobi", "gauss_seidel",
+             "power", "lanczos(3)"))
+    with using_backend('python'):
+        for k in grids:
+            ma = grid_matrix(k)
+            n = ma.shape[0]
+            b = random_vector(n)
+            dense = ma.tolist() if n <= 400 else None
+            solve = (best_time(la.matrix_solve, dense, b, repeat=1)
+                     if dense else None)
+            row = []
+            for func in (la.matrix_cg, la.matrix_jacobi,
+                         la.matrix_gauss_seidel):
+                result = []
+                elapsed = best_time(lambda: result.append(func(ma, b)),
+                                    repeat=1)
+                row.append("%9.4f (%3d)" % (elapsed, result[-1][1]))
+            for func in (lambda x: la.matrix_power_iteration(
+                             x, max_iterations=100000),
+                         lambda x: la.matrix_lanczos(x, 3)):
+                result = []
+                elapsed = best_time(lambda: result.append(func(ma)),
+                                    repeat=1)
+                row.append("%9.4f (%3d)" % (elapsed, result[-1][-1]))
+            print("%4d %6d %12s %s" % (k, n, "%.4f" % solve if solve else "-",
+                                       " ".join("%16s" % x for x in row)))
+
+
+def fraction_lu_det(ma):
+    """ Calculate the determinant exactly from an LU decomposition over
+    Fractions, for comparison with fraction-free elimination. """
+    with la.exact_mode():
+        (p, ml, mu) = la.matrix_lu(ma)
+    det = 1
+    for (i, row) in enumerate(mu):
+        det *= row[i]
+    return -det if la._permutation_is_odd(p) else det
+
+
+def bench_exact(sizes=(5, 10, 20, 40), low=-10, high=10):
+    """ Time the determinant, rank and solution of systems of random integer
+    matrices in float mode against exact mode, along with the determinant
+    from an LU decomposition over Fractions, and show the relative error of
+    the float determinant. """
+    print("exact: seconds per call on n x n matrices of ints in [%d, %d]"
+          % (low, high))
+    print("%4s %9s %9s %9s %9s %9s %9s %9s %9s"
+          % ("n", "det", "exact", "LU exact", "rank", "exact", "solve",
+             "exact", "det error"))
+    with using_backend('python'):
+        for n in sizes:
+            ma = [[random.randint(low, high) for j in range(n)]
+                  for i in range(n)]
+            b = [random.randint(low, high) for i in range(n)]
+            row = []
+            for func in (la.matrix_det, fraction_lu_det, la.matrix_rank,
+                         lambda ma: la.matrix_solve(ma, b)):
+                row.append(best_time(func, ma))
+                if func is not fraction_lu_det:
+                    with la.exact_mode():
+                        row.append(best_time(func, ma))
+            with la.exact_mode():
+                det = la.matrix_det(ma)
+            error = abs(la.matrix_det(ma) - det) / abs(det) if det else 0.0
+            print("%4d %s %9.1e"
+                  % (n, " ".join("%9.5f" % x for x in row), error))
+
+
+def structured_matrix(n, structure):
+    """ Create a random n x n Matrix with the given structure, along with
+    the same matrix without its structure recorded. """
+    ma = random_matrix(n, n)
+    for i in range(n):
+        for j in range(n):
+            if ((structure == 'diagonal' and i != j) or
+                    (structure == 'upper' and j < i)):
+                ma[i][j] = 0.0
+            elif structure == 'symmetric' and j < i:
+                ma[i][j] = ma[j][i]
+    return (la.Matrix(ma), la.Matrix(ma, structure=structure))
+
+
+def bench_structure(sizes=(100, 200)):
+    """ Time products, sums, solutions and determinants of Matrix operands
+    with their structure recorded, against the same operands without. """
+    print("structure: seconds per call")
+    print("%5s %-30s %10s %10s %8s"
+          % ("n", "operation", "plain", "structured", "speedup"))
+    cases = [("diagonal x dense product", 'diagonal', None,
+              la.matrix_product),
+             ("dense x diagonal product", None, 'diagonal',
+              la.matrix_product),
+             ("upper x upper product", 'upper', 'upper', la.matrix_product),
+             ("diagonal + diagonal", 'diagonal', 'diagonal', la.matrix_plus),
+             ("upper + upper", 'upper', 'upper', la.matrix_plus),
+             ("symmetric + symmetric", 'symmetric', 'symmetric',
+              la.matrix_plus),
+             ("upper solve", 'upper', None,
+              lambda ma, b: la.matrix_solve(ma, b[0])),
+             ("upper det", 'upper', None, lambda ma, b: la.matrix_det(ma))]
+    with using_backend('python'):
+        for n in sizes:
+            for (name, sa, sb, func) in cases:
+                (plain_a, ma) = structured_matrix(n, sa)
+                (plain_b, mb) = structured_matrix(n, sb)
+                plain = best_time(func, plain_a, plain_b, repeat=1)
+                structured = best_time(func, ma, mb, repeat=1)
+                print("%5d %-30s %10.4f %10.4f %8.1f"
+                      % (n, name, plain, structured, plain / structured))
+
+
+def main(args):
+    names = args or sorted(name[len('bench_'):] for name in globals()
+                           if name.startswith('bench_'))
+    for name in names:
+        globals()['bench_' + name]()
+        print("")
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -2,6 +2,19 @@ import math
 import operator
 import sets
 import functools
+import contextlib
+import itertools
+import bisect
+import random
+import os
+import sys
+import mmap
+import struct
+import multiprocessing
+import threading
+from multiprocessing import sharedctypes
+from array import array
+from fractions import Fraction, gcd
 
 """A module providing some basic linear algebra operations.
 
@@ -74,8 +87,1122 @@ class IncompatibleMatrixException(LAValueError):
     pass
 
 
+class SingularMatrixException(LAValueError):
+    pass
+
+
+class ConvergenceException(LAValueError):
+    pass
+
+
+class Matrix(object):
+    """
+    A dense m x n matrix whose elements are stored as floats in a single
+    flat array('d'), along with the shape, strides and offset needed to find
+    the (i, j) element at data[offset + i * strides[0] + j * strides[1]].
+
+    The elements are validated once, when the matrix is constructed, so the
+    matrix functions below can trust the recorded shape instead of rescanning
+    every row on every call. A Matrix may be passed anywhere a list-of-lists
+    matrix is accepted; when any operand is a Matrix, the result is a Matrix.
+
+    A Matrix can also record its structure, which is checked once, when it
+    is constructed, and is one of 'identity', 'scalar', 'diagonal', 'upper'
+    or 'lower' (triangular) and 'symmetric', so that the matrix functions
+    can use faster methods for it (see matrix_structure). Setting elements
+    of the matrix forgets its structure.
+
+    >>> a = Matrix([[1, 2, 3], [4, 5, 6]])
+    >>> a.shape, a.strides
+    ((2, 3), (3, 1))
+    >>> a
+    Matrix([[1.0, 2.0, 3.0], [4.0, 5.0, 6.0]])
+    >>> a[1], a[1, 2], len(a)
+    ([4.0, 5.0, 6.0], 6.0, 2)
+    >>> a[-1], a[-1, -1], a[0, -3]
+    ([4.0, 5.0, 6.0], 6.0, 1.0)
+    >>> a[0, 3]
+    Traceback (most recent call last):
+      ...
+    IndexError: Matrix index out of range: (0, 3)
+    >>> a[2, 0] = 7.0
+    Traceback (most recent call last):
+      ...
+    IndexError: Matrix index out of range: (2, 0)
+    >>> a.transpose().tolist()
+    [[1.0, 4.0], [2.0, 5.0], [3.0, 6.0]]
+    >>> Matrix([]).shape, Matrix([[]]).shape
+    ((0, 0), (1, 0))
+    >>> Matrix([[1], [2, 3]])
+    Traceback (most recent call last):
+      ...
+    InvalidMatrixException: Arg is not a matrix: [[1], [2, 3]]
+    >>> Matrix([[1, 2], [0, 3]], structure='upper').transpose()
+    Matrix([[1.0, 0.0], [2.0, 3.0]], structure='lower')
+    >>> d = Matrix([[1, 0], [0, 2]], structure='diagonal')
+    >>> d.transpose()[0, 1] = 5.0
+    >>> for block in matrix_row_blocks(d, 1):
+    ...     block[0, 1] = 5.0
+    >>> d, matrix_product(d, [[1], [1]])
+    (Matrix([[1.0, 0.0], [0.0, 2.0]], structure='diagonal'), Matrix([[1.0], [2.0]]))
+    >>> Matrix([[1, 2], [3, 4]], structure='upper')
+    Traceback (most recent call last):
+      ...
+    InvalidMatrixException: Matrix is not upper: [[1, 2], [3, 4]]
+    """
+
+    __slots__ = ('data', 'shape', 'strides', 'offset', 'structure')
+
+    def __init__(self, ma=(), structure=None):
+        if isinstance(ma, Matrix):
+            if structure is None:
+                structure = ma.structure
+            else:
+                _check_structure(ma, structure)
+            ma = ma.contiguous()
+            (m, n) = ma.shape
+            data = array('d', ma.flat())
+        elif not is_matrix(ma):
+            raise InvalidMatrixException("Arg is not a matrix: %s" % repr(ma))
+        else:
+            m = len(ma)
+            n = len(ma[0]) if m else 0
+            if structure is not None:
+                _check_structure(ma, structure)
+            data = array('d')
+            for row in ma:
+                data.extend(row)
+        self.data = data
+        self.shape = (m, n)
+        self.strides = (n, 1)
+        self.offset = 0
+        self.structure = structure
+
+    @classmethod
+    def from_array(cls, data, m, n, strides=None, offset=0, structure=None):
+        """ Create an m x n matrix that uses the given flat sequence of
+        floats as its storage, without copying or validating it. """
+        mc = cls.__new__(cls)
+        mc.data = data
+        mc.shape = (m, n)
+        mc.strides = (n, 1) if strides is None else tuple(strides)
+        mc.offset = offset
+        mc.structure = structure
+        return mc
+
+    @classmethod
+    def zeros(cls, m, n):
+        """ Create an m x n matrix with every element equal to 0.0. """
+        return cls.from_array(array('d', [0.0]) * (m * n), m, n)
+
+    def is_contiguous(self):
+        """ Determine whether the elements are stored row-major, with no
+        gaps between the rows. """
+        return self.strides == (self.shape[1], 1)
+
+    def contiguous(self):
+        """ Return this matrix if it is contiguous, or else a contiguous
+        copy of it. """
+        return self if self.is_contiguous() else self.copy()
+
+    def copy(self):
+        """ Return a contiguous copy of this matrix. """
+        (m, n) = self.shape
+        data = array('d')
+        for i in range(m):
+            data.extend(self._row_slice(i))
+        return Matrix.from_array(data, m, n, structure=self.structure)
+
+    def flat(self):
+        """ Return the m * n elements in row-major order, as a slice of
+        the underlying storage if possible rather than a copy. """
+        (m, n) = self.shape
+        if self.is_contiguous():
+            if self.offset == 0 and len(self.data) == m * n:
+                return self.data
+            return self.data[self.offset:self.offset + m * n]
+        return self.copy().data
+
+    def transpose(self):
+        """ Return the transpose of this matrix as a view that shares the
+        storage of this matrix, unless the matrix has a recorded structure,
+        which writes through a view would leave stale, in which case it is
+        a copy. """
+        (m, n) = self.shape
+        (s0, s1) = self.strides
+        mc = Matrix.from_array(self.data, n, m, (s1, s0), self.offset,
+                               _TRANSPOSED.get(self.structure,
+                                               self.structure))
+        return mc if self.structure is None else mc.copy()
+
+    def _row_slice(self, i):
+        (m, n) = self.shape
+        (s0, s1) = self.strides
+        start = self.offset + i * s0
+        if s1 == 1:
+            return self.data[start:start + n]
+        return self.data[start:start + n * s1:s1]
+
+    def row(self, i):
+        """ Return row i as a list (i.e., a vector). """
+        if not 0 <= i < self.shape[0]:
+            raise IndexError("Matrix row index out of range: %s" % i)
+        return list(self._row_slice(i))
+
+    def tolist(self):
+        """ Return the elements as a list of lists. """
+        return [self.row(i) for i in range(self.shape[0])]
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __iter__(self):
+        for i in range(self.shape[0]):
+            yield self.row(i)
+
+    def _position(self, index):
+        # The position in data of the (i, j) element, counting negative
+        # indexes from the end as lists do.
+        (i, j) = index
+        (m, n) = self.shape
+        if i < 0:
+            i += m
+        if j < 0:
+            j += n
+        if not (0 <= i < m and 0 <= j < n):
+            raise IndexError("Matrix index out of range: %s" % (index,))
+        return self.offset + i * self.strides[0] + j * self.strides[1]
+
+    def __getitem__(self, index):
+        if isinstance(index, tuple):
+            return self.data[self._position(index)]
+        if index < 0:
+            index += self.shape[0]
+        return self.row(index)
+
+    def __setitem__(self, index, value):
+        self.data[self._position(index)] = value
+        self.structure = None
+
+    def __repr__(self):
+        if self.structure is not None:
+            return "Matrix(%r, structure=%r)" % (self.tolist(), self.structure)
+        return "Matrix(%r)" % self.tolist()
+
+
+def as_matrix(ma):
+    """
+    Return the given matrix as a Matrix, converting a list-of-lists matrix
+    if necessary, but returning a Matrix unchanged.
+
+    >>> as_matrix([[1, 2]])
+    Matrix([[1.0, 2.0]])
+    >>> a = Matrix([[1]])
+    >>> as_matrix(a) is a
+    True
+    """
+    return ma if isinstance(ma, Matrix) else Matrix(ma)
+
+
+class MappedArray(object):
+    """
+    A flat sequence of floats stored as little-endian doubles in a memory
+    map (see matrix_load), starting at a given byte offset, which reads
+    elements from the map (and, if it is writable, writes them to it) only
+    as they are indexed, rather than holding them all in memory. Slices are
+    array('d') copies of just the elements they select, so a MappedArray
+    can be the storage of a Matrix.
+    """
+
+    __slots__ = ('mmap', 'start', 'size')
+
+    def __init__(self, mm, start, size):
+        self.mmap = mm
+        self.start = start
+        self.size = size
+
+    def _read(self, i, j):
+        """ Return elements i to j (exclusive) as an array('d'). """
+        data = array('d')
+        data.fromstring(self.mmap[self.start + 8 * i:self.start + 8 * j])
+        if sys.byteorder == 'big':
+            data.byteswap()
+        return data
+
+    def _position(self, index):
+        if index < 0:
+            index += self.size
+        if not 0 <= index < self.size:
+            raise IndexError("array index out of range")
+        return self.start + 8 * index
+
+    def __len__(self):
+        return self.size
+
+    def __iter__(self):
+        for i in xrange(0, self.size, 4096):
+            for x in self._read(i, min(i + 4096, self.size)):
+                yield x
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            (i, j, step) = index.indices(self.size)
+            if step == 1:
+                return self._read(i, max(i, j))
+            return array('d', [struct.unpack_from('<d', self.mmap,
+                                                  self.start + 8 * k)[0]
+                               for k in xrange(i, j, step)])
+        return struct.unpack_from('<d', self.mmap, self._position(index))[0]
+
+    def __setitem__(self, index, value):
+        if not isinstance(index, slice):
+            struct.pack_into('<d', self.mmap, self._position(index), value)
+            return
+        (i, j, step) = index.indices(self.size)
+        keys = xrange(i, j, step)
+        values = array('d', value)
+        if len(values) != len(keys):
+            raise ValueError("attempt to assign sequence of size %d to "
+                             "slice of size %d" % (len(values), len(keys)))
+        if step != 1:
+            for (k, x) in zip(keys, values):
+                self[k] = x
+            return
+        if sys.byteorder == 'big':
+            values.byteswap()
+        self.mmap[self.start + 8 * i:self.start + 8 * j] = values.tostring()
+
+    def __repr__(self):
+        return "MappedArray(%d element(s) at byte %d)" % (self.size,
+                                                          self.start)
+
+
+class SparseMatrix(object):
+    """
+    Base class for sparse m x n matrices, which store only their nonzero
+    elements. The matrix functions below accept a SparseMatrix wherever they
+    accept a matrix, and take time proportional to the number of stored
+    elements where they can: sums and products of sparse matrices are
+    CSRMatrix instances, while sums and products involving a dense matrix are
+    dense.
+    """
+
+    def nnz(self):
+        """ Return the number of stored elements. """
+        return len(self.values)
+
+    def row(self, i):
+        """ Return row i as a (dense) list. """
+        return self.tocsr().row(i)
+
+    def tolist(self):
+        """ Return the elements as a (dense) list of lists. """
+        (m, n) = self.shape
+        mc = [[0] * n for i in range(m)]
+        for (i, j, x) in self.items():
+            mc[i][j] += x
+        return mc
+
+    def todict(self):
+        """ Return a dict mapping the (i, j) position of each nonzero
+        element to its value. """
+        d = {}
+        for (i, j, x) in self.items():
+            d[i, j] = d.get((i, j), 0) + x
+        return dict((ij, x) for (ij, x) in d.iteritems() if x != 0)
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __iter__(self):
+        csr = self.tocsr()
+        for i in range(self.shape[0]):
+            yield csr.row(i)
+
+    def __getitem__(self, index):
+        if isinstance(index, tuple):
+            return self.get(*index)
+        if index < 0:
+            index += self.shape[0]
+        return self.row(index)
+
+
+class CSRMatrix(SparseMatrix):
+    """
+    A sparse m x n matrix in compressed sparse row format: the column
+    indices and values of the stored elements of row i are
+    indices[indptr[i]:indptr[i + 1]] and values[indptr[i]:indptr[i + 1]],
+    with the column indices of each row in increasing order.
+
+    >>> a = CSRMatrix.from_dense([[1, 0, 0], [0, 0, 2]])
+    >>> a
+    CSRMatrix((2, 3), [0, 1, 2], [0, 2], [1, 2])
+    >>> a.tolist(), a[1, 2], a[1, 1], a.nnz()
+    ([[1, 0, 0], [0, 0, 2]], 2, 0, 2)
+    >>> a.transpose()
+    CSRMatrix((3, 2), [0, 1, 1, 2], [0, 1], [1, 2])
+    >>> CSRMatrix((2, 2), [0, 1], [0], [1])
+    Traceback (most recent call last):
+      ...
+    InvalidMatrixException: CSR matrix with 2 row(s) needs 3 row pointer(s), not 2.
+    >>> CSRMatrix((1, 3), [0, 2], [2, 0], [1, 2])
+    Traceback (most recent call last):
+      ...
+    InvalidMatrixException: Column indexes of row 0 must increase, not go from 2 to 0.
+    >>> CSRMatrix((3, 2), [0, 2, 1, 2], [0, 1], [1, 2])
+    Traceback (most recent call last):
+      ...
+    InvalidMatrixException: CSR row pointers must not decrease, but row 1 starts at 2 and ends at 1.
+    """
+
+    def __init__(self, shape, indptr, indices, values):
+        (m, n) = shape
+        if len(indptr) != m + 1:
+            raise InvalidMatrixException(
+                "CSR matrix with %d row(s) needs %d row pointer(s), not %d."
+                % (m, m + 1, len(indptr)))
+        if len(indices) != len(values) or indptr[m] != len(values):
+            raise InvalidMatrixException(
+                "CSR matrix has %d column index(es) and %d value(s), but "
+                "its row pointers end at %d."
+                % (len(indices), len(values), indptr[m]))
+        for j in indices:
+            if not 0 <= j < n:
+                raise InvalidMatrixException(
+                    "Column index %s is out of range for %d column(s)."
+                    % (j, n))
+        if indptr[0] != 0:
+            raise InvalidMatrixException(
+                "CSR row pointers must start at 0, not %s." % (indptr[0],))
+        for i in range(m):
+            (start, stop) = (indptr[i], indptr[i + 1])
+            if stop < start:
+                raise InvalidMatrixException(
+                    "CSR row pointers must not decrease, but row %d starts "
+                    "at %d and ends at %d." % (i, start, stop))
+            for k in range(start + 1, stop):
+                if indices[k] <= indices[k - 1]:
+                    raise InvalidMatrixException(
+                        "Column indexes of row %d must increase, not go "
+                        "from %d to %d." % (i, indices[k - 1], indices[k]))
+        self.shape = (m, n)
+        self.indptr = list(indptr)
+        self.indices = list(indices)
+        self.values = list(values)
+
+    @classmethod
+    def from_dense(cls, ma):
+        """ Create a CSR matrix from the nonzero elements of the given
+        (dense) matrix. """
+        ma = _as_lists(ma)
+        if not is_matrix(ma):
+            raise InvalidMatrixException("Arg is not a matrix: %s" % repr(ma))
+        (m, n) = matrix_dimensions(ma)
+        indptr, indices, values = [0], [], []
+        for row in ma:
+            for (j, x) in enumerate(row):
+                if x != 0:
+                    indices.append(j)
+                    values.append(x)
+            indptr.append(len(values))
+        return cls._from_lists((m, n), indptr, indices, values)
+
+    @classmethod
+    def _from_lists(cls, shape, indptr, indices, values):
+        """ Create a CSR matrix that takes ownership of the given lists,
+        without validating them. """
+        mc = cls.__new__(cls)
+        mc.shape = shape
+        mc.indptr = indptr
+        mc.indices = indices
+        mc.values = values
+        return mc
+
+    def row_items(self, i):
+        """ Return a list of the (j, value) pairs stored in row i. """
+        (a, b) = (self.indptr[i], self.indptr[i + 1])
+        return zip(self.indices[a:b], self.values[a:b])
+
+    def items(self):
+        """ Generate an (i, j, value) triple for each stored element, in
+        row-major order. """
+        indices, values = self.indices, self.values
+        for i in range(self.shape[0]):
+            for k in range(self.indptr[i], self.indptr[i + 1]):
+                yield (i, indices[k], values[k])
+
+    def get(self, i, j):
+        """ Return the (i, j) element. """
+        (a, b) = (self.indptr[i], self.indptr[i + 1])
+        k = bisect.bisect_left(self.indices, j, a, b)
+        return self.values[k] if k < b and self.indices[k] == j else 0
+
+    def row(self, i):
+        row = [0] * self.shape[1]
+        for (j, x) in self.row_items(i):
+            row[j] = x
+        return row
+
+    def tocsr(self):
+        """ Return this matrix in CSR format (i.e., itself). """
+        return self
+
+    def tocoo(self):
+        """ Return a copy of this matrix in COO format. """
+        rows = []
+        for i in range(self.shape[0]):
+            rows.extend([i] * (self.indptr[i + 1] - self.indptr[i]))
+        return COOMatrix._from_lists(self.shape, rows, self.indices[:],
+                                     self.values[:])
+
+    def transpose(self):
+        """ Return the transpose of this matrix in CSR format, in time
+        proportional to the number of stored elements plus the number of
+        columns. """
+        (m, n) = self.shape
+        indptr = [0] * (n + 1)
+        for j in self.indices:
+            indptr[j + 1] += 1
+        for j in range(n):
+            indptr[j + 1] += indptr[j]
+        nnz = len(self.values)
+        indices, values = [0] * nnz, [None] * nnz
+        nxt = indptr[:n]
+        for (i, j, x) in self.items():
+            k = nxt[j]
+            indices[k] = i
+            values[k] = x
+            nxt[j] = k + 1
+        return CSRMatrix._from_lists((n, m), indptr, indices, values)
+
+    def __repr__(self):
+        return "CSRMatrix(%r, %r, %r, %r)" % (self.shape, self.indptr,
+                                               self.indices, self.values)
+
+
+class COOMatrix(SparseMatrix):
+    """
+    A sparse m x n matrix in coordinate format: element k stored in the matrix
+    is at row rows[k] and column cols[k] and has value values[k]. Elements
+    may be stored in any order, and elements stored more than once at the
+    same position are added together.
+
+    >>> a = COOMatrix((2, 3), [1, 0, 1], [2, 0, 2], [1, 1, 1])
+    >>> a.tolist(), a[1, 2]
+    ([[1, 0, 0], [0, 0, 2]], 2)
+    >>> a.tocsr()
+    CSRMatrix((2, 3), [0, 1, 2], [0, 2], [1, 2])
+    >>> COOMatrix((2, 2), [0], [2], [1])
+    Traceback (most recent call last):
+      ...
+    InvalidMatrixException: Element at (0, 2) is out of range for a 2 x 2 matrix.
+    """
+
+    def __init__(self, shape, rows, cols, values):
+        (m, n) = shape
+        if not len(rows) == len(cols) == len(values):
+            raise InvalidMatrixException(
+                "COO matrix has %d row index(es), %d column index(es) and "
+                "%d value(s)." % (len(rows), len(cols), len(values)))
+        for (i, j) in zip(rows, cols):
+            if not (0 <= i < m and 0 <= j < n):
+                raise InvalidMatrixException(
+                    "Element at (%s, %s) is out of range for a %d x %d "
+                    "matrix." % (i, j, m, n))
+        self.shape = (m, n)
+        self.rows = list(rows)
+        self.cols = list(cols)
+        self.values = list(values)
+
+    @classmethod
+    def from_dense(cls, ma):
+        """ Create a COO matrix from the nonzero elements of the given
+        (dense) matrix. """
+        return CSRMatrix.from_dense(ma).tocoo()
+
+    @classmethod
+    def _from_lists(cls, shape, rows, cols, values):
+        """ Create a COO matrix that takes ownership of the given lists,
+        without validating them. """
+        mc = cls.__new__(cls)
+        mc.shape = shape
+        mc.rows = rows
+        mc.cols = cols
+        mc.values = values
+        return mc
+
+    def items(self):
+        """ Generate an (i, j, value) triple for each stored element, in
+        the order they are stored. """
+        return itertools.izip(self.rows, self.cols, self.values)
+
+    def get(self, i, j):
+        """ Return the (i, j) element, which takes time proportional to the
+        number of stored elements. """
+        return sum(x for (r, c, x) in self.items() if r == i and c == j)
+
+    def tocsr(self):
+        """ Return a copy of this matrix in CSR format, with the elements
+        stored at the same position added together, and zeros dropped. """
+        (m, n) = self.shape
+        by_row = [{} for i in range(m)]
+        for (i, j, x) in self.items():
+            row = by_row[i]
+            row[j] = row.get(j, 0) + x
+        indptr, indices, values = [0], [], []
+        for row in by_row:
+            for j in sorted(row):
+                if row[j] != 0:
+                    indices.append(j)
+                    values.append(row[j])
+            indptr.append(len(values))
+        return CSRMatrix._from_lists((m, n), indptr, indices, values)
+
+    def tocoo(self):
+        """ Return this matrix in COO format (i.e., itself). """
+        return self
+
+    def transpose(self):
+        """ Return the transpose of this matrix in COO format. """
+        (m, n) = self.shape
+        return COOMatrix._from_lists((n, m), self.cols[:], self.rows[:],
+                                     self.values[:])
+
+    def __repr__(self):
+        return "COOMatrix(%r, %r, %r, %r)" % (self.shape, self.rows,
+                                               self.cols, self.values)
+
+
+def _sparse_pairwise_op(ma, mb, func):
+    """
+    Helper function for matrix_pairwise_op when either operand is sparse,
+    which merges the rows of two sparse operands into a CSRMatrix, or else
+    gives a dense result.
+    """
+    if not (isinstance(ma, SparseMatrix) and isinstance(mb, SparseMatrix)):
+        mc = matrix_pairwise_op(_as_dense(ma), _as_dense(mb), func)
+        if isinstance(ma, Matrix) or isinstance(mb, Matrix):
+            return as_matrix(mc)
+        return mc
+    (ma, mb) = (ma.tocsr(), mb.tocsr())
+    (m, n) = ma.shape
+    indptr, indices, values = [0], [], []
+    for i in range(m):
+        row_a = dict(ma.row_items(i))
+        row_b = dict(mb.row_items(i))
+        for j in sorted(set(row_a) | set(row_b)):
+            x = func(row_a.get(j, 0), row_b.get(j, 0))
+            if x != 0:
+                indices.append(j)
+                values.append(x)
+        indptr.append(len(values))
+    return CSRMatrix._from_lists((m, n), indptr, indices, values)
+
+
+def _sparse_product(ma, mb):
+    """
+    Helper function for matrix_product when either operand is sparse. The
+    product of two sparse matrices is a CSRMatrix, accumulated one row at a
+    time, and otherwise the product is dense, but each stored element of the
+    sparse operand is still visited only once.
+    """
+    (m, n) = matrix_dimensions(ma)
+    (n, r) = matrix_dimensions(mb)
+    if isinstance(ma, SparseMatrix) and isinstance(mb, SparseMatrix):
+        (ma, mb) = (ma.tocsr(), mb.tocsr())
+        b_rows = [mb.row_items(k) for k in range(n)]
+        indptr, indices, values = [0], [], []
+        for i in range(m):
+            acc = {}
+            for (k, x) in ma.row_items(i):
+                for (j, y) in b_rows[k]:
+                    acc[j] = acc.get(j, 0) + x * y
+            for j in sorted(acc):
+                if acc[j] != 0:
+                    indices.append(j)
+                    values.append(acc[j])
+            indptr.append(len(values))
+        return CSRMatrix._from_lists((m, r), indptr, indices, values)
+    wrap = isinstance(ma, Matrix) or isinstance(mb, Matrix)
+    if isinstance(ma, SparseMatrix):
+        # Each row of the result is a combination of the rows of B.
+        ma = ma.tocsr()
+        mb = _as_lists(mb)
+        mc = []
+        for i in range(m):
+            out = [0] * r
+            for (k, x) in ma.row_items(i):
+                row = mb[k]
+                for j in range(r):
+                    out[j] += x * row[j]
+            mc.append(out)
+    else:
+        # Each element of A scales a row of B into a row of the result.
+        ma = _as_lists(ma)
+        b_rows = [mb.tocsr().row_items(k) for k in range(n)]
+        mc = []
+        for row in ma:
+            out = [0] * r
+            for (k, x) in enumerate(row):
+                if x != 0:
+                    for (j, y) in b_rows[k]:
+                        out[j] += x * y
+            mc.append(out)
+    return as_matrix(mc) if wrap else mc
+
+
+def _sparse_times(s, ma):
+    """ Helper function for matrix_times when the matrix is sparse. """
+    if isinstance(ma, COOMatrix):
+        return COOMatrix._from_lists(ma.shape, ma.rows[:], ma.cols[:],
+                                     [s * x for x in ma.values])
+    return CSRMatrix._from_lists(ma.shape, ma.indptr[:], ma.indices[:],
+                                 [s * x for x in ma.values])
+
+
+def _copy_matrix(ma):
+    """ Return a copy of the given matrix, of the same type. """
+    if isinstance(ma, Matrix):
+        return ma.copy()
+    if isinstance(ma, SparseMatrix):
+        return _sparse_times(1, ma)
+    return [list(row) for row in ma]
+
+
+def _as_dense(ma):
+    """ Return the given matrix as a list of lists if it is sparse. """
+    return ma.tolist() if isinstance(ma, SparseMatrix) else ma
+
+
+class LazyMatrix(object):
+    """
+    A matrix expression recorded, rather than calculated, by matrix_plus,
+    matrix_minus, matrix_times, matrix_negative, matrix_transpose and
+    matrix_product when any of their operands is a LazyMatrix, which is
+    created by calling lazy() on a matrix. The expression is calculated
+    when evaluate() is called, or when the LazyMatrix is used as a matrix by
+    any other function, and the result is then kept. Given out=, those
+    functions calculate their lazy operands and write the result into out
+    rather than recording anything.
+
+    When the expression is calculated, sums, differences, scalar multiples
+    and transposes of matrices are combined into a single pass over the
+    elements, pairs of transposes cancel out, and chains of products are
+    multiplied in the order that needs the fewest scalar multiplications.
+
+    >>> a = lazy([[1, 2], [3, 4]])
+    >>> c = matrix_plus(matrix_times(2, a), matrix_transpose(a))
+    >>> c
+    lazy(matrix_plus(matrix_times(2, <2 x 2>), matrix_transpose(<2 x 2>)))
+    >>> c.evaluate()
+    [[3, 7], [8, 12]]
+    >>> matrix_transpose(matrix_transpose(a)).evaluate()
+    [[1, 2], [3, 4]]
+    >>> matrix_product(matrix_product(a, [[1], [0]]), [[1, 1, 1]]).evaluate()
+    [[1, 1, 1], [3, 3, 3]]
+    >>> mb = [[1, 2], [3, 4]]
+    >>> matrix_transpose(matrix_transpose(lazy(mb))).evaluate() is mb
+    False
+    >>> mc = [[0, 0], [0, 0]]
+    >>> matrix_plus(a, [[1, 1], [1, 1]], out=mc) is mc, mc
+    (True, [[2, 3], [4, 5]])
+    """
+
+    __slots__ = ('op', 'args', 'shape', 'value')
+
+    def __init__(self, op, args, shape):
+        self.op = op
+        self.args = args
+        self.shape = shape
+        self.value = None
+
+    def evaluate(self):
+        """ Calculate the matrix that this expression represents. """
+        if self.value is None:
+            self.value = _evaluate(self)
+        return self.value
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __iter__(self):
+        return iter(self.evaluate())
+
+    def __getitem__(self, index):
+        return self.evaluate()[index]
+
+    def __repr__(self):
+        return "lazy(%s)" % _describe(self)
+
+
+def lazy(ma):
+    """
+    Wrap the given matrix in a LazyMatrix, so that the matrix functions
+    that take it as an operand record what they would do instead of
+    doing it.
+
+    >>> lazy([[1, 2, 3]])
+    lazy(<1 x 3>)
+    """
+    if isinstance(ma, LazyMatrix):
+        return ma
+    if not is_matrix(ma):
+        raise InvalidMatrixException("Arg is not a matrix: %s" % repr(ma))
+    return LazyMatrix('matrix', (ma,), matrix_dimensions(ma))
+
+
+def evaluate(ma):
+    """
+    Return the matrix represented by the given LazyMatrix, or the given
+    matrix itself if it is not lazy.
+
+    >>> evaluate(matrix_negative(lazy([[1, -2]])))
+    [[-1, 2]]
+    >>> evaluate([[1]])
+    [[1]]
+    """
+    return ma.evaluate() if isinstance(ma, LazyMatrix) else ma
+
+
+def _is_lazy(*operands):
+    """ Determine whether any of the operands is a LazyMatrix. """
+    for x in operands:
+        if isinstance(x, LazyMatrix):
+            return True
+    return False
+
+
+def _record(op, args, shape):
+    """ Create the LazyMatrix for applying the named matrix function to the
+    given args, wrapping any matrix args that are not lazy. """
+    args = tuple(lazy(x) if is_matrix(x) else x for x in args)
+    return LazyMatrix(op, args, shape)
+
+
+def _describe(node):
+    """ Describe the expression rooted at the given node. """
+    if node.op == 'matrix':
+        return "<%d x %d>" % node.shape
+    args = [_describe(x) if isinstance(x, LazyMatrix) else repr(x)
+            for x in node.args]
+    return "%s(%s)" % (node.op, ", ".join(args))
+
+
+# The matrix functions whose results are linear combinations of (possibly
+# transposed) operands, which can be calculated together in one pass.
+_LINEAR_OPS = ('matrix_plus', 'matrix_minus', 'matrix_times',
+               'matrix_negative', 'matrix_transpose')
+
+
+def _evaluate(node):
+    """ Calculate the value of the given LazyMatrix. """
+    if node.value is not None:
+        return node.value
+    if node.op == 'matrix':
+        return node.args[0]
+    if node.op == 'matrix_product':
+        factors = []
+        _product_factors(node, factors)
+        return _chain_product([_evaluate(x) for x in factors])
+    terms = []
+    _linear_terms(node, 1, False, terms)
+    if len(terms) == 1 and terms[0][0] == 1:
+        # Nothing to calculate but a transpose (or not even that).
+        (c, x, transposed) = terms[0]
+        value = _evaluate(x)
+        if transposed:
+            return matrix_transpose.unchecked(value)
+        # The value may be an operand's matrix, which the result mustn't
+        # share.
+        return _copy_matrix(value)
+    return _linear_combination(
+        [(c, _evaluate(x), transposed) for (c, x, transposed) in terms],
+        node.shape)
+
+
+def _linear_terms(node, c, transposed, terms):
+    """ Append to terms a (coefficient, node, transposed) triple for each
+    operand whose sum, with those coefficients and transposes, is the value
+    of the given node, multiplied by c and transposed if transposed is
+    true. """
+    op = node.op
+    if node.value is not None or op not in _LINEAR_OPS:
+        terms.append((c, node, transposed))
+    elif op == 'matrix_plus':
+        _linear_terms(node.args[0], c, transposed, terms)
+        _linear_terms(node.args[1], c, transposed, terms)
+    elif op == 'matrix_minus':
+        _linear_terms(node.args[0], c, transposed, terms)
+        _linear_terms(node.args[1], -c, transposed, terms)
+    elif op == 'matrix_times':
+        _linear_terms(node.args[1], c * node.args[0], transposed, terms)
+    elif op == 'matrix_negative':
+        _linear_terms(node.args[0], -c, transposed, terms)
+    else:
+        _linear_terms(node.args[0], c, not transposed, terms)
+
+
+def _linear_combination(terms, shape):
+    """ Calculate the m x n matrix that is the sum of the (coefficient,
+    matrix, transposed) terms, in a single pass over their elements. """
+    (m, n) = shape
+    wrap = False
+    coefs, sources = [], []
+    for (c, x, transposed) in terms:
+        wrap = wrap or isinstance(x, Matrix)
+        x = _as_lists(_as_dense(x))
+        coefs.append(c)
+        sources.append((x, transposed))
+    mc = []
+    for i in range(m):
+        rows = [[row[i] for row in x] if transposed else x[i]
+                for (x, transposed) in sources]
+        if len(rows) == 2:
+            (c1, c2) = coefs
+            mc.append([c1 * a + c2 * b for (a, b) in zip(*rows)])
+        else:
+            mc.append([sum(c * a for (c, a) in zip(coefs, elems))
+                       for elems in zip(*rows)])
+    return as_matrix(mc) if wrap else mc
+
+
+def _product_factors(node, factors):
+    """ Append to factors the operands of the chain of products rooted at
+    the given node, in order. """
+    if node.op == 'matrix_product' and node.value is None:
+        _product_factors(node.args[0], factors)
+        _product_factors(node.args[1], factors)
+    else:
+        factors.append(node)
+
+
+def _chain_product(mats):
+    """ Multiply the chain of matrices, in the order that takes the fewest
+    scalar multiplications. """
+    k = len(mats)
+    dims = [matrix_dimensions.unchecked(x)[0] for x in mats]
+    dims.append(matrix_dimensions.unchecked(mats[-1])[1])
+    # cost[i][j] is the least cost of multiplying mats[i] to mats[j], and
+    # split[i][j] is where to divide them to achieve it.
+    cost = [[0] * k for i in range(k)]
+    split = [[0] * k for i in range(k)]
+    for length in range(1, k):
+        for i in range(k - length):
+            j = i + length
+            cost[i][j] = None
+            for s in range(i, j):
+                c = (cost[i][s] + cost[s + 1][j] +
+                     dims[i] * dims[s + 1] * dims[j + 1])
+                if cost[i][j] is None or c < cost[i][j]:
+                    cost[i][j] = c
+                    split[i][j] = s
+
+    def multiply(i, j):
+        if i == j:
+            return mats[i]
+        s = split[i][j]
+        return matrix_product.unchecked(multiply(i, s), multiply(s + 1, j))
+    return multiply(0, k - 1)
+
+
+# NumPy is used, when it is installed, to do the work of matrix_product,
+# matrix_transpose, matrix_plus, matrix_minus, vector_product and vector_norm.
+# Operands are converted to ndarrays on the way into these functions, and
+# the results are converted back to lists (or to a Matrix, if any operand
+# was a Matrix) on the way out. Setting backend to 'python' (or calling
+# set_backend('python')) uses the pure-Python implementations instead, and
+# 'numpy' requires NumPy; 'auto' uses NumPy if it could be imported.
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+backend = 'auto'
+
+_BACKENDS = ('auto', 'numpy', 'python')
+
+
+def set_backend(name):
+    """ Choose the implementation to be used by the functions that have
+    a NumPy implementation: 'numpy', 'python' or 'auto'.
+
+    >>> set_backend('fortran')
+    Traceback (most recent call last):
+      ...
+    LAValueError: Backend should be one of ('auto', 'numpy', 'python'), not: 'fortran'
+    """
+    global backend
+    if name not in _BACKENDS:
+        raise LAValueError("Backend should be one of %s, not: %s"
+                           % (_BACKENDS, repr(name)))
+    if name == 'numpy' and numpy is None:
+        raise LAValueError("The numpy backend requires NumPy to be installed")
+    backend = name
+
+
+def _use_numpy(*operands):
+    """ Return the given (matrix or vector) operands as ndarrays if they
+    should be handed to NumPy, or else None. They never are if any is
+    empty, since NumPy has no way of distinguishing a 1 x 0 matrix from a
+    0 x 0 one, nor if any is a list that isn't all floats (or complex
+    numbers), since NumPy would make ints into fixed-size integers that
+    silently overflow. Finding that out takes converting the lists, so the
+    arrays are returned for the caller to use rather than converting the
+    operands again.
+
+    >>> matrix_product([[2**40]], [[2**40]])
+    [[1208925819614629174706176L]]
+    >>> vector_product([2**62, 2**62], [2, 2])
+    18446744073709551616L
+    """
+    if numpy is None or backend == 'python' or exact:
+        return None
+    for x in operands:
+        if isinstance(x, SparseMatrix):
+            return None
+        elif isinstance(x, Matrix):
+            if 0 in x.shape:
+                return None
+        elif not x or (is_vector_type(x[0]) and not x[0]):
+            return None
+    arrays = tuple(_to_ndarray(x) for x in operands)
+    if any(a.dtype.kind not in 'fc' for a in arrays):
+        return None
+    return arrays
+
+
+def _to_ndarray(x):
+    """ Convert the matrix or vector to an ndarray, without copying the
+    storage of a Matrix. """
+    if isinstance(x, Matrix):
+        data = x.flat()
+        if isinstance(data, MappedArray):
+            return numpy.frombuffer(data.mmap, dtype=_FILE_DTYPE,
+                                    count=len(data),
+                                    offset=data.start).reshape(x.shape)
+        return numpy.frombuffer(data, dtype=float).reshape(x.shape)
+    return numpy.asarray(x)
+
+
+def _from_ndarray(a, *operands):
+    """ Convert the ndarray result of an operation on the given operands
+    to a Matrix if any operand was a Matrix, or else to a list (of lists),
+    or to a scalar. """
+    if a.ndim == 0:
+        return a.item()
+    for x in operands:
+        if isinstance(x, Matrix):
+            data = array('d', a.astype(float).tobytes())
+            return Matrix.from_array(data, a.shape[0], a.shape[1])
+    return a.tolist()
+
+
+# In exact mode, matrix functions that divide (matrix_lu, matrix_solve,
+# matrix_inverse, vector_project and the like) do so with fractions.Fraction
+# rather than floats, so that operations on ints and Fractions give exact
+# results, scalar_equal (and so vector_equal and matrix_equal) compares
+# exactly rather than to within epsilon, and matrix_det and matrix_rank
+# use fraction-free elimination. The NumPy backend is not used, and Matrix
+# instances, which store floats, give no benefit.
+exact = False
+
+
+@contextlib.contextmanager
+def exact_mode():
+    """ Context manager in which the matrix functions use exact arithmetic.
+
+    >>> with exact_mode():
+    ...     matrix_inverse([[1, 2], [3, 4]])
+    [[Fraction(-2, 1), Fraction(1, 1)], [Fraction(3, 2), Fraction(-1, 2)]]
+    >>> exact
+    False
+    """
+    global exact
+    previous = exact
+    exact = True
+    try:
+        yield
+    finally:
+        exact = previous
+
+
+def _division():
+    """ Return the function that divides scalars in the current mode. """
+    return _exact_divide if exact else operator.truediv
+
+
+def _exact_divide(x, y):
+    return Fraction(x) / Fraction(y)
+
+
 # Some simple decorators for verifying arguments to functions below,
 # in order to provide friendlier error messages.
+#
+# Validating a list-of-lists matrix means scanning every element, which can
+# cost more than the operation itself. Setting trusted to True (or using the
+# trusted_mode context manager) makes every decorator below pass its args
+# straight through to the decorated function, and each decorated function
+# also has an 'unchecked' attribute that is the undecorated function, for
+# skipping validation on a single call. Setting cache_validation to True
+# instead remembers, by object identity, which args have already been found
+# to be valid, which is safe only if they are not modified in place between
+# calls.
+trusted = False
+cache_validation = False
+
+# The maximum number of entries kept in the validation cache before it is
+# cleared.
+validation_cache_size = 1024
+
+_validation_cache = {}
+
+
+@contextlib.contextmanager
+def trusted_mode():
+    """ Context manager in which the check_* decorators don't validate the
+    args of the functions they decorate.
+
+    >>> with trusted_mode():
+    ...     matrix_plus([[1]], [[1, 2]])
+    [[2]]
+    >>> trusted
+    False
+    """
+    global trusted
+    previous = trusted
+    trusted = True
+    try:
+        yield
+    finally:
+        trusted = previous
+
+
+def clear_validation_cache():
+    """ Forget all args that have been remembered as valid. """
+    _validation_cache.clear()
+
+
+def _is_valid(x, test):
+    """ Helper for the decorators below that applies the given test to x,
+    consulting and updating the validation cache if it is enabled. """
+    if not cache_validation:
+        return test(x)
+    key = (id(x), test)
+    hit = _validation_cache.get(key)
+    # Holding a reference to x in the entry ensures the id can't be reused.
+    if hit is not None and hit is x:
+        return True
+    if not test(x):
+        return False
+    if len(_validation_cache) >= validation_cache_size:
+        _validation_cache.clear()
+    _validation_cache[key] = x
+    return True
+
+
+def _unchecked(func):
+    """ Return the undecorated function underlying func. """
+    return getattr(func, 'unchecked', func)
 
 
 def check_vector_same_size(index1, index2):
@@ -84,18 +1211,48 @@ def check_vector_same_size(index1, index2):
     the same size, and otherwise executes the function as usual. """
     def decorator(func):
         @functools.wraps(func)
-        def _decorator(*args):
-            if not is_vector(args[index1]):
+        def _decorator(*args, **kwargs):
+            if trusted:
+                return func(*args, **kwargs)
+            if not _is_valid(args[index1], is_vector):
                 msg = "1st arg to check_vector_same_size is not a vector"
                 raise InvalidVectorException(msg)
-            elif not is_vector(args[index2]):
+            elif not _is_valid(args[index2], is_vector):
                 msg = "2nd arg to check_vector_same_size is not a vector"
                 raise InvalidVectorException(msg)
             if len(args[index1]) != len(args[index2]):
                 raise IncompatibleVectorException(
                     "Vectors must be of equal size, not %d and %d."
                     % (len(args[index1]), len(args[index2])))
-            return func(*args)
+            return func(*args, **kwargs)
+        _decorator.unchecked = _unchecked(func)
+        return _decorator
+    return decorator
+
+
+# Check that one arg is a vector and another is a sequence of vectors of the
+# same size.
+def check_vector_batch(index1, index2):
+    """ Decorates a function such that an exception is raised if the
+    arg at index1 is not a vector, or the arg at index2 is not a matrix
+    (i.e., a sequence of vectors) whose rows have the same size as it,
+    and otherwise executes the function as usual. """
+    def decorator(func):
+        @functools.wraps(func)
+        def _decorator(*args, **kwargs):
+            if trusted:
+                return func(*args, **kwargs)
+            u = args[index1]
+            if not _is_valid(u, is_vector):
+                raise InvalidVectorException("Arg should be a vector: %s"
+                                             % repr(u))
+            (m, n) = matrix_dimensions(args[index2])
+            if m > 0 and n != len(u):
+                raise IncompatibleVectorException(
+                    "Vectors must be of equal size, not %d and %d."
+                    % (len(u), n))
+            return func(*args, **kwargs)
+        _decorator.unchecked = _unchecked(func)
         return _decorator
     return decorator
 
@@ -107,14 +1264,17 @@ def check_matrix_same_size(index1, index2):
     the same dimensions, and otherwise executes the function as usual. """
     def decorator(func):
         @functools.wraps(func)
-        def _decorator(*args):
+        def _decorator(*args, **kwargs):
+            if trusted:
+                return func(*args, **kwargs)
             (m1, n1) = matrix_dimensions(args[index1])
             (m2, n2) = matrix_dimensions(args[index2])
             if m1 != m2 or n1 != n2:
                 msg = ("Matrices must have same dimensions. Matrix 1 is "
                        "%d x %d, but matrix 2 is %d x %d.")
                 raise IncompatibleMatrixException(msg % (m1, n1, m2, n2))
-            return func(*args)
+            return func(*args, **kwargs)
+        _decorator.unchecked = _unchecked(func)
         return _decorator
     return decorator
 
@@ -126,13 +1286,16 @@ def check_scalar(*arg_indices):
     the function as usual."""
     def decorator(func):
         @functools.wraps(func)
-        def _decorator(*args):
+        def _decorator(*args, **kwargs):
+            if trusted:
+                return func(*args, **kwargs)
             for arg_index in arg_indices:
                 arg = args[arg_index]
                 if not is_scalar(arg):
                     msg = "Arg at index %s is not a scalar: %s"
                     raise LAValueError(msg % (arg_index, arg))
-            return func(*args)
+            return func(*args, **kwargs)
+        _decorator.unchecked = _unchecked(func)
         return _decorator
     return decorator
 
@@ -144,13 +1307,16 @@ def check_vector(*arg_indices):
     executes the function as usual. """
     def decorator(func):
         @functools.wraps(func)
-        def _decorator(*args):
+        def _decorator(*args, **kwargs):
+            if trusted:
+                return func(*args, **kwargs)
             for arg_index in arg_indices:
                 u = args[arg_index]
-                if not is_vector(u):
+                if not _is_valid(u, is_vector):
                     msg = "Arg should be a vector: %s" % repr(u)
                     raise InvalidVectorException(msg)
-            return func(*args)
+            return func(*args, **kwargs)
+        _decorator.unchecked = _unchecked(func)
         return _decorator
     return decorator
 
@@ -162,13 +1328,16 @@ def check_matrix(*arg_indices):
     the function as usual. """
     def decorator(func):
         @functools.wraps(func)
-        def _decorator(*args):
+        def _decorator(*args, **kwargs):
+            if trusted:
+                return func(*args, **kwargs)
             for arg_index in arg_indices:
                 a = args[arg_index]
-                if not is_matrix(a):
+                if not _is_valid(a, is_matrix):
                     raise InvalidMatrixException("Arg is not a matrix: %s"
                                                  % repr(a))
-            return func(*args)
+            return func(*args, **kwargs)
+        _decorator.unchecked = _unchecked(func)
         return _decorator
     return decorator
 
@@ -182,14 +1351,17 @@ def check_matrix_multipliable(index1, index2):
     in the first matrix is not equal to the number of rows in the second. """
     def decorator(func):
         @functools.wraps(func)
-        def _decorator(*args):
+        def _decorator(*args, **kwargs):
+            if trusted:
+                return func(*args, **kwargs)
             (m1, n1) = matrix_dimensions(args[index1])
             (m2, n2) = matrix_dimensions(args[index2])
             if n1 != m2:
                 msg = ("Matrices are not size-compatible. Matrix 1 has %s "
                        "column(s), but matrix 2 has %s row(s) instead of %s")
                 raise IncompatibleMatrixException(msg % (n1, m2, n1))
-            return func(*args)
+            return func(*args, **kwargs)
+        _decorator.unchecked = _unchecked(func)
         return _decorator
     return decorator
 
@@ -216,7 +1388,11 @@ def is_matrix(ma):
     False
     >>> is_matrix([[.5, -1, 9], [4, 3, 19], [3, 6, 8], [0, 0, 1]])
     True
+    >>> is_matrix(Matrix([[1, 2]])), is_matrix(CSRMatrix.from_dense([[1]]))
+    (True, True)
     """
+    if isinstance(ma, (Matrix, SparseMatrix, LazyMatrix)):
+        return True
     if not is_vector_type(ma) or not all_true(ma, is_vector_type):
         return False
     if len(ma) == 0:
@@ -242,7 +1418,11 @@ def matrix_dimensions(ma):
     Traceback (most recent call last):
       ...
     InvalidMatrixException: Arg is not a matrix: [[1, 2], [1, 2, 3]]
+    >>> matrix_dimensions(Matrix([[1, 2, 3], [4, 5, 6]]))
+    (2, 3)
     """
+    if isinstance(ma, (Matrix, SparseMatrix, LazyMatrix)):
+        return ma.shape
     m = len(ma)
     if m == 0:
         return (0, 0)
@@ -295,7 +1475,14 @@ def matrix_is_diagonal(ma):
     True
     >>> matrix_is_diagonal([[1, 0], [1, 0]])
     False
+    >>> matrix_is_diagonal(COOMatrix((3, 3), [0, 2], [0, 2], [5, 6]))
+    True
     """
+    if _has_structure(ma, 'diagonal'):
+        return True
+    if isinstance(ma, SparseMatrix):
+        (m, n) = ma.shape
+        return m == n and all_true(ma.todict(), lambda (i, j): i == j)
     if not matrix_is_square(ma):
         return False
     for (i, row) in enumerate(ma):
@@ -319,7 +1506,16 @@ def matrix_is_scalar(ma):
     True
     >>> matrix_is_scalar([[3, 0], [1, 3]])
     False
+    >>> matrix_is_scalar(CSRMatrix.from_dense([[3, 0], [0, 3]]))
+    True
     """
+    if _has_structure(ma, 'scalar'):
+        return True
+    if isinstance(ma, SparseMatrix):
+        d = ma.todict()
+        return (matrix_is_diagonal(ma) and
+                (not d or (len(d) == ma.shape[0] and
+                           len(set(d.itervalues())) == 1)))
     if not matrix_is_square(ma):
         return False
     elif len(ma) == 0:
@@ -352,7 +1548,16 @@ def matrix_is_identity(ma):
     False
     >>> matrix_is_identity([[2, 0], [0, 2]])
     False
+    >>> matrix_is_identity(CSRMatrix.from_dense([[1, 0], [0, 1]]))
+    True
     """
+    if _has_structure(ma, 'identity'):
+        return True
+    if isinstance(ma, SparseMatrix):
+        d = ma.todict()
+        return (ma.shape[0] > 0 and matrix_is_diagonal(ma) and
+                len(d) == ma.shape[0] and all_true(d.values(),
+                                                   lambda x: x == 1))
     if not matrix_is_square(ma):
         return False
     elif len(ma) == 0:
@@ -380,14 +1585,290 @@ def matrix_is_symmetric(ma):
     False
     >>> matrix_is_symmetric([[1, 3, 2], [3, 5, 0], [2, 0, 4]])
     True
+    >>> matrix_is_symmetric(CSRMatrix.from_dense([[1, 3, 2], [3, 5, 0], [2, 0, 4]]))
+    True
+    >>> matrix_is_symmetric(CSRMatrix.from_dense([[1, 2], [1, 2]]))
+    False
     """
+    if _has_structure(ma, 'symmetric'):
+        return True
+    if isinstance(ma, SparseMatrix):
+        (m, n) = ma.shape
+        d = ma.todict()
+        return m == n and all_true(
+            d.iteritems(),
+            lambda ((i, j), x): scalar_equal(x, d.get((j, i), 0)))
     return matrix_equal(ma, matrix_transpose(ma))
 
 
-def matrix_pairwise_op(ma, mb, func):
+@check_matrix(0)
+def matrix_is_upper_triangular(ma):
+    """
+    Determine whether the given matrix is upper triangular -- i.e., a square
+    matrix with all entries below the diagonal equal to 0.
+
+    >>> matrix_is_upper_triangular([[1, 2], [0, 3]])
+    True
+    >>> matrix_is_upper_triangular([[1, 0], [2, 3]])
+    False
+    >>> matrix_is_upper_triangular(CSRMatrix.from_dense([[1, 2], [0, 3]]))
+    True
+    """
+    if _has_structure(ma, 'upper'):
+        return True
+    if isinstance(ma, SparseMatrix):
+        (m, n) = ma.shape
+        return m == n and all_true(ma.todict(), lambda (i, j): i <= j)
+    if not matrix_is_square(ma):
+        return False
+    for (i, row) in enumerate(ma):
+        for j in range(i):
+            if row[j] != 0:
+                return False
+    return True
+
+
+@check_matrix(0)
+def matrix_is_lower_triangular(ma):
+    """
+    Determine whether the given matrix is lower triangular -- i.e., a square
+    matrix with all entries above the diagonal equal to 0.
+
+    >>> matrix_is_lower_triangular([[1, 0], [2, 3]])
+    True
+    >>> matrix_is_lower_triangular([[1, 2], [0, 3]])
+    False
+    """
+    if _has_structure(ma, 'lower'):
+        return True
+    if isinstance(ma, SparseMatrix):
+        (m, n) = ma.shape
+        return m == n and all_true(ma.todict(), lambda (i, j): i >= j)
+    if not matrix_is_square(ma):
+        return False
+    for (i, row) in enumerate(ma):
+        for j in range(i + 1, len(row)):
+            if row[j] != 0:
+                return False
+    return True
+
+
+# The structures that a Matrix can record, most specific first, each with
+# the structures that it implies, and the function that tests for it.
+_STRUCTURES = [
+    ('identity', ('identity', 'scalar', 'diagonal', 'upper', 'lower',
+                  'symmetric'), matrix_is_identity),
+    ('scalar', ('scalar', 'diagonal', 'upper', 'lower', 'symmetric'),
+     matrix_is_scalar),
+    ('diagonal', ('diagonal', 'upper', 'lower', 'symmetric'),
+     matrix_is_diagonal),
+    ('upper', ('upper',), matrix_is_upper_triangular),
+    ('lower', ('lower',), matrix_is_lower_triangular),
+    ('symmetric', ('symmetric',), matrix_is_symmetric),
+]
+_IMPLIED = dict((name, implied) for (name, implied, test) in _STRUCTURES)
+_TRANSPOSED = {'upper': 'lower', 'lower': 'upper'}
+
+
+@check_matrix(0)
+def matrix_structure(ma):
+    """
+    Return the most specific structure of the matrix -- 'identity',
+    'scalar', 'diagonal', 'upper' (triangular), 'lower' (triangular) or
+    'symmetric' -- or None if it has none of them. For a Matrix that has
+    recorded its structure, that structure is returned without looking at
+    the elements. Recording the structure, with Matrix(a, structure), makes
+    matrix_product and matrix_plus use row and column scaling for diagonal
+    matrices, and work on only the nonzero halves of triangular ones, and
+    makes matrix_solve and matrix_det use substitution and the product of
+    the diagonal for triangular matrices.
+
+    >>> matrix_structure([[2, 0], [0, 2]])
+    'scalar'
+    >>> matrix_structure([[1, 2], [0, 3]])
+    'upper'
+    >>> matrix_structure([[1, 2], [3, 4]]) is None
+    True
+    >>> matrix_structure(Matrix([[2, 0], [0, 2]], structure='diagonal'))
+    'diagonal'
+    """
+    if isinstance(ma, Matrix) and ma.structure is not None:
+        return ma.structure
+    for (name, implied, test) in _STRUCTURES:
+        if test(ma):
+            return name
+    return None
+
+
+def _check_structure(ma, structure):
+    """ Raise an exception unless the matrix has the given structure. """
+    if structure not in _IMPLIED:
+        raise LAValueError("Unknown matrix structure: %r" % structure)
+    test = dict((name, t) for (name, implied, t) in _STRUCTURES)[structure]
+    if not test(ma):
+        raise InvalidMatrixException("Matrix is not %s: %s"
+                                     % (structure, repr(ma)))
+
+
+def _has_structure(ma, structure):
+    """ Determine whether the matrix is a Matrix that has recorded a
+    structure that implies the given one. """
+    return (isinstance(ma, Matrix) and ma.structure is not None and
+            structure in _IMPLIED[ma.structure])
+
+
+def _product_structure(ma, mb):
+    """ Return the structure of the product of the two matrices that
+    follows from their recorded structures, if any. """
+    sa = ma.structure if isinstance(ma, Matrix) else None
+    sb = mb.structure if isinstance(mb, Matrix) else None
+    (ia, ib) = (_IMPLIED.get(sa, ()), _IMPLIED.get(sb, ()))
+    if 'identity' in ia:
+        return sb
+    if 'identity' in ib:
+        return sa
+    if 'scalar' in ia:
+        return 'scalar' if 'scalar' in ib else sb
+    if 'scalar' in ib:
+        return sa
+    for structure in ('diagonal', 'upper', 'lower'):
+        if structure in ia and structure in ib:
+            return structure
+    return None
+
+
+def _sum_structure(ma, mb):
+    """ Return the structure of the sum (or difference) of the two
+    matrices that follows from their recorded structures, if any. """
+    (ia, ib) = (_IMPLIED.get(getattr(ma, 'structure', None), ()),
+                _IMPLIED.get(getattr(mb, 'structure', None), ()))
+    for structure in ('scalar', 'diagonal', 'upper', 'lower', 'symmetric'):
+        if structure in ia and structure in ib:
+            return structure
+    return None
+
+
+def _structured_pairwise_op(ma, mb, func):
+    """
+    Helper function for matrix_pairwise_op that adds or subtracts Matrix
+    operands with a common structure, which is recorded on the result, by
+    working on just the diagonal of diagonal matrices, or the nonzero half
+    of triangular ones, or one half of symmetric ones, returning None if
+    the operands have no common structure.
+    """
+    structure = _sum_structure(ma, mb)
+    if structure is None:
+        return None
+    (n, n) = ma.shape
+    arrays = (structure not in ('scalar', 'diagonal') and
+              _use_numpy(ma, mb))
+    if arrays:
+        ufunc = getattr(numpy, _NUMPY_UFUNCS[func])
+        mc = _from_ndarray(ufunc(*arrays), ma, mb)
+        mc.structure = structure
+        return mc
+    (fa, fb) = (ma.flat(), mb.flat())
+    data = array('d', [0.0]) * (n * n)
+    for i in range(n):
+        if structure in ('scalar', 'diagonal'):
+            k = i * (n + 1)
+            data[k] = func(fa[k], fb[k])
+            continue
+        if structure == 'lower':
+            (start, stop) = (i * n, i * n + i + 1)
+        else:
+            (start, stop) = (i * n + i, (i + 1) * n)
+        data[start:stop] = array('d', map(func, fa[start:stop],
+                                          fb[start:stop]))
+    if structure == 'symmetric':
+        # Copy the upper half into the lower, one column at a time.
+        for i in range(1, n):
+            data[i * n:i * n + i] = data[i:i * n:n]
+    return Matrix.from_array(data, n, n, structure=structure)
+
+
+def _structured_product(ma, mb):
+    """
+    Helper function for matrix_product that multiplies by a Matrix with a
+    recorded diagonal structure by scaling the rows (or columns) of the
+    other matrix, or multiplies two triangular matrices of the same kind
+    using only their nonzero halves, returning None if neither applies.
+    """
+    structure = _product_structure(ma, mb)
+    if _has_structure(ma, 'diagonal') or _has_structure(mb, 'diagonal'):
+        left = _has_structure(ma, 'diagonal')
+        (d, mc) = (_diagonal(ma), mb) if left else (_diagonal(mb), ma)
+        (m, n) = matrix_dimensions.unchecked(mc)
+        arrays = _use_numpy(mc)
+        if arrays:
+            (a,) = arrays
+            d = numpy.asarray(d, dtype=float)
+            result = a * d[:, None] if left else a * d
+            data = array('d', result.tobytes())
+        else:
+            mc = as_matrix(mc)
+            data = array('d')
+            mul = operator.mul
+            for i in range(m):
+                row = mc._row_slice(i)
+                if left:
+                    x = d[i]
+                    data.extend([x * y for y in row])
+                else:
+                    data.extend(map(mul, row, d))
+        return Matrix.from_array(data, m, n, structure=structure)
+    if structure not in ('upper', 'lower'):
+        return None
+    arrays = _use_numpy(ma, mb)
+    if arrays:
+        mc = _from_ndarray(numpy.dot(*arrays), ma, mb)
+        mc.structure = structure
+        return mc
+    n = ma.shape[0]
+    rows = ma.tolist()
+    cols = mb.transpose().tolist()
+    mul = operator.mul
+    data = array('d', [0.0]) * (n * n)
+    for i in range(n):
+        row = rows[i]
+        for j in (range(i, n) if structure == 'upper' else range(i + 1)):
+            # Only the elements k of row i of A and column j of B with
+            # i <= k <= j (or j <= k <= i) can be nonzero.
+            (lo, hi) = (i, j + 1) if structure == 'upper' else (j, i + 1)
+            data[i * n + j] = sum(map(mul, row[lo:hi], cols[j][lo:hi]))
+    return Matrix.from_array(data, n, n, structure=structure)
+
+
+# The NumPy equivalents of the functions given to matrix_pairwise_op.
+_NUMPY_UFUNCS = {operator.add: 'add', operator.sub: 'subtract'}
+
+
+def matrix_pairwise_op(ma, mb, func, out=None):
     """
     Helper function for matrix_plus and matrix_minus.
     """
+    if out is not None:
+        return _matrix_pairwise_op_out(ma, mb, func, out)
+    if isinstance(ma, SparseMatrix) or isinstance(mb, SparseMatrix):
+        return _sparse_pairwise_op(ma, mb, func)
+    if func in _NUMPY_UFUNCS:
+        mc = _structured_pairwise_op(ma, mb, func)
+        if mc is not None:
+            return mc
+    arrays = func in _NUMPY_UFUNCS and _use_numpy(ma, mb)
+    if arrays:
+        (a, b) = arrays
+        # Operands of different shapes, which can only get here unchecked,
+        # get the same result as without NumPy rather than broadcasting:
+        # the elements of B outside the dimensions of A are ignored.
+        if a.shape == b.shape:
+            ufunc = getattr(numpy, _NUMPY_UFUNCS[func])
+            return _from_ndarray(ufunc(a, b), ma, mb)
+    if isinstance(ma, Matrix) or isinstance(mb, Matrix):
+        (m, n) = matrix_dimensions(ma)
+        data = array('d', map(func, as_matrix(ma).flat(),
+                              as_matrix(mb).flat()))
+        return Matrix.from_array(data, m, n)
     (m, n) = matrix_dimensions(ma)
     mc = [None] * m
     for i in range(m):
@@ -398,11 +1879,88 @@ def matrix_pairwise_op(ma, mb, func):
     return mc
 
 
+def _matrix_pairwise_op_out(ma, mb, func, out):
+    """
+    Helper function for matrix_pairwise_op that writes the result into the
+    given dense matrix instead of creating a new one.
+    """
+    (m, n) = matrix_dimensions.unchecked(ma)
+    _check_out(out, m, n, ma if out is ma else mb)
+    (ma, mb) = (_as_dense(ma), _as_dense(mb))
+    if isinstance(out, Matrix):
+        arrays = (func in _NUMPY_UFUNCS and _owns(out) and
+                  _use_numpy(ma, mb, out))
+        if arrays:
+            ufunc = getattr(numpy, _NUMPY_UFUNCS[func])
+            ufunc(arrays[0], arrays[1], out=arrays[2])
+        else:
+            _store_flat(out, itertools.imap(func, _flat(ma), _flat(mb)))
+        return out
+    for (row_a, row_b, row_out) in zip(ma, mb, out):
+        row_out[:] = map(func, row_a, row_b)
+    return out
+
+
+def _check_out(out, m, n, operand=None):
+    """ Raise an exception unless out is a dense m x n matrix that a result
+    can be written into, which needs no checking if it is the given operand
+    of the same size, which has already been checked. Once it has passed
+    the checks, the structure of a Matrix out is forgotten, since it is
+    about to be overwritten.
+
+    >>> out = Matrix([[1, 0], [0, 1]], structure='identity')
+    >>> matrix_plus([[1]], [[1]], out=out)
+    Traceback (most recent call last):
+      ...
+    IncompatibleMatrixException: Output matrix must be 1 x 1, not 2 x 2.
+    >>> out.structure
+    'identity'
+    """
+    if not (trusted or
+            (out is operand and not isinstance(out, SparseMatrix))):
+        if isinstance(out, SparseMatrix) or not _is_valid(out, is_matrix):
+            raise InvalidMatrixException(
+                "Output arg is not a dense matrix: %s" % repr(out))
+        (m2, n2) = matrix_dimensions.unchecked(out)
+        if (m2, n2) != (m, n):
+            raise IncompatibleMatrixException(
+                "Output matrix must be %d x %d, not %d x %d."
+                % (m, n, m2, n2))
+    if isinstance(out, Matrix):
+        out.structure = None
+
+
+def _owns(ma):
+    """ Determine whether the Matrix is the sole, contiguous view of all of
+    its storage, so that the storage can be written to as a whole. """
+    return ma.flat() is ma.data
+
+
+def _flat(ma):
+    """ Return the elements of the (dense) matrix in row-major order. """
+    if isinstance(ma, Matrix):
+        return ma.flat()
+    return itertools.chain.from_iterable(ma)
+
+
+def _store_flat(out, values):
+    """ Write the given values, in row-major order, into the Matrix. """
+    out.structure = None
+    if _owns(out):
+        out.data[:] = array('d', values)
+        return
+    n = out.shape[1]
+    for (k, x) in enumerate(values):
+        out[k // n, k % n] = x
+
+
 @check_matrix_same_size(0, 1)
-def matrix_plus(ma, mb):
+def matrix_plus(ma, mb, out=None):
     """
     Add the given matrices, which must have the same number of rows and
-    columns.
+    columns. If given, the result is written into the matrix out, which
+    must have the same dimensions and may be either of the matrices being
+    added, instead of into a new matrix.
 
     >>> matrix_plus([[1, 2], [3, 4]], [[4, 3], [2, 1]])
     [[5, 5], [5, 5]]
@@ -412,15 +1970,29 @@ def matrix_plus(ma, mb):
     Traceback (most recent call last):
       ...
     IncompatibleMatrixException: Matrices must have same dimensions. Matrix 1 is 1 x 1, but matrix 2 is 1 x 2.
+    >>> matrix_plus(Matrix([[1, 2], [3, 4]]), [[4, 3], [2, 1]])
+    Matrix([[5.0, 5.0], [5.0, 5.0]])
+    >>> mc = [[0, 0], [0, 0]]
+    >>> matrix_plus([[1, 2], [3, 4]], [[4, 3], [2, 1]], out=mc) is mc, mc
+    (True, [[5, 5], [5, 5]])
+    >>> matrix_plus([[1, 2]], [[3, 4]], out=[[0]])
+    Traceback (most recent call last):
+      ...
+    IncompatibleMatrixException: Output matrix must be 1 x 2, not 1 x 1.
     """
-    return matrix_pairwise_op(ma, mb, operator.add)
+    if _is_lazy(ma, mb):
+        if out is None:
+            return _record('matrix_plus', (ma, mb), matrix_dimensions(ma))
+        (ma, mb) = (evaluate(ma), evaluate(mb))
+    return matrix_pairwise_op(ma, mb, operator.add, out)
 
 
 @check_matrix_same_size(0, 1)
-def matrix_minus(ma, mb):
+def matrix_minus(ma, mb, out=None):
     """
     Subtract the second matrix from the first, both of which must have the
-    same number of rows and columns.
+    same number of rows and columns. If given, the result is written into
+    the matrix out, as for matrix_plus.
 
     >>> matrix_minus([[3, 4], [1, 2]], [[1, 1], [1, 1]])
     [[2, 3], [0, 1]]
@@ -430,15 +2002,24 @@ def matrix_minus(ma, mb):
     Traceback (most recent call last):
       ...
     IncompatibleMatrixException: Matrices must have same dimensions. Matrix 1 is 1 x 1, but matrix 2 is 1 x 2.
+    >>> mc = Matrix([[0, 0]])
+    >>> matrix_minus([[1, 2]], [[3, 4]], out=mc) is mc, mc
+    (True, Matrix([[-2.0, -2.0]]))
     """
-    return matrix_pairwise_op(ma, mb, operator.sub)
+    if _is_lazy(ma, mb):
+        if out is None:
+            return _record('matrix_minus', (ma, mb), matrix_dimensions(ma))
+        (ma, mb) = (evaluate(ma), evaluate(mb))
+    return matrix_pairwise_op(ma, mb, operator.sub, out)
 
 
 @check_scalar(0)
 @check_matrix(1)
-def matrix_times(s, ma):
+def matrix_times(s, ma, out=None):
     """
-    Multiply the matrix A by the scalar s.
+    Multiply the matrix A by the scalar s. If given, the result is written
+    into the matrix out, which must have the same dimensions as A and may
+    be A itself, instead of into a new matrix.
 
     >>> matrix_times(2, [[0,1], [1, 0]])
     [[0, 2], [2, 0]]
@@ -450,15 +2031,44 @@ def matrix_times(s, ma):
     []
     >>> matrix_times(3, [[1,2,3], [4,5,6], [7,8,9], [10, 11, 12]])
     [[3, 6, 9], [12, 15, 18], [21, 24, 27], [30, 33, 36]]
+    >>> matrix_times(2, Matrix([[1, 2], [3, 4]]))
+    Matrix([[2.0, 4.0], [6.0, 8.0]])
+    >>> matrix_times(2, CSRMatrix.from_dense([[0, 1], [0, 0]]))
+    CSRMatrix((2, 2), [0, 1, 1], [1], [2])
+    >>> mc = [[1, 2], [3, 4]]
+    >>> matrix_times(3, mc, out=mc) is mc, mc
+    (True, [[3, 6], [9, 12]])
     """
+    if _is_lazy(ma):
+        if out is None:
+            return _record('matrix_times', (s, ma), matrix_dimensions(ma))
+        ma = evaluate(ma)
+    if out is not None:
+        (m, n) = matrix_dimensions.unchecked(ma)
+        _check_out(out, m, n, ma)
+        ma = _as_dense(ma)
+        if isinstance(out, Matrix):
+            _store_flat(out, [s * elem for elem in _flat(ma)])
+        else:
+            for (row, row_out) in zip(ma, out):
+                row_out[:] = [s * elem for elem in row]
+        return out
+    if isinstance(ma, SparseMatrix):
+        return _sparse_times(s, ma)
+    if isinstance(ma, Matrix):
+        (m, n) = ma.shape
+        data = array('d', [s * elem for elem in ma.flat()])
+        structure = 'scalar' if ma.structure == 'identity' else ma.structure
+        return Matrix.from_array(data, m, n, structure=structure)
     return [[s * elem for elem in row] for row in ma]
 
 
 @check_matrix(0)
-def matrix_negative(ma):
+def matrix_negative(ma, out=None):
     """
     Return the negative of the given matrix, or the matrix multiplied
-    by scalar -1.
+    by scalar -1. If given, the result is written into the matrix out,
+    as for matrix_times.
 
     >>> matrix_negative([])
     []
@@ -467,15 +2077,21 @@ def matrix_negative(ma):
     >>> matrix_negative(((-1, 2), (2, -3)))
     [[1, -2], [-2, 3]]
     """
-    return matrix_times(-1, ma)
+    if _is_lazy(ma):
+        if out is None:
+            return _record('matrix_negative', (ma,), matrix_dimensions(ma))
+        ma = evaluate(ma)
+    return matrix_times(-1, ma, out)
 
 
 @check_matrix(0)
-def matrix_transpose(ma):
+def matrix_transpose(ma, out=None):
     """
     Generate the transpose of the given m x n matrix, which is the n x m
     matrix with where each (i,j) element of the original matrix is the (j,i)
-    element of the new matrix.
+    element of the new matrix. If given, the result is written into the
+    n x m matrix out, which must not be A itself (see matrix_itranspose),
+    instead of into a new matrix.
 
     >>> matrix_transpose([[1, 2], [3, 4], [5, 6]])
     [[1, 3, 5], [2, 4, 6]]
@@ -489,7 +2105,39 @@ def matrix_transpose(ma):
     [[1, 2, 3], [4, 5, 6], [7, 8, 9]]
     >>> matrix_transpose([[1,2,3]])
     [[1], [2], [3]]
+    >>> matrix_transpose(Matrix([[1, 2], [3, 4], [5, 6]]))
+    Matrix([[1.0, 3.0, 5.0], [2.0, 4.0, 6.0]])
+    >>> mc = [[0, 0, 0], [0, 0, 0]]
+    >>> matrix_transpose([[1, 2], [3, 4], [5, 6]], out=mc) is mc, mc
+    (True, [[1, 3, 5], [2, 4, 6]])
+    >>> matrix_transpose([[1, 2], [3, 4]], out=Matrix.zeros(2, 2))
+    Matrix([[1.0, 3.0], [2.0, 4.0]])
     """
+    if _is_lazy(ma):
+        if out is None:
+            return _record('matrix_transpose', (ma,),
+                           matrix_dimensions(ma)[::-1])
+        ma = evaluate(ma)
+    if out is not None:
+        return _matrix_transpose_out(ma, out)
+    if isinstance(ma, SparseMatrix):
+        return ma.transpose()
+    if _has_structure(ma, 'symmetric'):
+        return ma.copy()
+    arrays = _use_numpy(ma)
+    if arrays:
+        mc = _from_ndarray(arrays[0].T, ma)
+        if isinstance(ma, Matrix):
+            mc.structure = _TRANSPOSED.get(ma.structure, ma.structure)
+        return mc
+    if isinstance(ma, Matrix):
+        (m, n) = ma.shape
+        flat = ma.flat()
+        data = array('d')
+        for j in range(n):
+            data.extend(flat[j::n])
+        return Matrix.from_array(data, n, m, structure=_TRANSPOSED.get(
+            ma.structure, ma.structure))
     (m, n) = matrix_dimensions(ma)
     c = [[None] * m for i in range(n)]
     for i in range(m):
@@ -498,6 +2146,108 @@ def matrix_transpose(ma):
     return c
 
 
+def _matrix_transpose_out(ma, out):
+    """
+    Helper function for matrix_transpose that writes the transpose into the
+    given dense matrix instead of creating a new one. A Matrix out is
+    written element by element, since indexing it by row gives a copy.
+
+    >>> out = Matrix.zeros(3, 2)
+    >>> _matrix_transpose_out(Matrix([[1, 2, 3], [4, 5, 6]]), out) is out, out
+    (True, Matrix([[1.0, 4.0], [2.0, 5.0], [3.0, 6.0]]))
+    """
+    if out is ma:
+        raise LAValueError("Use matrix_itranspose to transpose a matrix "
+                           "in place.")
+    (m, n) = matrix_dimensions.unchecked(ma)
+    _check_out(out, n, m)
+    ma = _as_dense(ma)
+    if isinstance(out, Matrix):
+        for (i, row) in enumerate(ma):
+            for (j, elem) in enumerate(row):
+                out[j, i] = elem
+        return out
+    for (i, row) in enumerate(ma):
+        for (j, elem) in enumerate(row):
+            out[j][i] = elem
+    return out
+
+
+@check_matrix_same_size(0, 1)
+def matrix_iadd(ma, mb):
+    """
+    Add B to A in place, returning A.
+
+    >>> ma = [[1, 2], [3, 4]]
+    >>> matrix_iadd(ma, [[1, 1], [1, 1]]) is ma, ma
+    (True, [[2, 3], [4, 5]])
+    """
+    return matrix_pairwise_op(ma, mb, operator.add, ma)
+
+
+@check_matrix_same_size(0, 1)
+def matrix_isub(ma, mb):
+    """
+    Subtract B from A in place, returning A.
+
+    >>> ma = Matrix([[1, 2], [3, 4]])
+    >>> matrix_isub(ma, [[1, 1], [1, 1]]) is ma, ma
+    (True, Matrix([[0.0, 1.0], [2.0, 3.0]]))
+    """
+    return matrix_pairwise_op(ma, mb, operator.sub, ma)
+
+
+@check_scalar(0)
+@check_matrix(1)
+def matrix_iscale(s, ma):
+    """
+    Multiply A by the scalar s in place, returning A, which may be any
+    matrix, including a sparse one.
+
+    >>> ma = [[1, 2], [3, 4]]
+    >>> matrix_iscale(-2, ma) is ma, ma
+    (True, [[-2, -4], [-6, -8]])
+    """
+    if isinstance(ma, SparseMatrix):
+        ma.values[:] = [s * x for x in ma.values]
+        return ma
+    return matrix_times.unchecked(s, ma, ma)
+
+
+@check_matrix(0)
+def matrix_itranspose(ma):
+    """
+    Transpose A in place, returning A. A list-of-lists matrix must be
+    square, since its elements are swapped across the diagonal, but any
+    Matrix or sparse matrix can be transposed in place, since only the way
+    it is stored changes.
+
+    >>> ma = [[1, 2], [3, 4]]
+    >>> matrix_itranspose(ma) is ma, ma
+    (True, [[1, 3], [2, 4]])
+    >>> matrix_itranspose(Matrix([[1, 2, 3]]))
+    Matrix([[1.0], [2.0], [3.0]])
+    >>> matrix_itranspose([[1, 2, 3]])
+    Traceback (most recent call last):
+      ...
+    InvalidMatrixException: Matrix must be square, not 1 x 3.
+    """
+    if isinstance(ma, Matrix):
+        ma.shape = ma.shape[::-1]
+        ma.strides = ma.strides[::-1]
+        ma.structure = _TRANSPOSED.get(ma.structure, ma.structure)
+        return ma
+    if isinstance(ma, SparseMatrix):
+        ma.__dict__.update(ma.transpose().__dict__)
+        return ma
+    n = _check_square(ma)
+    for i in range(n):
+        row = ma[i]
+        for j in range(i + 1, n):
+            row[j], ma[j][i] = ma[j][i], row[j]
+    return ma
+
+
 @check_matrix_multipliable(0, 1)
 @check_matrix(0, 1)
 def matrix_product(ma, mb):
@@ -512,19 +2262,315 @@ def matrix_product(ma, mb):
     []
     >>> matrix_product([[1, 3, -1], [-2, -1, 1]], [[-4, 0, 3, -1], [5, -2, -1, 1], [-1, 2, 0, 6]])
     [[12, -8, 0, -4], [2, 4, -5, 7]]
+    >>> matrix_product(Matrix([[1, 3, -1], [-2, -1, 1]]), [[-4, 0, 3, -1], [5, -2, -1, 1], [-1, 2, 0, 6]])
+    Matrix([[12.0, -8.0, 0.0, -4.0], [2.0, 4.0, -5.0, 7.0]])
     """
-    (m, n) = matrix_dimensions(ma)
-    (n, r) = matrix_dimensions(mb)
-    mc = [[None] * r for i in range(m)]
+    if _is_lazy(ma, mb):
+        return _record('matrix_product', (ma, mb),
+                       (matrix_dimensions(ma)[0], matrix_dimensions(mb)[1]))
+    if isinstance(ma, SparseMatrix) or isinstance(mb, SparseMatrix):
+        return _sparse_product(ma, mb)
+    if isinstance(ma, Matrix) or isinstance(mb, Matrix):
+        mc = _structured_product(ma, mb)
+        if mc is not None:
+            return mc
+    arrays = _use_numpy(ma, mb)
+    if arrays:
+        return _from_ndarray(numpy.dot(*arrays), ma, mb)
+    if isinstance(ma, Matrix) or isinstance(mb, Matrix):
+        return _matrix_product_flat(as_matrix(ma), as_matrix(mb))
+    # Transposing B once, up front, means each column is built only once
+    # rather than once for every row of A.
+    mul = operator.mul
+    cols = zip(*mb)
+    return [[sum(map(mul, row, col)) for col in cols] for row in ma]
+
+
+def _matrix_product_flat(ma, mb):
+    """
+    Helper function for matrix_product when operating on Matrix instances,
+    which slices each column of B out of its storage once, up front.
+    """
+    (m, n) = ma.shape
+    (n, r) = mb.shape
+    fa = ma.flat()
+    fb = mb.flat()
+    cols = [fb[j::r] for j in range(r)]
+    mul = operator.mul
+    data = array('d', [0.0]) * (m * r)
+    k = 0
     for i in range(m):
-        for j in range(r):
-            mc[i][j] = vector_product(ma[i], [row[j] for row in mb])
+        row = fa[i * n:(i + 1) * n]
+        for col in cols:
+            data[k] = sum(map(mul, row, col))
+            k += 1
+    return Matrix.from_array(data, m, r)
+
+
+# The size of the square tiles that matrix_product_blocked works on.
+product_block_size = 64
+
+# The size at or below which matrix_product_strassen stops dividing its
+# operands and multiplies them with matrix_product instead.
+strassen_leaf_size = 64
+
+
+@check_matrix_multipliable(0, 1)
+@check_matrix(0, 1)
+def matrix_product_blocked(ma, mb, block_size=None):
+    """
+    Calculate the product of matrices A and B, as matrix_product does, but
+    working on one pair of block_size x block_size tiles of A and the
+    transpose of B at a time, which keeps the working set small for large
+    matrices. The block size defaults to product_block_size.
+
+    >>> matrix_product_blocked([[1, 3, -1], [-2, -1, 1]], [[-4, 0, 3, -1], [5, -2, -1, 1], [-1, 2, 0, 6]], 2)
+    [[12, -8, 0, -4], [2, 4, -5, 7]]
+    >>> matrix_product_blocked([], [])
+    []
+    """
+    if isinstance(ma, Matrix) or isinstance(mb, Matrix):
+        return as_matrix(matrix_product_blocked(_as_lists(ma), _as_lists(mb),
+                                                block_size))
+    bs = block_size or product_block_size
+    (m, n) = matrix_dimensions(ma)
+    cols = zip(*mb)
+    r = len(cols)
+    mul = operator.mul
+    mc = [[0] * r for i in range(m)]
+    for k0 in range(0, n, bs):
+        k1 = k0 + bs
+        col_tiles = [col[k0:k1] for col in cols]
+        for i0 in range(0, m, bs):
+            row_tiles = [row[k0:k1] for row in ma[i0:i0 + bs]]
+            for j0 in range(0, r, bs):
+                tile = col_tiles[j0:j0 + bs]
+                for (i, row) in enumerate(row_tiles, i0):
+                    out = mc[i]
+                    j = j0
+                    for col in tile:
+                        out[j] += sum(map(mul, row, col))
+                        j += 1
     return mc
 
 
+@check_matrix_multipliable(0, 1)
+@check_matrix(0, 1)
+def matrix_product_strassen(ma, mb, leaf_size=None):
+    """
+    Calculate the product of square matrices A and B using Strassen's
+    algorithm, which takes 7 rather than 8 products of half-size matrices
+    at each step, until the matrices are no larger than leaf_size (which
+    defaults to strassen_leaf_size). Matrices that are not both square are
+    multiplied with matrix_product instead.
+
+    >>> matrix_product_strassen([[1, 2, 0], [0, 1, 3], [4, 0, 1]], [[2, 0, 1], [1, 1, 0], [0, 3, 1]], 1)
+    [[4, 2, 1], [1, 10, 3], [8, 3, 5]]
+    >>> matrix_product_strassen([[1, 3, -1], [-2, -1, 1]], [[-4, 0, 3, -1], [5, -2, -1, 1], [-1, 2, 0, 6]])
+    [[12, -8, 0, -4], [2, 4, -5, 7]]
+    """
+    if isinstance(ma, Matrix) or isinstance(mb, Matrix):
+        return as_matrix(matrix_product_strassen(_as_lists(ma), _as_lists(mb),
+                                                 leaf_size))
+    (m, n) = matrix_dimensions(ma)
+    (n, r) = matrix_dimensions(mb)
+    if m != n or n != r:
+        return matrix_product.unchecked(ma, mb)
+    return _strassen([list(row) for row in ma], [list(row) for row in mb],
+                     leaf_size or strassen_leaf_size)
+
+
+def _strassen(ma, mb, leaf_size):
+    """
+    Helper function for matrix_product_strassen, which multiplies the n x n
+    matrices (lists of lists), padding them with a row and column of zeros
+    when n is odd.
+    """
+    n = len(ma)
+    if n <= leaf_size:
+        return matrix_product.unchecked(ma, mb)
+    if n % 2:
+        ma = [row + [0] for row in ma] + [[0] * (n + 1)]
+        mb = [row + [0] for row in mb] + [[0] * (n + 1)]
+        return [row[:n] for row in _strassen(ma, mb, leaf_size)[:n]]
+    h = n // 2
+    (a11, a12, a21, a22) = _quadrants(ma, h)
+    (b11, b12, b21, b22) = _quadrants(mb, h)
+    add = _matrix_add_lists
+    sub = _matrix_sub_lists
+    p1 = _strassen(add(a11, a22), add(b11, b22), leaf_size)
+    p2 = _strassen(add(a21, a22), b11, leaf_size)
+    p3 = _strassen(a11, sub(b12, b22), leaf_size)
+    p4 = _strassen(a22, sub(b21, b11), leaf_size)
+    p5 = _strassen(add(a11, a12), b22, leaf_size)
+    p6 = _strassen(sub(a21, a11), add(b11, b12), leaf_size)
+    p7 = _strassen(sub(a12, a22), add(b21, b22), leaf_size)
+    c11 = add(sub(add(p1, p4), p5), p7)
+    c12 = add(p3, p5)
+    c21 = add(p2, p4)
+    c22 = add(add(sub(p1, p2), p3), p6)
+    return ([r1 + r2 for (r1, r2) in zip(c11, c12)] +
+            [r1 + r2 for (r1, r2) in zip(c21, c22)])
+
+
+def _quadrants(ma, h):
+    """ Split the 2h x 2h matrix into its four h x h quadrants. """
+    top, bottom = ma[:h], ma[h:]
+    return ([row[:h] for row in top], [row[h:] for row in top],
+            [row[:h] for row in bottom], [row[h:] for row in bottom])
+
+
+def _matrix_add_lists(ma, mb):
+    """ Add two list-of-lists matrices of the same size, unchecked. """
+    add = operator.add
+    return [map(add, ra, rb) for (ra, rb) in zip(ma, mb)]
+
+
+def _matrix_sub_lists(ma, mb):
+    """ Subtract two list-of-lists matrices of the same size, unchecked. """
+    sub = operator.sub
+    return [map(sub, ra, rb) for (ra, rb) in zip(ma, mb)]
+
+
+def _as_lists(ma):
+    """ Return the given matrix as a list of lists if it is a Matrix. """
+    return ma.tolist() if isinstance(ma, Matrix) else ma
+
+
+# The number of worker processes that matrix_product_parallel uses by
+# default, or None for one per CPU.
+parallel_workers = None
+
+# The number of scalar multiplications (m x n x r for an m x n matrix times
+# an n x r one) below which matrix_product_parallel multiplies serially,
+# since starting the worker processes costs more than they save.
+parallel_threshold = 1000000
+
+# The shared arrays for the operands and result of matrix_product_parallel,
+# which the processes of its pool inherit when they are forked, and the
+# pool, its number of processes and the arrays, which are kept between
+# calls and replaced only when a product needs more processes or larger
+# arrays.
+_parallel_operands = None
+_parallel_pool = None
+_parallel_lock = threading.RLock()
+
+
+@check_matrix_multipliable(0, 1)
+@check_matrix(0, 1)
+def matrix_product_parallel(ma, mb, workers=None):
+    """
+    Calculate the product of matrices A and B, as matrix_product does, but
+    dividing the rows of A among worker processes (parallel_workers of
+    them by default), which read A and B from, and write the result to,
+    shared memory, rather than having them pickled. The processes are kept
+    for later calls, until close_parallel_pool is called. Products of
+    fewer than parallel_threshold multiplications, products in exact mode
+    or of matrices with elements that aren't all floats (which the shared
+    memory would round to floats), and all products where processes can't
+    be forked, are calculated by matrix_product instead.
+
+    >>> matrix_product_parallel([[1, 3, -1], [-2, -1, 1]], [[-4, 0, 3, -1], [5, -2, -1, 1], [-1, 2, 0, 6]])
+    [[12, -8, 0, -4], [2, 4, -5, 7]]
+    >>> a = [[float(i * j % 7) for j in range(100)] for i in range(100)]
+    >>> matrix_equal(matrix_product_parallel(a, a, 2), matrix_product(a, a))
+    True
+    >>> matrix_product_parallel([[2**60] * 100] * 100, [[1] * 100] * 100, 2)[0][0]
+    115292150460684697600L
+    >>> close_parallel_pool()
+    """
+    (m, n) = matrix_dimensions(ma)
+    r = matrix_dimensions(mb)[1] if m else 0
+    workers = min(workers or parallel_workers or multiprocessing.cpu_count(),
+                  m)
+    if (m * n * r < parallel_threshold or workers < 2 or exact or
+            not hasattr(os, 'fork') or _is_lazy(ma, mb) or
+            isinstance(ma, SparseMatrix) or isinstance(mb, SparseMatrix) or
+            _use_numpy(ma, mb) or
+            not (_all_floats(ma) and _all_floats(mb))):
+        return matrix_product.unchecked(ma, mb)
+    with _parallel_lock:
+        (pool, a, bt, mc) = _parallel_arrays(workers, m * n, n * r, m * r)
+        if isinstance(ma, Matrix):
+            a[:m * n] = ma.flat()
+        else:
+            a[:m * n] = list(itertools.chain.from_iterable(ma))
+        if isinstance(mb, Matrix):
+            bt[:n * r] = mb.transpose().flat()
+        else:
+            bt[:n * r] = list(itertools.chain.from_iterable(zip(*mb)))
+        step = -(-m // workers)
+        try:
+            pool.map(_product_rows, [(i, min(i + step, m), n, r)
+                                     for i in range(0, m, step)])
+        except BaseException:
+            close_parallel_pool()
+            raise
+        result = Matrix.from_array(array('d', mc[:m * r]), m, r)
+    if isinstance(ma, Matrix) or isinstance(mb, Matrix):
+        return result
+    return result.tolist()
+
+
+def _all_floats(ma):
+    """ Determine whether every element of the matrix is a float, as those
+    of a Matrix always are. """
+    if isinstance(ma, Matrix):
+        return True
+    return all(isinstance(x, float) for row in ma for x in row)
+
+
+def _parallel_arrays(workers, *sizes):
+    """ Return the pool of matrix_product_parallel and the shared arrays
+    its processes inherited, which hold at least the given numbers of
+    floats, first replacing the pool if it doesn't have the given number
+    of processes or its arrays are too small. """
+    global _parallel_operands, _parallel_pool
+    if _parallel_pool is not None:
+        (pool, count, arrays) = _parallel_pool
+        if count == workers and all(len(x) >= size
+                                    for (x, size) in zip(arrays, sizes)):
+            return (pool,) + arrays
+        sizes = [max(size, len(x)) for (x, size) in zip(arrays, sizes)]
+        close_parallel_pool()
+    _parallel_operands = tuple(sharedctypes.RawArray('d', size)
+                               for size in sizes)
+    # The pool must be created after _parallel_operands is set, so that its
+    # processes inherit the shared arrays.
+    pool = multiprocessing.Pool(workers)
+    _parallel_pool = (pool, workers, _parallel_operands)
+    return (pool,) + _parallel_operands
+
+
+def close_parallel_pool():
+    """ Stop the worker processes that matrix_product_parallel keeps
+    between calls, and free their shared memory. They are started again
+    by the next product calculated in parallel. """
+    global _parallel_operands, _parallel_pool
+    with _parallel_lock:
+        if _parallel_pool is not None:
+            pool = _parallel_pool[0]
+            (_parallel_operands, _parallel_pool) = (None, None)
+            pool.terminate()
+            pool.join()
+
+
+def _product_rows(task):
+    """ Calculate rows start to stop (exclusive) of the n x r product for
+    matrix_product_parallel, in a worker process. """
+    (a, bt, mc) = _parallel_operands
+    (start, stop, n, r) = task
+    mul = operator.mul
+    cols = [bt[j * n:(j + 1) * n] for j in range(r)]
+    for i in range(start, stop):
+        row = a[i * n:(i + 1) * n]
+        mc[i * r:(i + 1) * r] = [sum(map(mul, row, col)) for col in cols]
+
+
 def scalar_equal(s1, s2, eps=epsilon):
     """
-    Determine whether the two scalars are equal to accuracy of epsilon.
+    Determine whether the two scalars are equal to accuracy of epsilon, or
+    exactly equal in exact mode.
 
     >>> scalar_equal(0.9000000000000002, 0.9000000000000001)
     True
@@ -534,7 +2580,12 @@ def scalar_equal(s1, s2, eps=epsilon):
     True
     >>> scalar_equal(1.0, 1.00000001)
     False
+    >>> with exact_mode():
+    ...     scalar_equal(Fraction(1, 3), 1 / 3.0)
+    False
     """
+    if exact:
+        return s1 == s2
     return abs(s1 - s2) < eps
 
 
@@ -562,11 +2613,25 @@ def matrix_equal(ma, mb):
     True
     >>> matrix_equal([[1, 2, 3], [3.9000000000000001, 2, 1]], [[1, 2, 3], [3.9, 2, 1]])
     True
+    >>> matrix_equal(Matrix([[1, 2], [3, 4]]), [[1, 2], [3, 4]])
+    True
     """
     (m1, n1) = matrix_dimensions(ma)
     (m2, n2) = matrix_dimensions(mb)
     if m1 != m2 or n1 != n2:
         return False
+    if isinstance(ma, SparseMatrix) and isinstance(mb, SparseMatrix):
+        (da, db) = (ma.todict(), mb.todict())
+        for ij in set(da) | set(db):
+            if not scalar_equal(da.get(ij, 0), db.get(ij, 0)):
+                return False
+        return True
+    (ma, mb) = (_as_dense(ma), _as_dense(mb))
+    if isinstance(ma, Matrix) or isinstance(mb, Matrix):
+        for (x, y) in zip(as_matrix(ma).flat(), as_matrix(mb).flat()):
+            if not scalar_equal(x, y):
+                return False
+        return True
     for i in range(m1):
         for j in range(n1):
             if not scalar_equal(ma[i][j], mb[i][j]):
@@ -665,6 +2730,9 @@ def vector_product(u, v):
     >>> vector_product([1,2,-3], [-3,5,2])
     1
     """
+    arrays = _use_numpy(u, v)
+    if arrays:
+        return numpy.dot(*arrays).item()
     return sum(vector_pairwise_op(u, v, operator.mul))
 
 
@@ -684,6 +2752,9 @@ def vector_norm(v):
     >>> vector_norm([sqrt(2), -1, 1])
     2.0
     """
+    arrays = _use_numpy(v)
+    if arrays:
+        return math.sqrt(numpy.dot(arrays[0], arrays[0]))
     return math.sqrt(sum(map(lambda x: x * x, v)))
 
 
@@ -742,7 +2813,1087 @@ def vector_project(u, v):
     >>> vector_project([0,0,1], [1,2,3]), vector_equal(vector_project( [0,0,1], [1,2,3]), [0,0,3])
     ([0.0, 0.0, 3.0], True)
     """
-    return vector_times(float(vector_product(u, v)) / vector_product(u, u), u)
+    div = _division()
+    return vector_times(div(vector_product(u, v), vector_product(u, u)), u)
+
+
+# Batched versions of the vector functions above, which validate a whole
+# sequence of vectors (i.e., the rows of a matrix) once and then work through
+# it in a single loop, rather than paying for validation on every pair.
+
+
+@check_vector_batch(0, 1)
+def vector_sums(u, vs):
+    """
+    Calculate the sum of the vector u and each of the vectors vs, which
+    may be given as a list of vectors or as any matrix, each row of which is
+    one of the vectors.
+
+    >>> vector_sums([1, 2], [[3, 4], [5, 6]])
+    [[4, 6], [6, 8]]
+    >>> vector_sums([1, 2], [])
+    []
+    """
+    arrays = _use_numpy(u, vs)
+    if arrays:
+        return (arrays[1] + arrays[0]).tolist()
+    add = operator.add
+    return [map(add, u, v) for v in vs]
+
+
+@check_matrix(0)
+def vector_norms(vs):
+    """
+    Calculate the norm of each of the vectors vs.
+
+    >>> vector_norms([[3, 4], [0, 1], [0, 0]])
+    [5.0, 1.0, 0.0]
+    """
+    arrays = _use_numpy(vs)
+    if arrays:
+        (a,) = arrays
+        return numpy.sqrt(numpy.einsum('ij,ij->i', a, a)).tolist()
+    mul = operator.mul
+    root = math.sqrt
+    return [root(sum(map(mul, v, v))) for v in vs]
+
+
+@check_vector_batch(0, 1)
+def vector_distances(u, vs):
+    """
+    Calculate the distance between the vector u and each of the vectors vs.
+
+    >>> vector_distances([0, 0], [[3, 4], [1, 0], [0, 0]])
+    [5.0, 1.0, 0.0]
+    """
+    arrays = _use_numpy(u, vs)
+    if arrays:
+        d = arrays[1] - arrays[0]
+        return numpy.sqrt(numpy.einsum('ij,ij->i', d, d)).tolist()
+    (sub, mul) = (operator.sub, operator.mul)
+    root = math.sqrt
+    distances = []
+    for v in vs:
+        d = map(sub, u, v)
+        distances.append(root(sum(map(mul, d, d))))
+    return distances
+
+
+# The most differences that vector_distance_matrix holds at once with NumPy.
+distance_block_size = 1000000
+
+
+@check_matrix(0)
+def vector_distance_matrix(vs):
+    """
+    Calculate the distance between every pair of the vectors vs, returning
+    the symmetric matrix with the distance between vs[i] and vs[j] as its
+    (i, j) element.
+
+    >>> vector_distance_matrix([[0, 0], [3, 4], [3, 0]])
+    [[0.0, 5.0, 3.0], [5.0, 0.0, 4.0], [3.0, 4.0, 0.0]]
+    >>> vector_distance_matrix([[1e8, 0.0], [1e8 + 1, 0.0], [1e8, 3.0]])
+    [[0.0, 1.0, 3.0], [1.0, 0.0, 3.1622776601683795], [3.0, 3.1622776601683795, 0.0]]
+    """
+    arrays = _use_numpy(vs)
+    if arrays:
+        (a,) = arrays
+        (m, n) = a.shape
+        d = numpy.empty((m, m))
+        # Take the differences directly, rather than expanding |u - v|^2,
+        # which cancels badly for vectors far from the origin, a block of
+        # rows at a time to bound the memory the differences take.
+        block = max(1, distance_block_size // max(1, m * n))
+        for i in range(0, m, block):
+            diff = a[i:i + block, None, :] - a[None, :, :]
+            d[i:i + block] = numpy.sqrt(numpy.einsum('ijk,ijk->ij',
+                                                     diff, diff))
+        return d.tolist()
+    (sub, mul) = (operator.sub, operator.mul)
+    root = math.sqrt
+    vs = [list(v) for v in vs]
+    m = len(vs)
+    mc = [[0.0] * m for i in range(m)]
+    for i in range(m):
+        u = vs[i]
+        row = mc[i]
+        for j in range(i + 1, m):
+            d = map(sub, u, vs[j])
+            row[j] = mc[j][i] = root(sum(map(mul, d, d)))
+    return mc
+
+
+@check_vector_batch(0, 1)
+def vector_angles(u, vs):
+    """
+    Determine the angle, in radians, between the vector u and each of
+    the vectors vs. The cosines of the angles are clipped to [-1, 1], so
+    that rounding can't take them out of the domain of acos, and a zero
+    vector, which makes no angle, raises a ZeroDivisionError.
+
+    >>> vector_angles([1, 0], [[0, 1], [1, 0], [-2, 0]])
+    [1.5707963267948966, 0.0, 3.141592653589793]
+    >>> vector_angles([0.3, 0.7, 0.3], [[0.3 * 3, 0.7 * 3, 0.3 * 3]])
+    [0.0]
+    >>> vector_angles([1, 0], [[0, 1], [0, 0]])
+    Traceback (most recent call last):
+      ...
+    ZeroDivisionError: The angle with a zero vector is undefined.
+    """
+    arrays = _use_numpy(u, vs)
+    if arrays:
+        (u, a) = arrays
+        norms = numpy.sqrt(numpy.einsum('ij,ij->i', a, a)) * math.sqrt(
+            numpy.dot(u, u))
+        if not norms.all():
+            raise ZeroDivisionError("The angle with a zero vector is "
+                                    "undefined.")
+        cosines = numpy.dot(a, u) / norms
+        return numpy.arccos(numpy.clip(cosines, -1.0, 1.0)).tolist()
+    mul = operator.mul
+    root = math.sqrt
+    norm_u = root(sum(map(mul, u, u)))
+    angles = []
+    for v in vs:
+        norms = norm_u * root(sum(map(mul, v, v)))
+        if not norms:
+            raise ZeroDivisionError("The angle with a zero vector is "
+                                    "undefined.")
+        cosine = sum(map(mul, u, v)) / norms
+        angles.append(math.acos(max(-1.0, min(1.0, cosine))))
+    return angles
+
+
+@check_vector_batch(0, 1)
+def vector_projections(u, vs):
+    """
+    Calculate the projection of each of the vectors vs onto u, which
+    raises a ZeroDivisionError if u is a zero vector.
+
+    >>> vector_projections([2, 1], [[-1, 3], [2, 1]])
+    [[0.4, 0.2], [2.0, 1.0]]
+    >>> vector_projections([0.0, 0.0], [[1.0, 2.0]])
+    Traceback (most recent call last):
+      ...
+    ZeroDivisionError: Can't project onto a zero vector.
+    """
+    arrays = _use_numpy(u, vs)
+    if arrays:
+        (u, a) = arrays
+        uu = numpy.dot(u, u)
+        if not uu:
+            raise ZeroDivisionError("Can't project onto a zero vector.")
+        c = numpy.dot(a, u) / uu
+        return numpy.outer(c, u).tolist()
+    (mul, div) = (operator.mul, _division())
+    uu = sum(map(mul, u, u))
+    if not uu:
+        raise ZeroDivisionError("Can't project onto a zero vector.")
+    projections = []
+    for v in vs:
+        c = div(sum(map(mul, u, v)), uu)
+        projections.append([c * x for x in u])
+    return projections
+
+
+@check_scalar(0)
+def matrix_identity(n):
+    """
+    Create the n x n identity matrix.
+
+    >>> matrix_identity(3)
+    [[1, 0, 0], [0, 1, 0], [0, 0, 1]]
+    >>> matrix_identity(0)
+    []
+    """
+    return [[1 if i == j else 0 for j in range(n)] for i in range(n)]
+
+
+def _check_square(ma):
+    """ Raise an InvalidMatrixException if the matrix is not square. """
+    (m, n) = matrix_dimensions(ma)
+    if m != n:
+        raise InvalidMatrixException("Matrix must be square, not %d x %d."
+                                     % (m, n))
+    return n
+
+
+@check_matrix(0)
+def matrix_lu(ma):
+    """
+    Calculate the LU decomposition with partial pivoting of the square
+    matrix A, returning a triple (p, L, U) of a permutation, a lower
+    triangular matrix with 1s on the diagonal, and an upper triangular matrix,
+    such that row i of the product of L and U is row p[i] of A.
+
+    The triple can be given to matrix_lu_solve to solve systems Ax = b for
+    any number of vectors b, each in time proportional to n^2 rather than
+    the n^3 needed to decompose A.
+
+    >>> matrix_lu([[1, 2], [3, 4]])
+    ([1, 0], [[1, 0], [0.3333333333333333, 1]], [[3, 4], [0, 0.6666666666666667]])
+    >>> matrix_lu([])
+    ([], [], [])
+    >>> matrix_lu([[1, 2]])
+    Traceback (most recent call last):
+      ...
+    InvalidMatrixException: Matrix must be square, not 1 x 2.
+    """
+    n = _check_square(ma)
+    a = [list(row) for row in _as_lists(ma)]
+    p = range(n)
+    div = _division()
+    for k in range(n):
+        pivot_row = max(range(k, n), key=lambda i: abs(a[i][k]))
+        if pivot_row != k:
+            a[k], a[pivot_row] = a[pivot_row], a[k]
+            p[k], p[pivot_row] = p[pivot_row], p[k]
+        row_k = a[k]
+        pivot = row_k[k]
+        if pivot == 0:
+            # The rest of the column is 0 already, so A is singular.
+            continue
+        for i in range(k + 1, n):
+            row = a[i]
+            f = row[k]
+            if f != 0:
+                f = div(f, pivot)
+                for j in range(k + 1, n):
+                    row[j] -= f * row_k[j]
+            row[k] = f
+    ml = [[a[i][j] if j < i else int(i == j) for j in range(n)]
+          for i in range(n)]
+    mu = [[a[i][j] if j >= i else 0 for j in range(n)] for i in range(n)]
+    if isinstance(ma, Matrix):
+        return (p, Matrix(ml), Matrix(mu))
+    return (p, ml, mu)
+
+
+def matrix_lu_solve(lu, x):
+    """
+    Solve the system Ax = b, given the LU decomposition (p, L, U) of A
+    calculated by matrix_lu, where b is either a vector or a matrix, each of
+    whose columns is a separate vector to solve for. The result is the
+    vector x, or the matrix whose columns are the solutions.
+
+    >>> lu = matrix_lu([[2, 1], [1, 3]])
+    >>> matrix_lu_solve(lu, [3, 5])
+    [0.8, 1.4]
+    >>> matrix_lu_solve(lu, [[3, 1], [4, 0]])
+    [[1.0, 0.6], [1.0, -0.2]]
+    >>> matrix_lu_solve(matrix_lu([[1, 2], [2, 4]]), [1, 1])
+    Traceback (most recent call last):
+      ...
+    SingularMatrixException: Matrix is singular.
+    >>> matrix_lu_solve(matrix_lu([[1, 2, 3], [4, 5, 6], [7, 8, 9]]), [1, 2, 3])
+    Traceback (most recent call last):
+      ...
+    SingularMatrixException: Matrix is singular.
+    >>> matrix_lu_solve(matrix_lu([[1e-20, 0], [0, 1e-20]]), [1e-20, 1e-20])
+    [1.0, 1.0]
+    """
+    (p, ml, mu) = lu
+    if is_matrix(x) and not is_vector(x):
+        cols = [_lu_solve_vector(p, ml, mu, list(col)) for col in zip(*x)]
+        return [list(row) for row in zip(*cols)]
+    return _lu_solve_vector(p, ml, mu, x)
+
+
+def _lu_solve_vector(p, ml, mu, v):
+    """
+    Helper function for matrix_lu_solve that solves for one vector, with
+    forward substitution through L followed by back substitution through U.
+    """
+    n = len(p)
+    if len(v) != n:
+        raise IncompatibleVectorException(
+            "Vector must have %d element(s), not %d." % (n, len(v)))
+    div = _division()
+    tol = _pivot_tolerance([row[i] for (i, row) in enumerate(mu)])
+    y = [v[i] for i in p]
+    for i in range(n):
+        row = ml[i]
+        y[i] -= sum(row[j] * y[j] for j in range(i))
+    for i in reversed(range(n)):
+        row = mu[i]
+        if abs(row[i]) <= tol:
+            raise SingularMatrixException("Matrix is singular.")
+        y[i] = div(y[i] - sum(row[j] * y[j] for j in range(i + 1, n)),
+                   row[i])
+    return y
+
+
+def _pivot_tolerance(pivots):
+    """ Return the magnitude at or below which one of the given pivots (the
+    diagonal of a triangular matrix) makes the matrix singular: epsilon
+    times the largest pivot magnitude times the number of pivots, as in
+    matrix_rank, so that the test doesn't depend on the scale of the
+    matrix, or 0 in exact mode. """
+    if exact or not pivots:
+        return 0
+    return len(pivots) * epsilon * max(abs(x) for x in pivots)
+
+
+@check_matrix(0)
+def matrix_solve(ma, x):
+    """
+    Solve the system Ax = b for x, where A is a square matrix and b is a
+    vector, or a matrix with one column for each vector to solve for.
+    To solve for vectors one at a time, decompose A once with matrix_lu and
+    use matrix_lu_solve instead.
+
+    >>> matrix_solve([[1, 1, 1], [0, 2, 5], [2, 5, -1]], [6, -4, 27])
+    [5.0, 3.0, -2.0]
+    >>> matrix_solve([[0, 1], [1, 0]], [[1, 2], [3, 4]])
+    [[3.0, 4.0], [1.0, 2.0]]
+    >>> matrix_solve(Matrix([[2, 1], [0, 4]], structure='upper'), [4, 8])
+    [1.0, 2.0]
+    >>> matrix_solve(Matrix([[1e-20, 0], [1e-20, 1e-20]], structure='lower'), [1e-20, 2e-20])
+    [1.0, 1.0]
+    >>> matrix_solve(Matrix([[1, 1], [0, 0]], structure='upper'), [1, 1])
+    Traceback (most recent call last):
+      ...
+    SingularMatrixException: Matrix is singular.
+    """
+    if _has_structure(ma, 'upper') or _has_structure(ma, 'lower'):
+        # Triangular matrices need only substitution, not decomposition.
+        (rows, upper) = (ma.tolist(), _has_structure(ma, 'upper'))
+        if is_matrix(x) and not is_vector(x):
+            cols = [_substitute(rows, list(col), upper) for col in zip(*x)]
+            return [list(row) for row in zip(*cols)]
+        return _substitute(rows, x, upper)
+    return matrix_lu_solve(matrix_lu(ma), x)
+
+
+def _substitute(rows, v, upper):
+    """ Solve for one vector with back substitution through the given rows
+    of an upper triangular matrix, or forward substitution through those of
+    a lower triangular one. """
+    n = len(rows)
+    if len(v) != n:
+        raise IncompatibleVectorException(
+            "Vector must have %d element(s), not %d." % (n, len(v)))
+    div = _division()
+    tol = _pivot_tolerance([row[i] for (i, row) in enumerate(rows)])
+    y = list(v)
+    for i in (reversed(range(n)) if upper else range(n)):
+        row = rows[i]
+        if abs(row[i]) <= tol:
+            raise SingularMatrixException("Matrix is singular.")
+        others = range(i + 1, n) if upper else range(i)
+        y[i] = div(y[i] - sum(row[j] * y[j] for j in others), row[i])
+    return y
+
+
+@check_matrix(0)
+def matrix_det(ma):
+    """
+    Calculate the determinant of the square matrix A, as the product of the
+    diagonal of U in its LU decomposition, negated if the rows of A were
+    permuted an odd number of times. In exact mode, it is calculated
+    exactly instead, by fraction-free elimination.
+
+    >>> matrix_det([[1, 2], [3, 4]])
+    -2.0
+    >>> with exact_mode():
+    ...     matrix_det([[1, 2], [3, 4]]), matrix_det([[Fraction(1, 2), 1], [1, 3]])
+    (-2, Fraction(1, 2))
+    >>> matrix_det([[2, 0, 0], [0, 3, 0], [0, 0, 4]])
+    24
+    >>> scalar_equal(matrix_det([[1, 2], [2, 4]]), 0)
+    True
+    >>> matrix_det([])
+    1
+    """
+    if exact:
+        n = _check_square(ma)
+        (a, d) = _integer_rows(ma)
+        det = _bareiss_det(a)
+        return det if d == 1 else Fraction(det, d ** n)
+    if _has_structure(ma, 'upper') or _has_structure(ma, 'lower'):
+        return reduce(operator.mul, _diagonal(ma), 1.0)
+    (p, ml, mu) = matrix_lu(ma)
+    det = 1
+    for (i, row) in enumerate(_as_lists(mu)):
+        det *= row[i]
+    return -det if _permutation_is_odd(p) else det
+
+
+@check_matrix(0)
+def matrix_rank(ma):
+    """
+    Calculate the rank of the m x n matrix A, which is the number of
+    linearly independent rows (or columns), by Gaussian elimination with
+    partial pivoting, treating as 0 any pivot no greater than epsilon times
+    the largest element times the larger dimension. In exact mode, the
+    rank is found exactly, by fraction-free elimination.
+
+    >>> matrix_rank([[1, 2, 3], [2, 4, 6], [1, 0, 1]])
+    2
+    >>> h = [[Fraction(1, i + j + 1) for j in range(12)] for i in range(12)]
+    >>> matrix_rank(h)
+    11
+    >>> with exact_mode():
+    ...     matrix_rank(h)
+    12
+    """
+    if exact:
+        return _bareiss_rank(_integer_rows(ma)[0])
+    a = [[float(x) for x in row] for row in _as_dense(evaluate(ma))]
+    (m, n) = (len(a), len(a[0]) if a else 0)
+    largest = max([abs(x) for row in a for x in row] or [0.0])
+    tol = max(m, n) * epsilon * largest
+    rank = 0
+    for k in range(n):
+        if rank == m:
+            break
+        pivot_row = max(range(rank, m), key=lambda i: abs(a[i][k]))
+        if abs(a[pivot_row][k]) <= tol:
+            continue
+        a[rank], a[pivot_row] = a[pivot_row], a[rank]
+        row_k = a[rank]
+        for i in range(rank + 1, m):
+            row = a[i]
+            f = row[k] / row_k[k]
+            if f != 0:
+                for j in range(k + 1, n):
+                    row[j] -= f * row_k[j]
+        rank += 1
+    return rank
+
+
+def _integer_rows(ma):
+    """ Return the rows of the matrix of ints and Fractions as lists of
+    ints, multiplied by the least common multiple d of the denominators of
+    the elements, along with d. """
+    rows = [[Fraction(x) for x in row] for row in _as_dense(evaluate(ma))]
+    d = 1
+    for row in rows:
+        for x in row:
+            d = d * x.denominator // gcd(d, x.denominator)
+    return ([[(x * d).numerator for x in row] for row in rows], d)
+
+
+def _bareiss_det(a):
+    """
+    Calculate the determinant of the square matrix of ints with Bareiss's
+    fraction-free elimination, in which every element after step k is the
+    determinant of a (k + 1) x (k + 1) minor of the matrix, so the divisions
+    by the previous pivot are exact and the elements stay as small as the
+    determinant itself. The rows of a are modified.
+    """
+    n = len(a)
+    sign = 1
+    previous = 1
+    for k in range(n - 1):
+        if a[k][k] == 0:
+            for i in range(k + 1, n):
+                if a[i][k] != 0:
+                    a[k], a[i] = a[i], a[k]
+                    sign = -sign
+                    break
+            else:
+                return 0
+        row_k = a[k]
+        pivot = row_k[k]
+        for i in range(k + 1, n):
+            row = a[i]
+            f = row[k]
+            for j in range(k + 1, n):
+                row[j] = (row[j] * pivot - f * row_k[j]) // previous
+        previous = pivot
+    return sign * a[n - 1][n - 1] if n else 1
+
+
+def _bareiss_rank(a):
+    """ Calculate the rank of the matrix of ints with Bareiss's
+    fraction-free elimination, as _bareiss_det does, skipping columns with
+    no nonzero pivot. The rows of a are modified. """
+    (m, n) = (len(a), len(a[0]) if a else 0)
+    rank = 0
+    previous = 1
+    for k in range(n):
+        if rank == m:
+            break
+        for i in range(rank, m):
+            if a[i][k] != 0:
+                a[rank], a[i] = a[i], a[rank]
+                break
+        else:
+            continue
+        row_k = a[rank]
+        pivot = row_k[k]
+        for i in range(rank + 1, m):
+            row = a[i]
+            f = row[k]
+            for j in range(k + 1, n):
+                row[j] = (row[j] * pivot - f * row_k[j]) // previous
+        previous = pivot
+        rank += 1
+    return rank
+
+
+def _permutation_is_odd(p):
+    """ Determine whether the permutation (a list of the numbers 0 to n - 1)
+    is the product of an odd number of swaps, given that each of its cycles
+    of length k is the product of k - 1 swaps. """
+    seen = [False] * len(p)
+    cycles = 0
+    for i in range(len(p)):
+        if not seen[i]:
+            cycles += 1
+            j = i
+            while not seen[j]:
+                seen[j] = True
+                j = p[j]
+    return (len(p) - cycles) % 2 == 1
+
+
+@check_matrix(0)
+def matrix_inverse(ma):
+    """
+    Calculate the inverse of the square matrix A, raising a
+    SingularMatrixException if A has no inverse.
+
+    >>> matrix_inverse([[4, 7], [2, 6]])
+    [[0.6000000000000001, -0.7000000000000001], [-0.2, 0.4]]
+    >>> matrix_inverse([[1, 2], [2, 4]])
+    Traceback (most recent call last):
+      ...
+    SingularMatrixException: Matrix is singular.
+    """
+    lu = matrix_lu(ma)
+    n = len(lu[0])
+    mc = matrix_lu_solve((lu[0], _as_lists(lu[1]), _as_lists(lu[2])),
+                         matrix_identity(n))
+    return Matrix(mc) if isinstance(ma, Matrix) else mc
+
+
+# Iterative methods for large (and especially sparse) systems, which use
+# the matrix only to multiply vectors by it, and so never need more than
+# O(n) memory beyond the matrix itself. Each of them stops once the norm
+# of the residual (or, for eigenvalues, the change in the estimate) is at
+# most tol times the norm of the right-hand side (or of the eigenvalue),
+# where tol defaults to iterative_tolerance, and raises a
+# ConvergenceException if that doesn't happen within max_iterations.
+iterative_tolerance = math.sqrt(epsilon)
+
+
+@check_vector(1)
+def matrix_vector_product(ma, v):
+    """
+    Calculate the product Av of the m x n matrix A and the vector v of size
+    n, which is the vector of size m whose i-th element is the dot product
+    of row i of A with v.
+
+    >>> matrix_vector_product([[1, 2], [3, 4], [5, 6]], [1, -1])
+    [-1, -1, -1]
+    >>> matrix_vector_product(CSRMatrix.from_dense([[0, 2], [1, 0]]), [3, 4])
+    [8, 3]
+    >>> matrix_vector_product([[1, 2]], [1, 2, 3])
+    Traceback (most recent call last):
+      ...
+    IncompatibleVectorException: Vector must have 2 element(s), not 3.
+    """
+    if not trusted and not _is_valid(ma, is_matrix):
+        raise InvalidMatrixException("Arg is not a matrix: %s" % repr(ma))
+    (m, n) = matrix_dimensions.unchecked(ma)
+    if m > 0 and len(v) != n:
+        raise IncompatibleVectorException(
+            "Vector must have %d element(s), not %d." % (n, len(v)))
+    return _matvec(ma)(v)
+
+
+def _matvec(ma):
+    """ Return a function that multiplies a vector by the given matrix (or
+    by the linear operator, if ma is already such a function), doing any
+    conversion of the matrix only once, up front. """
+    if callable(ma):
+        return ma
+    if isinstance(ma, SparseMatrix):
+        rows = [ma.tocsr().row_items(i) for i in range(ma.shape[0])]
+        return lambda v: [sum(x * v[j] for (j, x) in row) for row in rows]
+    arrays = _use_numpy(ma)
+    if arrays:
+        (a,) = arrays
+        return lambda v: numpy.dot(a, v).tolist()
+    rows = [list(row) for row in _as_lists(evaluate(ma))]
+    mul = operator.mul
+    return lambda v: [sum(map(mul, row, v)) for row in rows]
+
+
+def _diagonal(ma):
+    """ Return the diagonal of the square matrix as a list. """
+    if isinstance(ma, SparseMatrix):
+        return [ma.get(i, i) for i in range(ma.shape[0])]
+    if isinstance(ma, Matrix):
+        return [ma[i, i] for i in range(ma.shape[0])]
+    return [row[i] for (i, row) in enumerate(evaluate(ma))]
+
+
+def _check_symmetric(ma):
+    """ Raise an InvalidMatrixException unless the given matrix (which
+    may instead be a function, which can't be checked) is symmetric. """
+    if trusted or callable(ma):
+        return
+    if not matrix_is_symmetric(ma):
+        raise InvalidMatrixException("Matrix must be symmetric.")
+
+
+def _operator_size(ma, v):
+    """ Return the size n of the square matrix (or, if ma is a function,
+    of the vector v), raising an exception if the matrix is invalid or v
+    doesn't have n elements. """
+    if callable(ma):
+        if v is None:
+            raise LAValueError("A vector is required when the matrix is "
+                               "given as a function.")
+        return len(v)
+    if not trusted and not _is_valid(ma, is_matrix):
+        raise InvalidMatrixException("Arg is not a matrix: %s" % repr(ma))
+    n = _check_square(ma)
+    if v is not None and len(v) != n:
+        raise IncompatibleVectorException(
+            "Vector must have %d element(s), not %d." % (n, len(v)))
+    return n
+
+
+def _start(n, x0):
+    """ Return a copy of the starting vector x0 as a list of floats, or
+    the zero vector of size n if x0 is None. """
+    if x0 is None:
+        return [0.0] * n
+    if len(x0) != n:
+        raise IncompatibleVectorException(
+            "Vector must have %d element(s), not %d." % (n, len(x0)))
+    return [float(x) for x in x0]
+
+
+@check_vector(1)
+def matrix_cg(ma, b, x0=None, tol=None, max_iterations=None):
+    """
+    Solve the system Ax = b with the conjugate gradient method, where A is
+    a symmetric positive-definite matrix (or a function that multiplies a
+    vector by such a matrix), starting from x0 (by default, the zero
+    vector). In exact arithmetic, it converges within n iterations, which
+    is also the default for max_iterations. The result is the pair
+    (x, iterations).
+
+    >>> (x, k) = matrix_cg([[4, 1], [1, 3]], [1, 2])
+    >>> [round(xi, 12) for xi in x], k
+    ([0.090909090909, 0.636363636364], 2)
+    >>> matrix_cg([[1, 2], [0, 1]], [1, 1])
+    Traceback (most recent call last):
+      ...
+    InvalidMatrixException: Matrix must be symmetric.
+    """
+    n = _operator_size(ma, b)
+    _check_symmetric(ma)
+    tol = iterative_tolerance if tol is None else tol
+    max_iterations = n if max_iterations is None else max_iterations
+    (dot, norm) = (vector_product.unchecked, vector_norm.unchecked)
+    (times, plus) = (vector_times.unchecked, vector_plus.unchecked)
+    matvec = _matvec(ma)
+    x = _start(n, x0)
+    r = vector_minus.unchecked(b, matvec(x))
+    p = r
+    rr = dot(r, r)
+    target = tol * norm(b)
+    if math.sqrt(rr) <= target:
+        return (x, 0)
+    for k in range(1, max(max_iterations, 1) + 1):
+        ap = matvec(p)
+        alpha = rr / dot(p, ap)
+        x = plus(x, times(alpha, p))
+        r = plus(r, times(-alpha, ap))
+        rr_next = dot(r, r)
+        if math.sqrt(rr_next) <= target:
+            return (x, k)
+        p = plus(r, times(rr_next / rr, p))
+        rr = rr_next
+    raise ConvergenceException(
+        "No convergence after %d iteration(s); residual norm is %s."
+        % (max_iterations, math.sqrt(rr)))
+
+
+@check_vector(1)
+def matrix_jacobi(ma, b, x0=None, tol=None, max_iterations=1000):
+    """
+    Solve the system Ax = b with the Jacobi method, starting from x0 (by
+    default, the zero vector). This converges when, for example, A is
+    strictly diagonally dominant. Like matrix_gauss_seidel, A must be a
+    matrix, not a function. The result is the pair (x, iterations).
+
+    >>> (x, k) = matrix_jacobi([[4, 1], [2, 5]], [6, 12])
+    >>> [round(xi, 6) for xi in x]
+    [1.0, 2.0]
+    """
+    return _stationary(ma, b, x0, tol, max_iterations, _jacobi_sweep)
+
+
+@check_vector(1)
+def matrix_gauss_seidel(ma, b, x0=None, tol=None, max_iterations=1000):
+    """
+    Solve the system Ax = b with the Gauss-Seidel method, starting from x0
+    (by default, the zero vector), which uses each updated element of x as
+    soon as it is calculated, and so typically needs fewer iterations than
+    the Jacobi method. This converges when, for example, A is symmetric
+    positive-definite or strictly diagonally dominant. The result is the
+    pair (x, iterations).
+
+    >>> (x, k) = matrix_gauss_seidel([[4, 1], [2, 5]], [6, 12])
+    >>> [round(xi, 6) for xi in x]
+    [1.0, 2.0]
+    """
+    return _stationary(ma, b, x0, tol, max_iterations, _gauss_seidel_sweep)
+
+
+def _stationary(ma, b, x0, tol, max_iterations, sweep):
+    """
+    Helper function for matrix_jacobi and matrix_gauss_seidel, which
+    repeats the given sweep, which updates x given A, b, the diagonal of A
+    and the function that multiplies by A, until the residual is small.
+    """
+    if callable(ma):
+        raise InvalidMatrixException("Arg is not a matrix: %s" % repr(ma))
+    n = _operator_size(ma, b)
+    tol = iterative_tolerance if tol is None else tol
+    matvec = _matvec(ma)
+    diagonal = _diagonal(ma)
+    if 0 in diagonal:
+        raise LAValueError("Matrix must have no zeros on its diagonal.")
+    norm = vector_norm.unchecked
+    target = tol * norm(b)
+    x = _start(n, x0)
+    for k in range(max_iterations + 1):
+        r = vector_minus.unchecked(b, matvec(x))
+        if norm(r) <= target:
+            return (x, k)
+        if k < max_iterations:
+            x = sweep(ma, b, x, r, diagonal)
+    raise ConvergenceException(
+        "No convergence after %d iteration(s); residual norm is %s."
+        % (max_iterations, norm(r)))
+
+
+def _jacobi_sweep(ma, b, x, r, diagonal):
+    """ Update every element of x from the previous x at once, which is
+    x + D^-1 r for diagonal D and residual r. """
+    return [xi + ri / di for (xi, ri, di) in zip(x, r, diagonal)]
+
+
+def _gauss_seidel_sweep(ma, b, x, r, diagonal):
+    """ Update the elements of x one at a time, in place. """
+    if isinstance(ma, SparseMatrix):
+        ma = ma.tocsr()
+        rows = (ma.row_items(i) for i in range(ma.shape[0]))
+    else:
+        rows = (enumerate(row) for row in _as_lists(evaluate(ma)))
+    for (i, row) in enumerate(rows):
+        s = b[i]
+        for (j, a) in row:
+            if j != i:
+                s -= a * x[j]
+        x[i] = s / float(diagonal[i])
+    return x
+
+
+def _unit_start(n, x0):
+    """ Return the starting vector x0, or an arbitrary (but repeatable)
+    vector of size n, normalized to unit length. """
+    if x0 is None:
+        rng = random.Random(n)
+        x0 = [rng.uniform(-1.0, 1.0) for i in range(n)]
+    x = _start(n, x0)
+    return vector_times.unchecked(1.0 / vector_norm.unchecked(x), x)
+
+
+def matrix_power_iteration(ma, x0=None, tol=None, max_iterations=1000):
+    """
+    Estimate the eigenvalue of the square matrix A with the greatest
+    magnitude, and a unit-length eigenvector for it, by multiplying a
+    starting vector (x0, or an arbitrary vector by default) by A repeatedly.
+    A may instead be a function that multiplies a vector by the matrix, in
+    which case x0 must be given. The result is the triple (eigenvalue,
+    eigenvector, iterations).
+
+    >>> (s, v, k) = matrix_power_iteration([[2, 1], [1, 2]])
+    >>> round(s, 6), [round(abs(x), 6) for x in v]
+    (3.0, [0.707107, 0.707107])
+    """
+    n = _operator_size(ma, x0)
+    tol = iterative_tolerance if tol is None else tol
+    matvec = _matvec(ma)
+    (dot, norm) = (vector_product.unchecked, vector_norm.unchecked)
+    x = _unit_start(n, x0)
+    for k in range(1, max_iterations + 1):
+        y = matvec(x)
+        # The Rayleigh quotient of the unit vector x, and the residual of
+        # x as an eigenvector for it.
+        s = dot(x, y)
+        size = norm(y)
+        if size == 0:
+            return (0.0, x, k)
+        residual = vector_minus.unchecked(y, vector_times.unchecked(s, x))
+        x = vector_times.unchecked(1.0 / size, y)
+        if norm(residual) <= tol * abs(s):
+            return (s, x, k)
+    raise ConvergenceException(
+        "No convergence after %d iteration(s); eigenvalue estimate is %s."
+        % (max_iterations, s))
+
+
+def matrix_lanczos(ma, k=1, x0=None, tol=None, max_iterations=None):
+    """
+    Estimate the k eigenvalues of greatest magnitude of the symmetric
+    matrix A, and unit-length eigenvectors for them, with the Lanczos
+    method, which builds an orthonormal basis of the space spanned by
+    x0, Ax0, A^2x0, ..., in which A is tridiagonal, one vector per
+    iteration, until the eigenvalues of that tridiagonal matrix estimate k
+    eigenvalues of A to within tol. A may instead be a function that
+    multiplies a vector by the matrix, in which case x0 must be given.
+    The result is the triple (eigenvalues, eigenvectors, iterations), with
+    the eigenvalues in decreasing order of magnitude.
+
+    >>> (ss, vs, k) = matrix_lanczos([[2, 1, 0], [1, 2, 0], [0, 0, 1]], 2)
+    >>> [round(s, 6) for s in ss]
+    [3.0, 1.0]
+    >>> [round(abs(x), 6) for x in vs[0]]
+    [0.707107, 0.707107, 0.0]
+    """
+    n = _operator_size(ma, x0)
+    _check_symmetric(ma)
+    tol = iterative_tolerance if tol is None else tol
+    matvec = _matvec(ma)
+    max_iterations = n if max_iterations is None else min(max_iterations, n)
+    (dot, norm) = (vector_product.unchecked, vector_norm.unchecked)
+    (times, plus) = (vector_times.unchecked, vector_plus.unchecked)
+    basis = [_unit_start(n, x0)]
+    alphas, betas = [], []
+    # Finding the eigenvalues of the tridiagonal matrix costs more than an
+    # iteration, so convergence is checked at growing intervals.
+    check = k
+    for j in range(max_iterations):
+        q = basis[j]
+        w = matvec(q)
+        alphas.append(dot(w, q))
+        # Orthogonalizing against every basis vector, not just the last
+        # two, and doing so twice, keeps the basis from losing
+        # orthogonality to rounding, which would give spurious eigenvalues.
+        for p in basis + basis:
+            w = plus(w, times(-dot(w, p), p))
+        beta = norm(w)
+        done = beta <= tol * max(abs(s) for s in alphas) or j + 1 == n
+        if not done and j + 1 < min(check, max_iterations):
+            betas.append(beta)
+            basis.append(times(1.0 / beta, w))
+            continue
+        check = max(j + 2, int((j + 1) * 1.25))
+        (ritz, vectors) = _ritz_pairs(alphas, betas)
+        if len(ritz) >= k and (done or all_true(
+                range(k), lambda i: beta * abs(vectors[i][-1])
+                <= tol * abs(ritz[i]))):
+            eigenvectors = []
+            for y in vectors[:k]:
+                v = [0.0] * n
+                for (c, p) in zip(y, basis):
+                    v = plus(v, times(c, p))
+                eigenvectors.append(v)
+            return (ritz[:k], eigenvectors, j + 1)
+        if done:
+            break
+        betas.append(beta)
+        basis.append(times(1.0 / beta, w))
+    raise ConvergenceException(
+        "No convergence after %d iteration(s)." % len(alphas))
+
+
+def _ritz_pairs(alphas, betas):
+    """ Return the eigenvalues, in decreasing order of magnitude, and the
+    corresponding eigenvectors of the symmetric tridiagonal matrix with
+    the given diagonal and off-diagonal. """
+    (values, vectors) = _tridiagonal_eigen(alphas, betas)
+    order = sorted(range(len(values)), key=lambda i: -abs(values[i]))
+    return ([values[i] for i in order], [vectors[i] for i in order])
+
+
+def _tridiagonal_eigen(diagonal, off_diagonal, max_iterations=30):
+    """
+    Calculate the eigenvalues and eigenvectors of the symmetric tridiagonal
+    matrix with the given diagonal and off-diagonal with the QL method with
+    implicit shifts, which repeatedly applies rotations that chase the
+    off-diagonal elements to zero, one eigenvalue at a time.
+    """
+    n = len(diagonal)
+    d = [float(x) for x in diagonal]
+    e = [float(x) for x in off_diagonal] + [0.0]
+    z = matrix_identity(n)
+    for l in range(n):
+        for iteration in range(max_iterations + 1):
+            # Look for a negligible off-diagonal element to split at.
+            m = l
+            while m < n - 1 and abs(e[m]) > epsilon * (abs(d[m]) +
+                                                      abs(d[m + 1])):
+                m += 1
+            if m == l:
+                break
+            if iteration == max_iterations:
+                raise ConvergenceException(
+                    "No convergence after %d iteration(s)." % iteration)
+            g = (d[l + 1] - d[l]) / (2.0 * e[l])
+            r = math.hypot(g, 1.0)
+            g = d[m] - d[l] + e[l] / (g + (r if g >= 0 else -r))
+            (s, c, p) = (1.0, 1.0, 0.0)
+            for i in range(m - 1, l - 1, -1):
+                (f, b) = (s * e[i], c * e[i])
+                r = e[i + 1] = math.hypot(f, g)
+                if r == 0.0:
+                    d[i + 1] -= p
+                    e[m] = 0.0
+                    break
+                (s, c) = (f / r, g / r)
+                g = d[i + 1] - p
+                r = (d[i] - g) * s + 2.0 * c * b
+                p = s * r
+                d[i + 1] = g + p
+                g = c * r - b
+                for row in z:
+                    (x, y) = (row[i], row[i + 1])
+                    (row[i], row[i + 1]) = (c * x - s * y, s * x + c * y)
+            else:
+                d[l] -= p
+                e[l] = g
+                e[m] = 0.0
+    return (d, [[row[i] for row in z] for i in range(n)])
+
+
+# Matrix files, as written by matrix_save and read by matrix_load, start
+# with a header holding the magic string, the format version, the type of
+# the elements (always little-endian doubles) and the number of rows and
+# columns, followed by the elements in row-major order.
+_FILE_HEADER = struct.Struct('<4sB3sQQ')
+_FILE_MAGIC = 'LAMX'
+_FILE_VERSION = 1
+_FILE_DTYPE = '<f8'
+
+
+@check_matrix(0)
+def matrix_save(ma, path):
+    """
+    Write the matrix to the file at the given path, in the binary format
+    that matrix_load reads, one row at a time.
+
+    >>> import os, tempfile
+    >>> (fd, path) = tempfile.mkstemp()
+    >>> matrix_save([[1, 2, 3], [4, 5, 6]], path)
+    >>> os.path.getsize(path)
+    72
+    >>> os.close(fd); os.remove(path)
+    """
+    ma = evaluate(ma)
+    (m, n) = matrix_dimensions.unchecked(ma)
+    with open(path, 'wb') as f:
+        f.write(_FILE_HEADER.pack(_FILE_MAGIC, _FILE_VERSION, _FILE_DTYPE,
+                                  m, n))
+        for i in range(m):
+            row = array('d', ma.row(i) if isinstance(ma, SparseMatrix)
+                        else ma[i])
+            if sys.byteorder == 'big':
+                row.byteswap()
+            row.tofile(f)
+
+
+def matrix_load(path, mode='r'):
+    """
+    Open the matrix file written by matrix_save at the given path as a
+    Matrix whose storage is a MappedArray over a memory map of the file, so
+    that none of the elements are read until they are used, and matrices
+    larger than memory can be operated on. With mode 'r', the matrix is
+    read-only; with 'r+', changes to it are written to the file; and with
+    'c', changes are made only in memory.
+
+    >>> import os, tempfile
+    >>> (fd, path) = tempfile.mkstemp()
+    >>> matrix_save([[1, 2, 3], [4, 5, 6]], path)
+    >>> a = matrix_load(path)
+    >>> a
+    Matrix([[1.0, 2.0, 3.0], [4.0, 5.0, 6.0]])
+    >>> a.data
+    MappedArray(6 element(s) at byte 24)
+    >>> matrix_product(a, matrix_transpose(a))
+    Matrix([[14.0, 32.0], [32.0, 77.0]])
+    >>> os.chmod(path, 0o444)
+    >>> c = matrix_load(path, 'c')
+    >>> c[0, 0] = 9.0
+    >>> c[0, 0], matrix_load(path)[0, 0]
+    (9.0, 1.0)
+    >>> del a, c
+    >>> os.chmod(path, 0o644)
+    >>> open(path, 'wb').close()
+    >>> matrix_load(path) # doctest: +ELLIPSIS
+    Traceback (most recent call last):
+      ...
+    LAValueError: Not a matrix file: ...
+    >>> os.close(fd); os.remove(path)
+    """
+    access = {'r': mmap.ACCESS_READ, 'r+': mmap.ACCESS_WRITE,
+              'c': mmap.ACCESS_COPY}.get(mode)
+    if access is None:
+        raise LAValueError("Invalid mode: %r" % mode)
+    # A copy-on-write map doesn't write to the file, so only 'r+' needs
+    # it to be writable.
+    with open(path, 'r+b' if mode == 'r+' else 'rb') as f:
+        try:
+            mm = mmap.mmap(f.fileno(), 0, access=access)
+        except ValueError:
+            # An empty file can't be mapped.
+            raise LAValueError("Not a matrix file: %s" % path)
+    size = _FILE_HEADER.size
+    (magic, version, dtype, m, n) = _FILE_HEADER.unpack_from(
+        mm[:size].ljust(size, '\0'))
+    if (magic != _FILE_MAGIC or version != _FILE_VERSION or
+            dtype != _FILE_DTYPE or len(mm) != size + 8 * m * n):
+        mm.close()
+        raise LAValueError("Not a matrix file: %s" % path)
+    return Matrix.from_array(MappedArray(mm, size, m * n), m, n)
+
+
+@check_matrix(0)
+@check_scalar(1)
+def matrix_row_blocks(ma, rows):
+    """
+    Iterate over the matrix in blocks of the given number of rows (the
+    last block may have fewer), each of which is a matrix of the same type.
+    The blocks of a Matrix are views that share its storage, so iterating
+    over a matrix opened by matrix_load reads one block at a time, unless
+    the matrix has a recorded structure, which writes through the blocks
+    would leave stale, in which case they are copies.
+
+    >>> list(matrix_row_blocks([[1, 2], [3, 4], [5, 6]], 2))
+    [[[1, 2], [3, 4]], [[5, 6]]]
+    >>> [block.shape for block in matrix_row_blocks(Matrix([[1], [2], [3]]), 2)]
+    [(2, 1), (1, 1)]
+    >>> list(matrix_row_blocks([[1, 2]], 0))
+    Traceback (most recent call last):
+      ...
+    LAValueError: Number of rows per block must be a positive integer, not 0.
+    """
+    if not isinstance(rows, (int, long)) or rows <= 0:
+        raise LAValueError("Number of rows per block must be a positive "
+                           "integer, not %r." % (rows,))
+    ma = evaluate(ma)
+    (m, n) = matrix_dimensions.unchecked(ma)
+    for i in range(0, m, rows):
+        k = min(rows, m - i)
+        if isinstance(ma, Matrix):
+            (s0, s1) = ma.strides
+            block = Matrix.from_array(ma.data, k, n, (s0, s1),
+                                      ma.offset + i * s0)
+            yield block if ma.structure is None else block.copy()
+        elif isinstance(ma, SparseMatrix):
+            yield [ma.row(j) for j in range(i, i + k)]
+        else:
+            yield ma[i:i + k]
 
 # Don't include complex, because python can be built without support.
 __NUMBER_TYPES = sets.Set([int, float, long])
@@ -786,7 +3937,7 @@ def is_vector(u):
 def is_scalar(s):
     """
     Determine whether s is a scalar, which is either a float, int,
-    or long. The integral values 0 and 1 may also be given as
+    long or Fraction. The integral values 0 and 1 may also be given as
     False and True, respectively.
 
     >>> is_scalar(0)
@@ -797,10 +3948,12 @@ def is_scalar(s):
     True
     >>> is_scalar(100L)
     True
+    >>> is_scalar(Fraction(1, 3))
+    True
     >>> is_scalar((1,2))
     False
     """
-    return isinstance(s, (int, float, long))
+    return isinstance(s, (int, float, long, Fraction))
 
 
 def all_true(lst, test=bool):
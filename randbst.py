@@ -1,229 +1,480 @@
+import bisect
+import marshal
+import mmap
+import os
 import random
+import resource
+import shutil
+import struct
+import sys
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
 from cPickle import dump, load
 
-from pprint import PrettyPrinter, pformat, pprint
+from pprint import pformat, pprint, saferepr
 
 
-pp = PrettyPrinter(indent=1)
+# Whether insert_random makes one random draw per insert, rather than one
+# per node that it visits. With a fast source of draws such as
+# random.random, the arithmetic this takes costs more than the draws it
+# saves, but it pays off with a slow one such as random.SystemRandom.
+reuse_draws = False
 
 
 class Ref(object):
     pass
 
 
-class Node(dict):
+class Instruments(object):
+    # Counters of the work done by put, put_many, get and remove, for
+    # checking that the shapes of trees stay healthy. Set the module's
+    # instruments to an instance to have the operations report to it.
+    # Subclasses can extend the put, put_many, get and remove hooks, which
+    # are called after each operation. The counters are updated under a
+    # lock, since the gets of a SharedTree report concurrently.
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.puts = self.inserts = self.inserts_at_root = 0
+            self.rotations = self.put_path_length = 0
+            self.max_put_path_length = 0
+            self.batches = self.batch_puts = self.batch_inserts = 0
+            self.rebuilds = 0
+            self.gets = self.hits = self.comparisons = 0
+            self.max_comparisons = 0
+            self.removes = self.removed = self.remove_path_length = 0
+
+    def put(self, tree, key, is_new, at_root, path_length, rotations):
+        # path_length is the number of nodes above the key's place when it
+        # was inserted or found, and rotations is the number of rotations
+        # made to move it up to where the coin toss put it.
+        with self.lock:
+            self.puts += 1
+            self.inserts += is_new
+            self.inserts_at_root += at_root
+            self.rotations += rotations
+            self.put_path_length += path_length
+            self.max_put_path_length = max(self.max_put_path_length,
+                                           path_length)
+
+    def put_many(self, tree, count, inserts, rebuilt):
+        # count is the number of pairs in the batch and inserts the number
+        # of keys it added. The new keys of a small batch are added with
+        # put, which reports to its own hook as well; a large batch
+        # rebuilds the tree.
+        with self.lock:
+            self.batches += 1
+            self.batch_puts += count
+            self.batch_inserts += inserts
+            self.rebuilds += rebuilt
+
+    def get(self, tree, key, found, comparisons):
+        with self.lock:
+            self.gets += 1
+            self.hits += found
+            self.comparisons += comparisons
+            self.max_comparisons = max(self.max_comparisons, comparisons)
+
+    def remove(self, tree, key, found, path_length):
+        with self.lock:
+            self.removes += 1
+            self.removed += found
+            self.remove_path_length += path_length
+
+    def summary(self):
+        def mean(total, count):
+            return total / float(count) if count else 0.0
+        with self.lock:
+            return {
+                'puts': self.puts,
+                'inserts': self.inserts,
+                'at_root_per_put': mean(self.inserts_at_root, self.puts),
+                'rotations_per_put': mean(self.rotations, self.puts),
+                'mean_put_path_length': mean(self.put_path_length, self.puts),
+                'max_put_path_length': self.max_put_path_length,
+                'batches': self.batches,
+                'batch_puts': self.batch_puts,
+                'batch_inserts': self.batch_inserts,
+                'rebuilds': self.rebuilds,
+                'gets': self.gets,
+                'hit_rate': mean(self.hits, self.gets),
+                'comparisons_per_get': mean(self.comparisons, self.gets),
+                'max_comparisons': self.max_comparisons,
+                'removes': self.removes,
+                'removed': self.removed,
+                'mean_remove_path_length': mean(self.remove_path_length,
+                                                self.removes),
+            }
+
+
+class Tracer(Instruments):
+    # Instruments that also print each operation, and the tree after each
+    # put and remove.
+
+    def put(self, tree, key, is_new, at_root, path_length, rotations):
+        Instruments.put(self, tree, key, is_new, at_root, path_length,
+                        rotations)
+        print("put(%r): new=%s, at_root=%s, path_length=%d, rotations=%d"
+              % (key, is_new, at_root, path_length, rotations))
+        print(tree)
+
+    def put_many(self, tree, count, inserts, rebuilt):
+        Instruments.put_many(self, tree, count, inserts, rebuilt)
+        print("put_many(%d pairs): inserts=%d, rebuilt=%s"
+              % (count, inserts, rebuilt))
+        print(tree)
+
+    def get(self, tree, key, found, comparisons):
+        Instruments.get(self, tree, key, found, comparisons)
+        print("get(%r): found=%s, comparisons=%d"
+              % (key, found, comparisons))
+
+    def remove(self, tree, key, found, path_length):
+        Instruments.remove(self, tree, key, found, path_length)
+        print("remove(%r): found=%s, path_length=%d"
+              % (key, found, path_length))
+        print(tree)
+
+
+# The Instruments that put, put_many, get and remove report to, if any.
+instruments = None
+
+
+class Node(object):
+
+    __slots__ = ('key', 'value', 'size', 'left', 'right')
 
     def __init__(self, key, value, indict=None):
-        if indict is None:
-            indict = {}
-        dict.__init__(self, indict)
         self.key = key
         self.value = value
         self.size = 1
+        self.left = None
+        self.right = None
+        if indict:
+            for (attr, value) in indict.items():
+                setattr(self, attr, value)
 
-    def __getattr__(self, attr):
-        return self.get(attr, None)
+    def __setitem__(self, attr, value):
+        # Pickles written when Node was a dict subclass set the attributes
+        # that weren't None as dict items.
+        setattr(self, attr, value)
 
-    def __setattr__(self, attr, value):
-        if attr in self.__dict__:
-            dict.__setattr__(self, attr, value)
-        else:
-            if value is not None:
-                self.__setitem__(attr, value)
-            elif attr in self:
-                self.__delitem__(attr)
+    def __repr__(self):
+        return node_text(self)
 
     def __getstate__(self):
         return (self.key, self.value, self.size, self.left, self.right)
 
     def __setstate__(self, tup):
-        if tup[0]:
-            self.key = tup[0]
-        if tup[1]:
-            self.value = tup[1]
-        if tup[2]:
-            self.size = tup[2]
-        if tup[3]:
-            self.left = tup[3]
-        if tup[4]:
-            self.right = tup[4]
+        (self.key, self.value, self.size, self.left, self.right) = tup
 
     def __getnewargs__(self):
         return self.key, self.value
 
 
+def copy_node(node):
+    new = Node(node.key, node.value)
+    (new.size, new.left, new.right) = (node.size, node.left, node.right)
+    return new
+
+
+def node_text(node, width=None):
+    # The node and its subtrees written as nested dicts of their key,
+    # value, size and the children that aren't None, on one line, or
+    # broken over lines of the given width as pformat would break them.
+    # The text is written from a stack, rather than by formatting dicts,
+    # which recurses, so that deep trees can be printed.
+    if node is None:
+        return 'None'
+    lengths = node_lengths(node) if width else {}
+    pieces = []
+    stack = [(node, 0, 0, not width)]
+    while stack:
+        item = stack.pop()
+        if isinstance(item, str):
+            pieces.append(item)
+            continue
+        (node, indent, allowance, flat) = item
+        # As in pformat, a dict that doesn't fit in what is left of the
+        # line has an item per line, each indented past its field name.
+        flat = flat or lengths[node] <= width - 1 - indent - allowance
+        sep = ', ' if flat else ',\n' + ' ' * (indent + 1)
+        fields = [("'key': ", saferepr(node.key))]
+        if node.left is not None:
+            fields.append(("'left': ", node.left))
+        if node.right is not None:
+            fields.append(("'right': ", node.right))
+        fields.append(("'size': ", str(node.size)))
+        if flat:
+            fields.append(("'value': ", saferepr(node.value)))
+        else:
+            # A value that is too long is broken over lines at its column.
+            column = indent + 1 + len("'value': ")
+            value = pformat(node.value, width=width - column - allowance - 1
+                            or -1)
+            value = value.replace('\n', '\n' + ' ' * column)
+            fields.append(("'value': ", value))
+        items = ['{']
+        for (i, (name, value)) in enumerate(fields):
+            items.append(name if not i else sep + name)
+            if isinstance(value, Node):
+                value = (value, indent + 1 + len(name), allowance + 1, flat)
+            items.append(value)
+        items.append('}')
+        stack.extend(reversed(items))
+    return ''.join(pieces)
+
+
+def node_lengths(node):
+    # The length of each subtree of node written on one line by node_text,
+    # found from the bottom up, with the lengths of the subtrees of each
+    # node on top of the stack of lengths when it is visited.
+    result = {}
+    stack = [(node, False)]
+    lengths = []
+    while stack:
+        (node, visited) = stack.pop()
+        if node is None:
+            lengths.append(0)
+        elif not visited:
+            stack.append((node, True))
+            stack.append((node.right, False))
+            stack.append((node.left, False))
+        else:
+            (right, left) = (lengths.pop(), lengths.pop())
+            length = (len("{'key': , 'size': , 'value': }") +
+                      len(saferepr(node.key)) + len(str(node.size)) +
+                      len(saferepr(node.value)))
+            if left:
+                length += len(", 'left': ") + left
+            if right:
+                length += len(", 'right': ") + right
+            result[node] = length
+            lengths.append(length)
+    return result
+
+
 class Tree(object):
 
-    def __init__(self):
+    # A persistent tree never changes its nodes, so that they can be shared
+    # with snapshots of it: put and remove copy the nodes on the path that
+    # they change instead.
+    persistent = False
+
+    # The source of the tree's random draws, a function returning floats
+    # uniformly distributed in [0, 1), such as the random method of a seeded
+    # random.Random for a reproducible tree.
+    rand = staticmethod(random.random)
+
+    def __init__(self, persistent=False, rand=None):
         self.root = None
+        self.persistent = persistent
+        if rand is not None:
+            self.rand = rand
 
     def is_empty(self):
         return self.root is None
 
     def __str__(self):
-        return "Tree[]" if self.root is None else pformat(self.root)
+        return ("Tree[]" if self.root is None
+                else node_text(self.root, 80))
 
     __repr__ = __str__
 
     def __getstate__(self):
-        return self.root
-
-    def __setstate__(self, n):
-        self.root = n
-
-
-def put(tree, key, value, debug=False):
-    if debug:
-        print("put[begin](%s, %s); tree.root:" % (key, value))
-    if debug:
-        print(tree)
+        # Methods can't be pickled, so a rand that is a method of an object,
+        # such as a seeded random.Random, is kept as the object and the
+        # method's name. The default rand isn't kept.
+        rand = self.__dict__.get('rand')
+        if getattr(rand, '__self__', None) is not None:
+            rand = (rand.__self__, rand.__name__)
+        return (self.root, self.persistent, rand)
+
+    def __setstate__(self, state):
+        # Pickles written before trees had settings hold just the root.
+        if not isinstance(state, tuple):
+            state = (state, False, None)
+        (self.root, self.persistent, rand) = state
+        if isinstance(rand, tuple):
+            rand = getattr(*rand)
+        if rand is not None:
+            self.rand = rand
+
+
+def put(tree, key, value):
     ref = Ref()
     ref.old_value, ref.is_new = None, False
-    tree.root = insert_random(tree.root, key, value, ref, debug=debug)
-    if debug:
-        print("put[end](%s, %s); tree.root:" % (key, value))
-        print(tree)
-        print("\n")
+    tree.root = insert_random(tree.root, key, value, ref,
+                              copy=tree.persistent, rand=tree.rand)
+    if instruments is not None:
+        instruments.put(tree, key, ref.is_new, ref.at_root, ref.path_length,
+                        ref.rotations)
     return ref.old_value if not ref.is_new else None
 
 
-def get(tree, key, debug=False):
-    node = node_get(tree.root, key, debug=False)
+def get(tree, key):
+    if instruments is not None:
+        return instrumented_get(tree, key)
+    node = node_get(tree.root, key)
     return node.value if node else None
 
 
-def node_get(node, key, debug=False):
-    if node is None or key is None:
-        return None
-    if key < node.key:
-        return node_get(node.left, key, debug)
-    elif key > node.key:
-        return node_get(node.right, key, debug)
-    else:
-        return node
+def instrumented_get(tree, key):
+    # get, also counting the nodes whose keys key is compared with.
+    (node, comparisons) = (tree.root, 0)
+    while node is not None and key is not None:
+        comparisons += 1
+        if key < node.key:
+            node = node.left
+        elif key > node.key:
+            node = node.right
+        else:
+            break
+    instruments.get(tree, key, node is not None, comparisons)
+    return node.value if node else None
 
 
-def insert_random(node, key, value, ref, debug=False):
-    if debug:
-        print("insert_random(begin): key=%s, value=%s, old_value=%s"
-              % (key, value, ref.old_value))
-    if debug:
-        pp.pprint(node)
-    if node is None:
-        node = Node(key, value)
-        ref.is_new = True
-        if debug:
-            print("insert_random(exit node was None): key=%s, value=%s, "
-                  "old_value=%s" % (key, value, ref.old_value))
-        if debug:
-            pp.pprint(node)
-        return node
-    if random.random() * node.size < 1.0:
-        node = insert_at_root(node, key, value, ref, debug=debug)
-        if debug:
-            print("insert_random(exit insert_at_root): key=%s, value=%s, "
-                  "old_value=%s" % (key, value, ref.old_value))
-        if debug:
-            pp.pprint(node)
-    elif key < node.key:
-        node.left = insert_random(node.left, key, value, ref, debug=debug)
-        if ref.is_new:
-            node.size += 1
-    elif key > node.key:
-        node.right = insert_random(node.right, key, value, ref, debug=debug)
+def node_get(node, key):
+    if key is None:
+        return None
+    while node is not None:
+        if key < node.key:
+            node = node.left
+        elif key > node.key:
+            node = node.right
+        else:
+            return node
+    return None
+
+
+def replace_value(node, key, value):
+    # A copy of the tree under node with value as key's value, which copies
+    # just the nodes on the path down to key, sharing the rest. key must be
+    # in the tree.
+    path = []
+    while key < node.key or key > node.key:
+        is_left = key < node.key
+        path.append((copy_node(node), is_left))
+        node = node.left if is_left else node.right
+    node = copy_node(node)
+    node.value = value
+    path.append((node, False))
+    return relink_path(path)
+
+
+def insert_random(node, key, value, ref, copy=False, rand=random.random):
+    # Walk down from node, recording the path, until either the key is
+    # found, an empty subtree is reached, or the coin toss at some node
+    # says the key belongs at the root of that node's subtree.
+    #
+    # With reuse_draws, a single uniform draw u serves the whole walk: when
+    # the toss at a node of size s fails, u is uniform in [1/s, 1), so (u *
+    # s - 1) / (s - 1) is a fresh uniform draw for the toss at the next
+    # node. Since the sizes decrease down the path, this uses up at most
+    # log2(node.size) of the 53 bits of u.
+    reuse = reuse_draws
+    u = rand() if reuse else None
+    path = []
+    curr = node
+    ref.at_root, ref.rotations = False, 0
+    while True:
+        if curr is None:
+            sub = Node(key, value)
+            ref.is_new = True
+            break
+        v = (u if reuse else rand()) * curr.size
+        if v < 1.0:
+            sub = insert_at_root(curr, key, value, ref, copy=copy)
+            ref.at_root = True
+            break
+        if reuse:
+            u = (v - 1.0) / (curr.size - 1)
+        if key < curr.key:
+            path.append((copy_node(curr) if copy else curr, True))
+            curr = curr.left
+        elif key > curr.key:
+            path.append((copy_node(curr) if copy else curr, False))
+            curr = curr.right
+        else:
+            ref.old_value = curr.value
+            sub = curr
+            break
+    ref.path_length = len(path) + ref.rotations
+    if path:
+        if copy:
+            node = relink_path(path)
+        (parent, is_left) = path[-1]
+        if is_left:
+            parent.left = sub
+        else:
+            parent.right = sub
         if ref.is_new:
-            node.size += 1
+            for (ancestor, is_left) in path:
+                ancestor.size += 1
     else:
-        if debug:
-            print("insert_random(found old_value): node.key=%s, "
-                  "node.value=%s, old_value=%s" % (key, value, ref.old_value))
-        ref.old_value = node.value
-        assert node.key == key
-        if debug:
-            print("insert_random(registered old_value): node.key=%s, "
-                  "node.value=%s, old_value=%s" % (key, value, ref.old_value))
-
-    if debug:
-        print("insert_random(end): key=%s, value=%s, old_value=%s"
-              % (key, value, ref.old_value))
-    if debug:
-        pp.pprint(node)
+        node = sub
     return node
 
 
-def insert_at_root(node, key, value, ref, debug=False):
-    if debug:
-        print("insert_at_root(begin): key=%s, value=%s, old_value=%s"
-              % (key, value, ref.old_value))
-    if debug:
-        pp.pprint(node)
-    if node is None:
-        if debug:
-            print("insert_at_root(exit node was None): key=%s, value=%s, "
-                  "old_value=%s" % (key, value, ref.old_value))
+def insert_at_root(node, key, value, ref, copy=False):
+    # Walk down to where the key is or belongs, recording the path, then
+    # rotate the key's node up the path, one level at a time, to the top.
+    path = []
+    curr = node
+    while curr is not None:
+        if key < curr.key:
+            path.append((copy_node(curr) if copy else curr, True))
+            curr = curr.left
+        elif key > curr.key:
+            path.append((copy_node(curr) if copy else curr, False))
+            curr = curr.right
+        else:
+            break
+    if curr is None:
         ref.is_new = True
-        return Node(key, value)
-    if key < node.key:
-        if debug:
-            print("insert_at_root(recursing on left): key=%s, value=%s, "
-                  "old_value=%s" % (key, value, ref.old_value))
-        node.left = insert_at_root(node.left, key, value, ref, debug=debug)
-        if ref.is_new:
-            node.size += 1
-        node = rotate_right(node, ref, debug)
-    elif key > node.key:
-        if debug:
-            print("insert_at_root(recursing on right): key=%s, value=%s, "
-                  "old_value=%s" % (key, value, ref.old_value))
-        node.right = insert_at_root(node.right, key, value, ref, debug=debug)
-        if ref.is_new:
-            node.size += 1
-        node = rotate_left(node, ref, debug=debug)
+        curr = Node(key, value)
     else:
-        if debug:
-            print("insert_at_root(set): node.key=%s, node.value=%s, "
-                  "old_value=%s" % (key, value, ref.old_value))
-        ref.old_value = node.value
-        node.key, node.value = key, value
-    if debug:
-        print("insert_at_root(end): key=%s, value=%s, old_value=%s"
-              % (key, value, ref.old_value))
-    if debug:
-        pp.pprint(node)
-    return node
+        ref.old_value = curr.value
+        if copy:
+            curr = copy_node(curr)
+        curr.key, curr.value = key, value
+    ref.rotations = len(path)
+    while path:
+        (parent, is_left) = path.pop()
+        if is_left:
+            parent.left = curr
+            if ref.is_new:
+                parent.size += 1
+            curr = rotate_right(parent, ref)
+        else:
+            parent.right = curr
+            if ref.is_new:
+                parent.size += 1
+            curr = rotate_left(parent, ref)
+    return curr
 
 
-def rotate_left(node, ref, debug=False):
-    if debug:
-        print("rotate_left(begin): node->")
-    if debug:
-        pp.pprint(node)
+def rotate_left(node, ref):
     node.size, node.right.size = (size(node) - right_size(node.right) - 1,
                                   node.size)
     x = node.right
     node.right = x.left
     x.left = node
-    if debug:
-        print("rotate_left(end): x->")
-    if debug:
-        pp.pprint(x)
     return x
 
 
-def rotate_right(node, ref, debug=False):
-    if debug:
-        print("rotate_right(begin): node->")
-    if debug:
-        pp.pprint(node)
+def rotate_right(node, ref):
     node.size, node.left.size = (size(node) - left_size(node.left) - 1,
                                  node.size)
     x = node.left
     node.left = x.right
     x.right = node
-    if debug:
-        print("rotate_right(end): x->")
-    if debug:
-        pp.pprint(x)
     return x
 
 
@@ -232,41 +483,321 @@ def remove(tree, key):
         return
     ref = Ref()
     ref.rem_node = None
-    tree.root = remove_r(tree.root, key, ref)
+    tree.root = remove_r(tree.root, key, ref, copy=tree.persistent,
+                         rand=tree.rand)
+    if instruments is not None:
+        instruments.remove(tree, key, ref.rem_node is not None,
+                           ref.path_length)
     return ref.rem_node.value if ref.rem_node else None
 
 
-def remove_r(node, key, ref):
-    if node is None:
-        return
-    if key < node.key:
-        node.left = remove_r(node.left, key, ref)
-        if ref.rem_node is not None:
-            node.size -= 1
-    elif key > node.key:
-        node.right = remove_r(node.right, key, ref)
-        if ref.rem_node is not None:
-            node.size -= 1
+def remove_r(node, key, ref, copy=False, rand=random.random):
+    path = []
+    curr = node
+    while curr is not None:
+        if key < curr.key:
+            path.append((curr, True))
+            curr = curr.left
+        elif key > curr.key:
+            path.append((curr, False))
+            curr = curr.right
+        else:
+            break
+    ref.path_length = len(path)
+    if curr is None:
+        return node
+    ref.rem_node = curr
+    sub = join_lr(curr.left, curr.right, copy=copy, rand=rand)
+    if not path:
+        return sub
+    if copy:
+        path = [(copy_node(parent), is_left) for (parent, is_left) in path]
+        node = relink_path(path)
+    (parent, is_left) = path[-1]
+    if is_left:
+        parent.left = sub
     else:
-        ref.rem_node = node
-        node = join_lr(node.left, node.right)
+        parent.right = sub
+    for (ancestor, is_left) in path:
+        ancestor.size -= 1
     return node
 
 
-def join_lr(left, right):
+def relink_path(path):
+    # Link each of the (node, is_left) pairs of a path of copied nodes to
+    # the next one, returning the first.
+    for i in xrange(1, len(path)):
+        (parent, is_left) = path[i - 1]
+        if is_left:
+            parent.left = path[i][0]
+        else:
+            parent.right = path[i][0]
+    return path[0][0]
+
+
+def join_lr(left, right, copy=False, rand=random.random):
     if left is None:
         return right
     if right is None:
         return left
-    n = left.size + right.size
-    if random.random() * n < (1.0 * left.size):
-        left.right = join_lr(left.right, right)
-        left.size = n
-        return left
+    # Repeatedly take the root of one of the trees, chosen at random in
+    # proportion to their sizes, as the next node down the joined tree,
+    # leaving its inner subtree to be joined with the other tree below it.
+    root = parent = None
+    while left is not None and right is not None:
+        n = left.size + right.size
+        if rand() * n < (1.0 * left.size):
+            (node, left, is_left) = (left, left.right, False)
+        else:
+            (node, right, is_left) = (right, right.left, True)
+        if copy:
+            node = copy_node(node)
+        node.size = n
+        if parent is None:
+            root = node
+        elif parent_is_left:
+            parent.left = node
+        else:
+            parent.right = node
+        (parent, parent_is_left) = (node, is_left)
+    rest = left if right is None else right
+    if parent_is_left:
+        parent.left = rest
     else:
-        right.left = join_lr(left, right.left)
-        right.size = n
-        return right
+        parent.right = rest
+    return root
+
+
+def snapshot(tree):
+    # A copy of the tree in O(1) time, sharing all of its nodes. The tree
+    # is made persistent, if it wasn't already, so that neither it nor the
+    # copy changes the nodes that they share.
+    tree.persistent = True
+    snap = Tree(persistent=True, rand=tree.rand)
+    snap.root = tree.root
+    return snap
+
+
+def join(tree1, tree2):
+    # A tree of the nodes of both trees, all of whose keys must be smaller
+    # than those of tree2. Both trees are left empty.
+    if (tree1.root is not None and tree2.root is not None and
+            not max_key(tree1) < min_key(tree2)):
+        raise ValueError("keys of the first tree must be smaller than "
+                         "those of the second")
+    tree = Tree(tree1.persistent or tree2.persistent, tree1.rand)
+    tree.root = join_lr(tree1.root, tree2.root, copy=tree.persistent,
+                        rand=tree.rand)
+    tree1.root = tree2.root = None
+    return tree
+
+
+def split(tree, key):
+    # Two trees of the nodes with keys smaller than key and of those with
+    # keys at least key. The tree is left empty.
+    (lesser, greater) = (Tree(tree.persistent, tree.rand),
+                         Tree(tree.persistent, tree.rand))
+    (lesser.root, greater.root) = split_r(tree.root, key,
+                                          copy=tree.persistent)
+    tree.root = None
+    return (lesser, greater)
+
+
+def split_r(node, key, inclusive=False, copy=False):
+    # Walk down from node, hanging each node and the subtree on its far side
+    # from key off the tree on its own side of key, then fix the sizes of
+    # the walked nodes from the bottom up. With inclusive, a node with the
+    # key itself goes into the lesser tree rather than the greater one.
+    path = []
+    lesser = greater = None
+    lesser_last = greater_last = None
+    while node is not None:
+        if copy:
+            node = copy_node(node)
+        path.append(node)
+        if node.key < key or (inclusive and not key < node.key):
+            if lesser_last is None:
+                lesser = node
+            else:
+                lesser_last.right = node
+            (lesser_last, node) = (node, node.right)
+        else:
+            if greater_last is None:
+                greater = node
+            else:
+                greater_last.left = node
+            (greater_last, node) = (node, node.left)
+    if lesser_last is not None:
+        lesser_last.right = None
+    if greater_last is not None:
+        greater_last.left = None
+    for node in reversed(path):
+        node.size = 1 + size(node.left) + size(node.right)
+    return (lesser, greater)
+
+
+def remove_range(tree, lo, hi):
+    # Remove the keys k with lo <= k <= hi, returning how many there were.
+    if tree is None or tree.root is None or hi < lo:
+        return 0
+    copy = tree.persistent
+    (lesser, rest) = split_r(tree.root, lo, copy=copy)
+    (removed, greater) = split_r(rest, hi, inclusive=True, copy=copy)
+    tree.root = join_lr(lesser, greater, copy=copy, rand=tree.rand)
+    return size(removed)
+
+
+def build_from_sorted(items, rand=None):
+    # A tree of the (key, value) pairs, whose keys must be increasing,
+    # built directly in O(n) time. The root of each subtree is chosen
+    # uniformly at random from its keys, just as inserting the keys one at
+    # a time with put would tend to.
+    items = items if isinstance(items, list) else list(items)
+    for i in xrange(1, len(items)):
+        if not items[i - 1][0] < items[i][0]:
+            raise ValueError("keys must be increasing: %r, %r"
+                             % (items[i - 1][0], items[i][0]))
+    tree = Tree(rand=rand)
+    rand = tree.rand
+    stack = [(0, len(items), None, False)]
+    while stack:
+        (lo, hi, parent, is_left) = stack.pop()
+        if lo == hi:
+            continue
+        mid = lo + int(rand() * (hi - lo))
+        node = Node(*items[mid])
+        node.size = hi - lo
+        if parent is None:
+            tree.root = node
+        elif is_left:
+            parent.left = node
+        else:
+            parent.right = node
+        stack.append((mid + 1, hi, node, False))
+        stack.append((lo, mid, node, True))
+    return tree
+
+
+def merge_items(items1, items2, keep_one):
+    # Merge two increasing sequences of (key, value) pairs, keeping a pair
+    # for each key in both, with the value from the second, and, if
+    # keep_one, the pairs of the keys in only one of them.
+    items1, items2 = iter(items1), iter(items2)
+    (item1, item2) = (next(items1, None), next(items2, None))
+    while item1 is not None and item2 is not None:
+        if item1[0] < item2[0]:
+            if keep_one:
+                yield item1
+            item1 = next(items1, None)
+        elif item2[0] < item1[0]:
+            if keep_one:
+                yield item2
+            item2 = next(items2, None)
+        else:
+            yield item2
+            (item1, item2) = (next(items1, None), next(items2, None))
+    if keep_one:
+        for (item, items) in ((item1, items1), (item2, items2)):
+            if item is not None:
+                yield item
+                for item in items:
+                    yield item
+
+
+def union(tree1, tree2):
+    # A new tree of the keys in either tree, taking the values of keys in
+    # both from tree2, as dict.update would, in O(m + n) time.
+    return build_from_sorted(merge_items(items(tree1), items(tree2), True),
+                             rand=tree1.rand)
+
+
+def intersection(tree1, tree2):
+    # A new tree of the keys in both trees, with their values from tree1,
+    # in O(m + n) time.
+    return build_from_sorted(merge_items(items(tree2), items(tree1), False),
+                             rand=tree1.rand)
+
+
+def items(tree, lo=None, hi=None, reverse=False):
+    # Generate the (key, value) pairs with lo <= key <= hi, where a bound of
+    # None is no bound, in increasing order of key, or decreasing order with
+    # reverse. Only the path to the next node is kept, so the memory used is
+    # O(height) and the first pair is found in O(log n) expected time.
+    if tree is None:
+        return
+    end = lo if reverse else hi
+    stack = seek_path(tree.root, hi if reverse else lo, [], reverse)
+    while stack:
+        node = next_path(stack, reverse)
+        if end is not None and (node.key < end if reverse else end < node.key):
+            return
+        yield (node.key, node.value)
+
+
+def keys(tree, lo=None, hi=None, reverse=False):
+    for (key, value) in items(tree, lo, hi, reverse):
+        yield key
+
+
+def seek_path(node, key, stack, reverse=False, inclusive=True):
+    # Push onto the stack the nodes on the path from node towards key that
+    # come at or after key in the order of iteration (only those after key
+    # if not inclusive), so that the last of them is the first to visit.
+    while node is not None:
+        if key is None:
+            after = True
+        elif reverse:
+            after = node.key < key or (inclusive and not key < node.key)
+        else:
+            after = key < node.key or (inclusive and not node.key < key)
+        if after:
+            stack.append(node)
+            node = node.right if reverse else node.left
+        else:
+            node = node.left if reverse else node.right
+    return stack
+
+
+def next_path(stack, reverse=False):
+    # Pop the next node to visit, pushing the nodes that come before the
+    # rest of the stack: those down the near side of its far subtree.
+    node = stack.pop()
+    child = node.left if reverse else node.right
+    while child is not None:
+        stack.append(child)
+        child = child.right if reverse else child.left
+    return node
+
+
+class Cursor(object):
+    # A position in the order of a tree's keys, returning the (key, value)
+    # pairs after it with next(). If the tree is changed, resume() moves the
+    # cursor onto the changed tree, just after the last key returned.
+
+    def __init__(self, tree, key=None, reverse=False):
+        self.tree = tree
+        self.reverse = reverse
+        self.seek(key)
+
+    def seek(self, key, inclusive=True):
+        # Move to just before key, or just after it if not inclusive, in
+        # the order of iteration; a key of None is the start of the tree.
+        self.position = (key, inclusive)
+        self.stack = seek_path(self.tree.root, key, [], self.reverse,
+                               inclusive)
+
+    def resume(self):
+        self.seek(*self.position)
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        if not self.stack:
+            raise StopIteration
+        node = next_path(self.stack, self.reverse)
+        self.position = (node.key, False)
+        return (node.key, node.value)
 
 
 def min_key(tree):
@@ -287,6 +818,214 @@ def max_key(tree):
     return curr.key if curr else None
 
 
+def select(tree, k):
+    # The key with k keys smaller than it (i.e., the (k + 1)th smallest), or
+    # None if k is out of range, found by using the subtree sizes to skip
+    # the whole left subtree whenever k is beyond it.
+    if tree is None or k is None:
+        return None
+    node = tree.root
+    if not 0 <= k < size(node):
+        return None
+    while node is not None:
+        left = left_size(node)
+        if k < left:
+            node = node.left
+        elif k > left:
+            k -= left + 1
+            node = node.right
+        else:
+            return node.key
+    return None
+
+
+def rank(tree, key):
+    # The number of keys smaller than key, whether or not key is present.
+    if tree is None or key is None:
+        return 0
+    return node_rank(tree.root, key, False)
+
+
+def node_rank(node, key, inclusive):
+    count = 0
+    while node is not None:
+        if key < node.key:
+            node = node.left
+        elif key > node.key:
+            count += left_size(node) + 1
+            node = node.right
+        else:
+            count += left_size(node) + (1 if inclusive else 0)
+            break
+    return count
+
+
+def count_range(tree, lo, hi):
+    # The number of keys k with lo <= k <= hi.
+    if tree is None or lo is None or hi is None or hi < lo:
+        return 0
+    return node_rank(tree.root, hi, True) - node_rank(tree.root, lo, False)
+
+
+def floor(tree, key):
+    # The largest key less than or equal to key, or None if there is none.
+    if tree is None or key is None:
+        return None
+    node, best = tree.root, None
+    while node is not None:
+        if key < node.key:
+            node = node.left
+        elif key > node.key:
+            best = node
+            node = node.right
+        else:
+            return node.key
+    return best.key if best else None
+
+
+def ceiling(tree, key):
+    # The smallest key greater than or equal to key, or None if there is
+    # none.
+    if tree is None or key is None:
+        return None
+    node, best = tree.root, None
+    while node is not None:
+        if key < node.key:
+            best = node
+            node = node.left
+        elif key > node.key:
+            node = node.right
+        else:
+            return node.key
+    return best.key if best else None
+
+
+class RWLock(object):
+    # A lock that many readers can hold at once, or a single writer. A
+    # waiting writer keeps new readers out, so writers aren't starved.
+
+    def __init__(self):
+        self.cond = threading.Condition(threading.Lock())
+        self.readers = 0
+        self.writing = False
+        self.writers_waiting = 0
+
+    def acquire_read(self):
+        with self.cond:
+            while self.writing or self.writers_waiting:
+                self.cond.wait()
+            self.readers += 1
+
+    def release_read(self):
+        with self.cond:
+            self.readers -= 1
+            if not self.readers:
+                self.cond.notify_all()
+
+    def acquire_write(self):
+        with self.cond:
+            self.writers_waiting += 1
+            while self.writing or self.readers:
+                self.cond.wait()
+            self.writers_waiting -= 1
+            self.writing = True
+
+    def release_write(self):
+        with self.cond:
+            self.writing = False
+            self.cond.notify_all()
+
+    @contextmanager
+    def read_locked(self):
+        self.acquire_read()
+        try:
+            yield
+        finally:
+            self.release_read()
+
+    @contextmanager
+    def write_locked(self):
+        self.acquire_write()
+        try:
+            yield
+        finally:
+            self.release_write()
+
+
+def put_many(tree, pairs):
+    # Set the value of each of the (key, value) pairs' key, inserting the
+    # keys not yet in the tree, a later pair winning over an earlier one
+    # with the same key. A batch that is large for the tree is sorted and
+    # merged with it, rebuilding the tree in O(m log m + n) time rather than
+    # O(m log n).
+    pairs = pairs if isinstance(pairs, list) else list(pairs)
+    n = size(tree.root)
+    rebuilt = len(pairs) * max(1, n.bit_length()) >= n
+    if not rebuilt:
+        for (key, value) in pairs:
+            node = node_get(tree.root, key)
+            if node is None:
+                put(tree, key, value)
+            elif tree.persistent:
+                tree.root = replace_value(tree.root, key, value)
+            else:
+                node.value = value
+    else:
+        batch = sorted(pairs, key=lambda item: item[0])
+        batch = [item for (i, item) in enumerate(batch)
+                 if i + 1 == len(batch) or item[0] < batch[i + 1][0]]
+        tree.root = build_from_sorted(merge_items(items(tree), batch, True),
+                                      rand=tree.rand).root
+    if instruments is not None:
+        instruments.put_many(tree, len(pairs), size(tree.root) - n, rebuilt)
+
+
+class SharedTree(object):
+    # A tree that threads can share, with lookups holding the read lock and
+    # updates the write lock. To iterate over the tree without holding a
+    # lock, take a snapshot.
+
+    def __init__(self, tree=None):
+        self.tree = tree if tree is not None else Tree()
+        self.lock = RWLock()
+
+    def get(self, key):
+        with self.lock.read_locked():
+            return get(self.tree, key)
+
+    def node_get(self, key):
+        # A copy of the key's node without its children, since the node
+        # itself can be changed by a writer once the lock is released.
+        with self.lock.read_locked():
+            node = node_get(self.tree.root, key)
+            return Node(node.key, node.value) if node else None
+
+    def put(self, key, value):
+        with self.lock.write_locked():
+            return put(self.tree, key, value)
+
+    def put_many(self, pairs):
+        with self.lock.write_locked():
+            put_many(self.tree, pairs)
+
+    def remove(self, key):
+        with self.lock.write_locked():
+            return remove(self.tree, key)
+
+    def min_key(self):
+        with self.lock.read_locked():
+            return min_key(self.tree)
+
+    def max_key(self):
+        with self.lock.read_locked():
+            return max_key(self.tree)
+
+    def snapshot(self):
+        # snapshot makes the tree persistent, which is a change to it.
+        with self.lock.write_locked():
+            return snapshot(self.tree)
+
+
 def size(node):
     return node.size if node else 0
 
@@ -302,37 +1041,63 @@ def right_size(node):
 def verify_size(x, debug=True):
     if isinstance(x, Tree):
         x = x.root
-    if x is None:
-        return
-    calc_size = size_calc(x)
-    if (x is not None and size(x) != (1 + left_size(x) + right_size(x)) or
-            size(x) != calc_size):
-        if debug:
-            print("Invalid Size:\nnode (calc_size=%d):" % (calc_size,))
-            pprint(x)
+    # Visit the nodes in postorder, so that the calculated sizes of the
+    # subtrees of each node are on top of the stack of sizes when it is
+    # visited.
+    stack = [(x, False)]
+    sizes = []
+    while stack:
+        (node, visited) = stack.pop()
+        if node is None:
+            sizes.append(0)
+        elif not visited:
+            stack.append((node, True))
+            stack.append((node.right, False))
+            stack.append((node.left, False))
         else:
-            raise Exception("Invalid Size: (calc_size=%d, node.size=%d)"
-                            % (calc_size, x.size))
-    verify_size(x.left if x else None)
-    verify_size(x.right if x else None)
+            calc_size = 1 + sizes.pop() + sizes.pop()
+            sizes.append(calc_size)
+            if (size(node) != (1 + left_size(node) + right_size(node)) or
+                    size(node) != calc_size):
+                if debug:
+                    print("Invalid Size:\nnode (calc_size=%d):"
+                          % (calc_size,))
+                    print(node_text(node, 80))
+                else:
+                    raise Exception("Invalid Size: (calc_size=%d, "
+                                    "node.size=%d)" % (calc_size, node.size))
 
 
 def height(x):
     if isinstance(x, Tree):
         x = x.root
-    if x is None:
-        return 0
-    return 1 + max(height(x.left), height(x.right))
+    result = 0
+    stack = [(x, 1)] if x is not None else []
+    while stack:
+        (node, depth) = stack.pop()
+        if depth > result:
+            result = depth
+        if node.left is not None:
+            stack.append((node.left, depth + 1))
+        if node.right is not None:
+            stack.append((node.right, depth + 1))
+    return result
 
 
 def size_calc(node):
-    if node is None:
-        return 0
-    return (1 + (size_calc(node.left) if node.left else 0) +
-            (size_calc(node.right) if node.right else 0))
-
-
-def seed(tree, n, low=0, high=None, unique=False, debug=False):
+    count = 0
+    stack = [node] if node is not None else []
+    while stack:
+        node = stack.pop()
+        count += 1
+        if node.left is not None:
+            stack.append(node.left)
+        if node.right is not None:
+            stack.append(node.right)
+    return count
+
+
+def seed(tree, n, low=0, high=None, unique=False):
     if high is None:
         high = 100 * n
 
@@ -346,14 +1111,14 @@ def seed(tree, n, low=0, high=None, unique=False, debug=False):
                 key = next()
         keys.add(key)
         new_val = next()
-        put(tree, key, new_val, debug=debug)
+        put(tree, key, new_val)
 
 tree = Tree()
 
 
-def f(tree, n=100, debug=False):
+def f(tree, n=100):
     for i in range(n):
-        put(tree, i, random.randint(0, n * 10), debug=debug)
+        put(tree, i, random.randint(0, n * 10))
         size_c = size_calc(tree.root)
         if tree.root.size != size_c:
             print("ERROR: tree.root.size=%d, size_calc(tree.root)=%d"
@@ -424,6 +1189,288 @@ def stress_test_unseed_minmax(tree):
     print("last (min, max) = (%s, %s)" % (curr_min, curr_max))
 
 
+def stress_test_order_stats(n=10 * 1000, ops=20 * 1000):
+    # Check select, rank, count_range, floor, ceiling, min_key and max_key
+    # against a sorted list of the keys while keys are inserted and removed.
+    tree = Tree()
+    keys = []
+    for i in xrange(ops):
+        k = random.randint(0, n)
+        if random.random() < 0.6:
+            put(tree, k, i)
+            if k not in keys:
+                bisect.insort(keys, k)
+        else:
+            remove(tree, k)
+            if k in keys:
+                keys.remove(k)
+        count = len(keys)
+        assert count == (tree.root.size if tree.root else 0)
+        assert min_key(tree) == (keys[0] if keys else None)
+        assert max_key(tree) == (keys[-1] if keys else None)
+        j = random.randint(-1, count)
+        assert select(tree, j) == (keys[j] if 0 <= j < count else None)
+        q = random.randint(-1, n + 1)
+        lo = bisect.bisect_left(keys, q)
+        assert rank(tree, q) == lo
+        hi = q + random.randint(0, n // 10)
+        assert (count_range(tree, q, hi) ==
+                bisect.bisect_right(keys, hi) - lo)
+        up = bisect.bisect_right(keys, q)
+        assert floor(tree, q) == (keys[up - 1] if up else None)
+        assert ceiling(tree, q) == (keys[lo] if lo < count else None)
+        if i > 0 and i % 10000 == 0:
+            print("%6d %6d: size is %d" % (i, height(tree), count))
+    return tree
+
+
+def stress_test_iteration(n=1000, ops=20 * 1000):
+    # Check forward, reverse and bounded items, and a cursor each way
+    # resumed after every change, against sorted(d) while keys are inserted
+    # and removed.
+    tree = Tree()
+    d = {}
+    cursors = (Cursor(tree), Cursor(tree, reverse=True))
+    for i in xrange(ops):
+        k = random.randint(0, n)
+        if random.random() < 0.6:
+            put(tree, k, -k)
+            d[k] = -k
+        else:
+            remove(tree, k)
+            d.pop(k, None)
+        expected = sorted(d.items())
+        keys = [key for (key, value) in expected]
+        if i % 10 == 0:
+            assert list(items(tree)) == expected
+            assert list(items(tree, reverse=True)) == expected[::-1]
+            lo = random.randint(-1, n + 1)
+            hi = lo + random.randint(-1, n // 10)
+            inside = expected[bisect.bisect_left(keys, lo):
+                              bisect.bisect_right(keys, hi)]
+            assert list(items(tree, lo, hi)) == inside
+            assert list(items(tree, lo, hi, reverse=True)) == inside[::-1]
+        for cursor in cursors:
+            cursor.resume()
+            (key, inclusive) = cursor.position
+            if key is None:
+                rest = expected[::-1] if cursor.reverse else expected
+            elif cursor.reverse:
+                end = (bisect.bisect_right if inclusive
+                       else bisect.bisect_left)(keys, key)
+                rest = expected[end - 1::-1] if end else []
+            else:
+                start = (bisect.bisect_left if inclusive
+                         else bisect.bisect_right)(keys, key)
+                rest = expected[start:]
+            steps = random.randint(1, 5)
+            for item in rest[:steps]:
+                assert next(cursor) == item
+            if steps > len(rest):
+                assert next(cursor, None) is None
+                cursor.seek(None)
+    return tree
+
+
+def benchmark_seed(n=100 * 1000, ordered=False):
+    # Time the inserts of stress_test_seed (without its checks) and then a
+    # lookup of every inserted key, reporting operations per second.
+    if ordered:
+        items = [(i, i * 2) for i in xrange(n)]
+    else:
+        items = [(random.randint(0, n), random.randint(0, n))
+                 for i in xrange(n)]
+    tree = Tree()
+    start = time.time()
+    for (k, v) in items:
+        put(tree, k, v)
+    insert_time = time.time() - start
+    start = time.time()
+    for (k, v) in items:
+        get(tree, k)
+    lookup_time = time.time() - start
+    print("%8d %-9s %6d: %10.0f inserts/s %10.0f lookups/s"
+          % (n, "ordered" if ordered else "random", height(tree),
+             n / insert_time, n / lookup_time))
+    return tree
+
+
+def benchmark_bulk(n=100 * 1000):
+    # Time building a tree of n keys, and then removing the middle half of
+    # its keys, one key at a time and in bulk.
+    items = [(i, i * 2) for i in xrange(n)]
+    (lo, hi) = (n // 4, n - n // 4 - 1)
+    start = time.time()
+    tree = Tree()
+    for (k, v) in items:
+        put(tree, k, v)
+    put_time = time.time() - start
+    start = time.time()
+    for k in xrange(lo, hi + 1):
+        remove(tree, k)
+    remove_time = time.time() - start
+    start = time.time()
+    tree = build_from_sorted(items)
+    build_time = time.time() - start
+    start = time.time()
+    remove_range(tree, lo, hi)
+    remove_range_time = time.time() - start
+    print("%8d: put %8.3fs  build_from_sorted %8.3fs  "
+          "remove %8.3fs  remove_range %8.6fs"
+          % (n, put_time, build_time, remove_time, remove_range_time))
+    return tree
+
+
+def benchmark_draws(n=100 * 1000, trees=10):
+    # Build trees of n random keys, with seeded random.Random and with
+    # random.SystemRandom draws, making one draw per node visited by an
+    # insert and then one draw per insert, and report the inserts per
+    # second and the heights of the trees for each.
+    global reuse_draws
+    saved = reuse_draws
+    keys = [random.randint(0, n) for i in xrange(n)]
+    try:
+        for source in ('Random', 'SystemRandom'):
+            for reuse in (False, True):
+                reuse_draws = reuse
+                heights = []
+                elapsed = 0.0
+                for i in xrange(trees):
+                    if source == 'Random':
+                        rand = random.Random(i).random
+                    else:
+                        rand = random.SystemRandom().random
+                    tree = Tree(rand=rand)
+                    start = time.time()
+                    for k in keys:
+                        put(tree, k, k)
+                    elapsed += time.time() - start
+                    heights.append(height(tree))
+                print("%8d %-12s %-10s: %10.0f inserts/s, "
+                      "height mean %5.1f, min %3d, max %3d"
+                      % (n, source, "per-insert" if reuse else "per-node",
+                         n * trees / elapsed, sum(heights) / float(trees),
+                         min(heights), max(heights)))
+    finally:
+        reuse_draws = saved
+
+
+def benchmark_instruments(n=100 * 1000):
+    # Time n random puts and gets without and with instruments installed,
+    # and report what the instruments counted.
+    global instruments
+    saved = instruments
+    items = [(random.randint(0, n), i) for i in xrange(n)]
+    try:
+        for hooks in (None, Instruments()):
+            instruments = hooks
+            tree = Tree()
+            start = time.time()
+            for (k, v) in items:
+                put(tree, k, v)
+            for (k, v) in items:
+                get(tree, k)
+            elapsed = time.time() - start
+            print("%8d %-11s: %10.0f ops/s"
+                  % (n, "instruments" if hooks else "none",
+                     2 * n / elapsed))
+    finally:
+        instruments = saved
+    pprint(hooks.summary())
+    return hooks
+
+
+def benchmark_memory(n=100 * 1000):
+    # Report the size of a single node, and the growth in the peak memory
+    # of the process while building a tree of n random keys.
+    node = Node(0, 0)
+    node_size = sys.getsizeof(node)
+    if hasattr(node, '__dict__'):
+        node_size += sys.getsizeof(node.__dict__)
+    before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    tree = Tree()
+    for i in xrange(n):
+        put(tree, random.randint(0, n), i)
+    growth = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - before
+    print("%8d nodes: %d bytes per node, peak memory grew by %d kB"
+          % (tree.root.size, node_size, growth))
+    return tree
+
+
+def benchmark_snapshots(n=100 * 1000, updates=100 * 1000, every=100):
+    # Make random updates to a persistent tree of n keys, keeping a snapshot
+    # of it after every so many, and report the time per update, the nodes
+    # allocated per update (those not shared with an earlier snapshot) and
+    # the growth in the peak memory of the process.
+    tree = build_from_sorted((i, i) for i in xrange(n))
+    snaps = [snapshot(tree)]
+    before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    start = time.time()
+    for i in xrange(updates):
+        k = random.randint(0, n)
+        if i % 2:
+            put(tree, k, i)
+        else:
+            remove(tree, k)
+        if i % every == 0:
+            snaps.append(snapshot(tree))
+    update_time = time.time() - start
+    growth = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - before
+    seen = set()
+    for snap in snaps + [tree]:
+        stack = [snap.root]
+        while stack:
+            node = stack.pop()
+            if node is not None and id(node) not in seen:
+                seen.add(id(node))
+                stack.append(node.left)
+                stack.append(node.right)
+    print("%8d keys, %d snapshots: %8.1f us/update, %5.1f nodes/update, "
+          "peak memory grew by %d kB"
+          % (n, len(snaps), 1e6 * update_time / updates,
+             (len(seen) - n) / float(updates), growth))
+    return snaps
+
+
+def benchmark_threads(n=100 * 1000, ops=100 * 1000, writes=0.1, batch=1):
+    # Share a tree of n keys between 1, 2, 4 and 8 threads, each making its
+    # share of ops random lookups and updates (the given fraction of them
+    # writes, put in batches of the given size), and report the overall
+    # operations per second.
+    shared = SharedTree(build_from_sorted((i, i) for i in xrange(n)))
+
+    def work(count):
+        rand = random.Random(count)
+        pairs = []
+        for i in xrange(count):
+            k = rand.randint(0, n)
+            if rand.random() < writes:
+                pairs.append((k, i))
+                if len(pairs) >= batch:
+                    if batch == 1:
+                        shared.put(k, i)
+                    else:
+                        shared.put_many(pairs)
+                    pairs = []
+            else:
+                shared.get(k)
+        if pairs:
+            shared.put_many(pairs)
+    for count in (1, 2, 4, 8):
+        threads = [threading.Thread(target=work, args=(ops // count,))
+                   for i in xrange(count)]
+        start = time.time()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.time() - start
+        print("%8d keys, %d threads, %3.0f%% writes in batches of %d: "
+              "%10.0f ops/s" % (n, count, 100 * writes, batch,
+                                ops / elapsed))
+    return shared
+
+
 pickle_path = 'tree.pickle'
 
 
@@ -443,6 +1490,201 @@ def read_tree(path=pickle_path):
         f.close()
     return tree
 
+# The binary format is a header followed by a record per node in preorder,
+# each giving the sizes of the node's subtree and left subtree and the
+# lengths of its marshalled key and value, which follow it, and then an
+# index of the offsets of the records. With the sizes, the tree can be
+# rebuilt in one pass; with the index, the child records of a node can be
+# found without reading its subtrees.
+binary_path = 'tree.rbst'
+binary_magic = 'RBST'
+binary_version = 1
+binary_header = struct.Struct('<4sB3xQQ')
+binary_record = struct.Struct('<IIII')
+binary_offset = struct.Struct('<Q')
+
+
+def write_tree_binary(tree, path=binary_path):
+    # Write the tree in one pass, keeping only the path to the next node
+    # and a buffer in memory, with the index going to a temporary file
+    # until the records are all written.
+    f = open(path, 'wb')
+    index = tempfile.TemporaryFile()
+    try:
+        f.write(binary_header.pack(binary_magic, binary_version, 0, 0))
+        offset = binary_header.size
+        stack = [tree.root] if tree.root is not None else []
+        while stack:
+            node = stack.pop()
+            key = marshal.dumps(node.key)
+            value = marshal.dumps(node.value)
+            index.write(binary_offset.pack(offset))
+            f.write(binary_record.pack(node.size, size(node.left),
+                                       len(key), len(value)))
+            f.write(key)
+            f.write(value)
+            offset += binary_record.size + len(key) + len(value)
+            if node.right is not None:
+                stack.append(node.right)
+            if node.left is not None:
+                stack.append(node.left)
+        index.seek(0)
+        shutil.copyfileobj(index, f)
+        f.seek(0)
+        f.write(binary_header.pack(binary_magic, binary_version,
+                                   size(tree.root), offset))
+    finally:
+        index.close()
+        f.close()
+
+
+def read_binary_header(f, path):
+    header = f.read(binary_header.size)
+    if len(header) < binary_header.size:
+        raise ValueError("%s: too short for a tree file" % (path,))
+    (magic, version, count, index_offset) = binary_header.unpack(header)
+    if magic != binary_magic or version != binary_version:
+        raise ValueError("%s: not a version %d tree file"
+                         % (path, binary_version))
+    # The index of the records' offsets ends the file.
+    if (index_offset < binary_header.size or index_offset +
+            count * binary_offset.size != os.fstat(f.fileno()).st_size):
+        raise ValueError("%s: truncated or corrupt tree file" % (path,))
+    return (count, index_offset)
+
+
+def corrupt_tree_file(path):
+    return ValueError("%s: corrupt tree file" % (path,))
+
+
+# The errors that marshal.loads raises for data it didn't write.
+marshal_errors = (EOFError, ValueError, TypeError)
+
+
+def read_tree_binary(path=binary_path):
+    # Rebuild the tree in one pass over the records, keeping a stack of the
+    # subtrees still to be read, whose sizes say where each one ends.
+    f = open(path, 'rb')
+    try:
+        (count, index_offset) = read_binary_header(f, path)
+        tree = Tree()
+        stack = [(None, False)] if count else []
+        offset = binary_header.size
+        while stack:
+            (parent, is_left) = stack.pop()
+            if offset + binary_record.size > index_offset:
+                raise corrupt_tree_file(path)
+            (n, left, key_len, value_len) = binary_record.unpack(
+                f.read(binary_record.size))
+            offset += binary_record.size + key_len + value_len
+            if offset > index_offset or not left < n:
+                raise corrupt_tree_file(path)
+            try:
+                node = Node(marshal.loads(f.read(key_len)),
+                            marshal.loads(f.read(value_len)))
+            except marshal_errors:
+                raise corrupt_tree_file(path)
+            node.size = n
+            if parent is None:
+                tree.root = node
+            elif is_left:
+                parent.left = node
+            else:
+                parent.right = node
+            if n - left - 1:
+                stack.append((node, False))
+            if left:
+                stack.append((node, True))
+    finally:
+        f.close()
+    return tree
+
+
+class MappedTree(object):
+    # A read-only tree answering get straight from a memory-mapped file
+    # written by write_tree_binary, reading only the records on the path
+    # to the key.
+
+    def __init__(self, path=binary_path):
+        self.path = path
+        f = open(path, 'rb')
+        try:
+            (self.size, self.index_offset) = read_binary_header(f, path)
+            self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        finally:
+            f.close()
+
+    def close(self):
+        self.map.close()
+
+    def record(self, i):
+        # The sizes, key and offset of the value of the ith record.
+        (offset,) = binary_offset.unpack_from(
+            self.map, self.index_offset + i * binary_offset.size)
+        if offset + binary_record.size > self.index_offset:
+            raise corrupt_tree_file(self.path)
+        (n, left, key_len, value_len) = binary_record.unpack_from(
+            self.map, offset)
+        start = offset + binary_record.size
+        if start + key_len + value_len > self.index_offset:
+            raise corrupt_tree_file(self.path)
+        try:
+            key = marshal.loads(self.map[start:start + key_len])
+        except marshal_errors:
+            raise corrupt_tree_file(self.path)
+        return (n, left, key, start + key_len, value_len)
+
+    def get(self, key):
+        if key is None:
+            return None
+        (i, end) = (0, self.size)
+        while i < end:
+            (n, left, node_key, start, value_len) = self.record(i)
+            if key < node_key:
+                end = i + 1 + left
+                i += 1
+            elif key > node_key:
+                i += 1 + left
+            else:
+                try:
+                    return marshal.loads(self.map[start:start + value_len])
+                except marshal_errors:
+                    raise corrupt_tree_file(self.path)
+        return None
+
+
+def benchmark_serialize(n=100 * 1000):
+    # Time writing and reading a tree of n random keys with pickle and in
+    # the binary format, and looking up every key in the mapped file,
+    # reporting the sizes of the files.
+    tree = Tree()
+    for i in xrange(n):
+        put(tree, random.randint(0, n), i)
+    all_keys = list(keys(tree))
+    for (name, path, write, read) in (
+            ('pickle', pickle_path, write_tree, read_tree),
+            ('binary', binary_path, write_tree_binary, read_tree_binary)):
+        start = time.time()
+        write(tree, path)
+        write_time = time.time() - start
+        start = time.time()
+        read(path)
+        read_time = time.time() - start
+        print("%8d %-6s: write %6.3fs  read %6.3fs  %10d bytes"
+              % (tree.root.size, name, write_time, read_time,
+                 os.path.getsize(path)))
+    mapped = MappedTree(binary_path)
+    try:
+        start = time.time()
+        for k in all_keys:
+            mapped.get(k)
+        elapsed = time.time() - start
+    finally:
+        mapped.close()
+    print("%8d mapped: %10.0f lookups/s"
+          % (tree.root.size, len(all_keys) / elapsed))
+
+
 t = Tree()
 r, w, s = read_tree, write_tree, seed
 unpop, pop = stress_test_unseed_minmax, stress_test_seed
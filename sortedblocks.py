@@ -0,0 +1,241 @@
+import bisect
+import random
+import sys
+import time
+
+import randbst
+
+
+# The most keys a block holds before it is split in two, and the fewest it
+# holds before it is merged with a neighbour.
+max_block = 512
+min_block = max_block // 4
+
+
+class Tree(object):
+    # An ordered map with the same module-level API as randbst, keeping its
+    # keys in a list of sorted blocks of a few hundred keys each, with the
+    # values in a parallel list of blocks. A lookup bisects the list of the
+    # blocks' last keys to find the block and then bisects the block, so it
+    # touches two contiguous arrays rather than a node per level.
+
+    def __init__(self):
+        self.keys = []
+        self.values = []
+        self.maxes = []
+        self.size = 0
+
+    def is_empty(self):
+        return self.size == 0
+
+    def __str__(self):
+        return "Tree[%s]" % (", ".join("%r: %r" % item
+                                       for item in items(self)),)
+
+    __repr__ = __str__
+
+
+def find_block(tree, key):
+    # The index of the block that key is in or belongs in.
+    i = bisect.bisect_left(tree.maxes, key)
+    return i if i < len(tree.maxes) else i - 1
+
+
+def put(tree, key, value):
+    if not tree.keys:
+        tree.keys.append([key])
+        tree.values.append([value])
+        tree.maxes.append(key)
+        tree.size = 1
+        return None
+    i = find_block(tree, key)
+    (keys, values) = (tree.keys[i], tree.values[i])
+    j = bisect.bisect_left(keys, key)
+    if j < len(keys) and not key < keys[j]:
+        old_value = values[j]
+        values[j] = value
+        return old_value
+    keys.insert(j, key)
+    values.insert(j, value)
+    tree.maxes[i] = keys[-1]
+    tree.size += 1
+    if len(keys) > max_block:
+        split_block(tree, i)
+    return None
+
+
+def get(tree, key):
+    if key is None or not tree.keys:
+        return None
+    i = find_block(tree, key)
+    keys = tree.keys[i]
+    j = bisect.bisect_left(keys, key)
+    if j < len(keys) and not key < keys[j]:
+        return tree.values[i][j]
+    return None
+
+
+def remove(tree, key):
+    if tree is None or key is None or not tree.keys:
+        return None
+    i = find_block(tree, key)
+    (keys, values) = (tree.keys[i], tree.values[i])
+    j = bisect.bisect_left(keys, key)
+    if j == len(keys) or key < keys[j]:
+        return None
+    old_value = values[j]
+    del keys[j]
+    del values[j]
+    tree.size -= 1
+    if keys:
+        tree.maxes[i] = keys[-1]
+        if len(keys) < min_block and len(tree.keys) > 1:
+            merge_block(tree, i)
+    else:
+        del tree.keys[i]
+        del tree.values[i]
+        del tree.maxes[i]
+    return old_value
+
+
+def split_block(tree, i):
+    (keys, values) = (tree.keys[i], tree.values[i])
+    half = len(keys) // 2
+    tree.keys[i + 1:i + 1] = [keys[half:]]
+    tree.values[i + 1:i + 1] = [values[half:]]
+    del keys[half:]
+    del values[half:]
+    tree.maxes[i:i + 1] = [keys[-1], tree.keys[i + 1][-1]]
+
+
+def merge_block(tree, i):
+    # Merge the ith block into a neighbour, splitting the result again if
+    # it is too big.
+    if i == len(tree.keys) - 1:
+        i -= 1
+    tree.keys[i].extend(tree.keys[i + 1])
+    tree.values[i].extend(tree.values[i + 1])
+    tree.maxes[i] = tree.keys[i][-1]
+    del tree.keys[i + 1]
+    del tree.values[i + 1]
+    del tree.maxes[i + 1]
+    if len(tree.keys[i]) > max_block:
+        split_block(tree, i)
+
+
+def min_key(tree):
+    if tree is None or not tree.keys:
+        return None
+    return tree.keys[0][0]
+
+
+def max_key(tree):
+    if tree is None or not tree.maxes:
+        return None
+    return tree.maxes[-1]
+
+
+def items(tree):
+    for (keys, values) in zip(tree.keys, tree.values):
+        for item in zip(keys, values):
+            yield item
+
+
+def memory(tree):
+    # The bytes taken by the lists of the tree, not counting the keys and
+    # values themselves.
+    return (sys.getsizeof(tree.keys) + sys.getsizeof(tree.values) +
+            sys.getsizeof(tree.maxes) +
+            sum(sys.getsizeof(block) for block in tree.keys) +
+            sum(sys.getsizeof(block) for block in tree.values))
+
+
+def stress_test_random(n=10 * 1000, ops=100 * 1000):
+    # Check put, get, remove, min_key and max_key against a dict, with
+    # enough keys to split and merge blocks.
+    tree = Tree()
+    d = {}
+    for i in xrange(ops):
+        k = random.randint(0, n)
+        if random.random() < 0.55:
+            assert put(tree, k, i) == d.get(k)
+            d[k] = i
+        else:
+            assert remove(tree, k) == d.pop(k, None)
+        assert get(tree, k) == d.get(k)
+        assert tree.size == len(d)
+        if i % 1000 == 0:
+            assert list(items(tree)) == sorted(d.items())
+            assert min_key(tree) == (min(d) if d else None)
+            assert max_key(tree) == (max(d) if d else None)
+            assert all(0 < len(keys) <= max_block for keys in tree.keys)
+    return tree
+
+
+def workload_seed(module, n, ordered=False):
+    # The puts of randbst.stress_test_seed, with its checks of min_key and
+    # max_key after each one.
+    tree = module.Tree()
+    curr_min, curr_max = None, None
+    for i in xrange(n):
+        if ordered:
+            k, v = i, i * 2
+        else:
+            k, v = random.randint(0, n), random.randint(0, n)
+        if curr_min is None or k < curr_min:
+            curr_min = k
+        if curr_max is None or k > curr_max:
+            curr_max = k
+        module.put(tree, k, v)
+        assert module.min_key(tree) == curr_min
+        assert module.max_key(tree) == curr_max
+    return tree
+
+
+def workload_unseed_minmax(module, tree):
+    # The removes of randbst.stress_test_unseed_minmax: the smallest or
+    # largest key at random, and a key that isn't there, until the tree is
+    # empty.
+    curr_min, curr_max = module.min_key(tree), module.max_key(tree)
+    while not tree.is_empty():
+        if random.choice((True, False)):
+            assert module.remove(tree, curr_min) is not None
+            curr_min = module.min_key(tree)
+        else:
+            assert module.remove(tree, curr_max) is not None
+            curr_max = module.max_key(tree)
+        if not tree.is_empty():
+            assert module.remove(tree, (curr_max + 1) * -1) is None
+
+
+def benchmark(n=100 * 1000):
+    # Run the seed workload, lookups of every key, and the unseed workload
+    # against randbst and sorted blocks, with the same keys for each,
+    # reporting operations per second and the memory taken by the
+    # structure (not counting the keys and values).
+    state = random.getstate()
+    blocks = sys.modules[__name__]
+    for (name, module) in (('randbst', randbst), ('blocks', blocks)):
+        for ordered in (False, True):
+            random.setstate(state)
+            start = time.time()
+            tree = workload_seed(module, n, ordered)
+            seed_time = time.time() - start
+            keys = [k for (k, v) in module.items(tree)]
+            if module is randbst:
+                count = tree.root.size
+                size = count * sys.getsizeof(tree.root)
+            else:
+                (count, size) = (tree.size, memory(tree))
+            start = time.time()
+            for k in keys:
+                module.get(tree, k)
+            get_time = time.time() - start
+            start = time.time()
+            workload_unseed_minmax(module, tree)
+            unseed_time = time.time() - start
+            print("%8d %-7s %-7s: %8.0f puts/s %8.0f gets/s %8.0f removes/s "
+                  "%5.1f bytes/key"
+                  % (n, name, "ordered" if ordered else "random",
+                     n / seed_time, count / get_time, count / unseed_time,
+                     size / float(count)))